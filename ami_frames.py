@@ -0,0 +1,92 @@
+"""
+Streaming AMI frame parser
+Shared by asterisk-realtime-websocket.py and asterisk-realtime-report.py
+
+AMI frames are blocks of "Key: value" lines terminated by a blank line
+(\r\n\r\n).  The parser keeps unconsumed bytes in a bytearray, searches for
+the terminator only in bytes that have not been scanned yet, and decodes
+each frame exactly once straight from a memoryview, so the work per read is
+proportional to the bytes received rather than to the buffered response.
+"""
+
+from typing import List
+
+FRAME_END = b'\r\n\r\n'
+
+
+class AMIFrame(dict):
+    """One AMI frame (response or event) as a field dict.
+
+    Lines that are not "Key: value" headers (raw CLI output of a `Command`
+    action on older Asterisk) and repeated `Output` headers (Asterisk 14+)
+    are collected, newline-joined, under 'Output'.
+    """
+
+    __slots__ = ()
+
+    @property
+    def event(self) -> str:
+        return self.get('Event', '')
+
+
+def parse_frame(data) -> AMIFrame:
+    """Parse one frame (bytes or memoryview, without the blank-line terminator)"""
+    frame = AMIFrame()
+    output = []
+    for line in str(data, 'utf-8', 'ignore').split('\r\n'):
+        key, sep, value = line.partition(': ')
+        if sep and key and ' ' not in key and '/' not in key:
+            if key == 'Output':
+                output.append(value)
+            else:
+                frame[key] = value.strip()
+        elif line.strip():
+            output.append(line)
+    if output:
+        frame['Output'] = '\n'.join(output)
+    return frame
+
+
+class AMIFrameParser:
+    """Incremental AMI frame parser.
+
+    Feed it raw socket reads; it returns the frames completed by each read.
+    With ``expect_banner`` the first line ("Asterisk Call Manager/x.y.z"),
+    which has no blank-line terminator, is stored in ``banner`` instead.
+    """
+
+    def __init__(self, expect_banner: bool = False):
+        self.banner = None if expect_banner else ''
+        self._buf = bytearray()
+        self._scanned = 0     # bytes of _buf already searched for FRAME_END
+
+    def feed(self, data: bytes) -> List[AMIFrame]:
+        buf = self._buf
+        buf += data
+
+        start = 0
+        if self.banner is None:
+            eol = buf.find(b'\r\n')
+            if eol == -1:
+                return []
+            self.banner = buf[:eol].decode('utf-8', 'ignore')
+            start = eol + 2
+            self._scanned = start
+
+        frames = []
+        # A terminator may straddle the previous read, so back up 3 bytes.
+        pos = buf.find(FRAME_END, max(start, self._scanned - 3))
+        if pos != -1:
+            with memoryview(buf) as view:
+                while pos != -1:
+                    frames.append(parse_frame(view[start:pos]))
+                    start = pos + 4
+                    pos = buf.find(FRAME_END, start)
+        if start:
+            del buf[:start]
+        self._scanned = len(buf)
+        return frames
+
+    def pending(self) -> int:
+        """Number of buffered bytes not yet forming a complete frame"""
+        return len(self._buf)
@@ -0,0 +1,153 @@
+/*
+ * Realtime WebSocket protocol client, shared by ui/realtime.php and
+ * ui/realtime-queues.php.
+ *
+ * The page defines, before calling connectWebSocket():
+ *   SUBSCRIPTION       the subscribe object sent in the hello
+ *   updateDisplay(d)   renders a full snapshot
+ *   formatDuration(s)  seconds -> "m:ss"
+ * and has #connectionStatus and #updateStatus elements.
+ */
+
+let ws = null;
+let reconnectInterval = null;
+
+// ── Protocol 2: snapshot once, then sequence-numbered deltas ────────────────
+const DELTA_SECTIONS = { calls: 'call_id', extension_kpis: 'extension', queues: 'name' };
+let snapshot = null;
+let lastSeq = 0;
+let epoch = null;       // server-side stream the sequence numbers belong to
+
+// Columnar layout: {fields: [...], rows: [[...], ...]} -> list of objects
+function fromColumns(block) {
+  if (Array.isArray(block)) return block;
+  return block.rows.map(row => {
+    const entry = {};
+    block.fields.forEach((field, i) => { entry[field] = row[i]; });
+    return entry;
+  });
+}
+
+function applyDelta(state, delta) {
+  Object.assign(state, delta.set || {});
+  (delta.unset || []).forEach(k => { delete state[k]; });
+  for (const section in DELTA_SECTIONS) {
+    const change = delta[section];
+    if (!change) continue;
+    const idKey = DELTA_SECTIONS[section];
+    const byKey = new Map((state[section] || []).map(e => [e[idKey], e]));
+    (change.remove || []).forEach(k => byKey.delete(k));
+    fromColumns(change.upsert || []).forEach(e => byKey.set(e[idKey], e));
+    state[section] = change.order ? change.order.map(k => byKey.get(k)) : Array.from(byKey.values());
+  }
+}
+
+function handleMessage(msg) {
+  if (!msg.type) {                      // legacy full snapshot
+    updateDisplay(msg);
+    return;
+  }
+  if (msg.type === 'snapshot') {
+    snapshot = msg.data;
+    for (const section in DELTA_SECTIONS) {
+      if (snapshot[section]) snapshot[section] = fromColumns(snapshot[section]);
+    }
+    lastSeq = msg.seq;
+    epoch = msg.epoch;
+  } else if (msg.type === 'delta') {
+    if (msg.seq <= lastSeq) return;     // already covered by a newer snapshot
+    // seqs can skip values (a subscription that did not change, a worker
+    // that skipped ahead); base is the seq the delta applies on top of
+    const base = msg.base !== undefined ? msg.base : msg.seq - 1;
+    if (!snapshot || base !== lastSeq) {
+      ws.send(JSON.stringify({ type: 'resync' }));
+      return;
+    }
+    applyDelta(snapshot, msg);
+    lastSeq = msg.seq;
+  } else {
+    return;
+  }
+  updateDisplay(snapshot);
+}
+
+// "Last Update" is when the server built the data; flag it when AMI data is
+// lagging (e.g. while the service reconnects to Asterisk)
+function updateStatusText(data) {
+  const generated = data.timestamp ? new Date(data.timestamp * 1000) : new Date();
+  let text = 'Last Update: ' + generated.toLocaleTimeString();
+  const freshness = data.freshness || {};
+  const oldest = Math.min(...['channels', 'queues'].map(k => freshness[k]).filter(Boolean));
+  if (data.timestamp && isFinite(oldest) && data.timestamp - oldest > 30) {
+    text += ' (AMI data ' + formatDuration(data.timestamp - oldest) + ' old)';
+  }
+  return text;
+}
+
+function connectWebSocket() {
+  if (ws && ws.readyState === WebSocket.OPEN) {
+    return;
+  }
+
+  // Construct WebSocket URL - use current hostname with port 8765
+  const wsProtocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
+  const wsUrl = `${wsProtocol}//${window.location.hostname}:8765/?protocol=2`;
+
+  console.log('Connecting to WebSocket:', wsUrl);
+  document.getElementById('updateStatus').textContent = 'Connecting to WebSocket...';
+
+  try {
+    ws = new WebSocket(wsUrl);
+
+    ws.onopen = function() {
+      console.log('✓ WebSocket connected');
+      document.getElementById('connectionStatus').className = 'connection-status connected';
+      document.getElementById('updateStatus').textContent = 'Connected - Waiting for updates';
+      // After a reconnect, ask for just the deltas missed while away
+      const hello = { type: 'hello', protocol: 2, layout: 'columns', subscribe: SUBSCRIPTION };
+      if (snapshot) { hello.epoch = epoch; hello.last_seq = lastSeq; }
+      ws.send(JSON.stringify(hello));
+
+      // Clear reconnect interval if exists
+      if (reconnectInterval) {
+        clearInterval(reconnectInterval);
+        reconnectInterval = null;
+      }
+    };
+
+    ws.onmessage = function(event) {
+      try {
+        const msg = JSON.parse(event.data);
+        document.getElementById('connectionStatus').className = 'connection-status connected';
+        handleMessage(msg);
+      } catch (e) {
+        console.error('Error parsing WebSocket message:', e);
+      }
+    };
+
+    ws.onerror = function(error) {
+      console.error('WebSocket error:', error);
+      document.getElementById('connectionStatus').className = 'connection-status disconnected';
+      document.getElementById('updateStatus').textContent = 'Connection Error';
+    };
+
+    ws.onclose = function() {
+      console.log('✗ WebSocket disconnected');
+      document.getElementById('connectionStatus').className = 'connection-status disconnected';
+      document.getElementById('updateStatus').textContent = 'Disconnected - Reconnecting...';
+
+      // Attempt to reconnect every 5 seconds
+      if (!reconnectInterval) {
+        reconnectInterval = setInterval(function() {
+          console.log('Attempting to reconnect...');
+          connectWebSocket();
+        }, 5000);
+      }
+    };
+
+  } catch (e) {
+    console.error('Failed to create WebSocket:', e);
+    document.getElementById('connectionStatus').className = 'connection-status disconnected';
+    document.getElementById('updateStatus').textContent = 'Failed to connect';
+  }
+}
@@ -9,9 +9,14 @@ import socket
 import json
 import time
 import sys
-import re
 import os
+from collections import deque
 from datetime import datetime, date
+
+from ami_frames import AMIFrameParser
+from call_assembly import group_call_legs, originating_leg
+from channel_classifier import ChannelClassifier
+from cdr_stats import CDRWatermark, RefreshCoordinator, landed_query
 try:
     import pymysql
     MYSQL_AVAILABLE = True
@@ -44,6 +49,18 @@ EXTENSION_STATS = {}
 LAST_DB_RELOAD = 0
 DB_RELOAD_INTERVAL = 30  # Reload from DB every 30 seconds (instead of 5 minutes)
 
+# Hangups and the reload interval only request a reload; the coordinator
+# merges requests, spaces reloads apart and waits for a hangup's CDR row
+DB_REFRESH = RefreshCoordinator(
+    PROJECT_CONFIG.get('realtime', {}).get('dbRefreshMinInterval', 5),
+    PROJECT_CONFIG.get('realtime', {}).get('cdrLandingTimeout', 5),
+)
+CDR_LANDED = None  # (since, CDR row count) taken before the last reload
+# Rows written after a reload have a calldate no older than this mark (the
+# oldest call up or recently ended), so the landing probe counts only those
+CDR_WATERMARK = CDRWatermark(PROJECT_CONFIG.get('realtime', {}).get('cdrSettleTime', 120))
+CDR_PROBE_CONN = None  # kept open between probes
+
 # Track recently seen extensions (to keep them visible after call ends)
 RECENTLY_SEEN_EXTENSIONS = {}  # {extension: {'last_seen': timestamp, 'caller_id': name}}
 RECENT_EXTENSION_TIMEOUT = 300  # Keep extension visible for 5 minutes after last activity
@@ -88,6 +105,66 @@ def parse_db_config():
     return config
 
 
+def connect_db(autocommit=False):
+    db_config = parse_db_config()
+    return pymysql.connect(
+        host=db_config['host'],
+        user=db_config['user'],
+        password=db_config['password'],
+        database=db_config['database'],
+        port=db_config['port'],
+        autocommit=autocommit
+    )
+
+
+def count_landed(since):
+    """CDR rows with a calldate at or after ``since``, on the probe connection
+    (autocommit, so every probe sees the rows committed since the last)"""
+    global CDR_PROBE_CONN
+    try:
+        if CDR_PROBE_CONN is None:
+            CDR_PROBE_CONN = connect_db(autocommit=True)
+        else:
+            CDR_PROBE_CONN.ping(reconnect=True)
+        with CDR_PROBE_CONN.cursor(pymysql.cursors.DictCursor) as cursor:
+            cursor.execute(*landed_query(since))
+            return cursor.fetchone()['n']
+    except Exception:
+        if CDR_PROBE_CONN is not None:
+            try:
+                CDR_PROBE_CONN.close()
+            except Exception:
+                pass
+            CDR_PROBE_CONN = None
+        raise
+
+
+def mark_cdr_baseline(channels, now):
+    """Before a reload: remember how many CDR rows cdr_landed() starts from"""
+    global CDR_LANDED
+    if not MYSQL_AVAILABLE:
+        return
+    start_times = {ch['uniqueid'] or ch['channel']: now - ch['duration'] for ch in channels}
+    since = max(CDR_WATERMARK.update(start_times, now), datetime.combine(date.today(), datetime.min.time()))
+    try:
+        CDR_LANDED = (since, count_landed(since))
+    except Exception as e:
+        print(f"Warning: CDR landing baseline failed: {e}")
+        CDR_LANDED = None
+
+
+def cdr_landed():
+    """True once CDR rows were written since the last reload"""
+    if CDR_LANDED is None:
+        return True
+    since, count = CDR_LANDED
+    try:
+        return count_landed(since) > count
+    except Exception as e:
+        print(f"Warning: CDR landing check failed: {e}")
+        return True
+
+
 def load_extension_stats_from_db():
     """Load today's extension statistics from CDR database"""
     global EXTENSION_STATS
@@ -100,14 +177,7 @@ def load_extension_stats_from_db():
         db_config = parse_db_config()
         print(f"Connecting to database: {db_config['host']}/{db_config['database']}")
 
-        conn = pymysql.connect(
-            host=db_config['host'],
-            user=db_config['user'],
-            password=db_config['password'],
-            database=db_config['database'],
-            port=db_config['port']
-        )
-
+        conn = connect_db()
         cursor = conn.cursor(pymysql.cursors.DictCursor)
 
         # Get today's date range
@@ -229,6 +299,7 @@ def load_gateways():
     return ['we', 'trunk', 'gateway', 'pstn', 'did']
 
 GATEWAYS = load_gateways()
+CHANNEL_CLASSIFIER = ChannelClassifier(GATEWAYS)
 
 def parse_duration(duration_str):
     """Convert HH:MM:SS or seconds string to integer seconds"""
@@ -254,6 +325,8 @@ class AsteriskAMI:
         self.secret = secret
         self.socket = None
         self.logged_in = False
+        self.parser = None
+        self._frames = deque()
 
     def connect(self):
         """Connect to Asterisk Manager Interface"""
@@ -261,10 +334,16 @@ class AsteriskAMI:
             self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.socket.settimeout(10)
             self.socket.connect((self.host, self.port))
+            self.parser = AMIFrameParser(expect_banner=True)
+            self._frames = deque()
 
             # Read welcome message
-            response = self._read_response()
-            print(f"Connected to AMI: {response.get('Asterisk Call Manager', 'Unknown')}")
+            while self.parser.banner is None:
+                data = self.socket.recv(1024)
+                if not data:
+                    raise ConnectionError('connection closed before banner')
+                self._frames.extend(self.parser.feed(data))
+            print(f"Connected to AMI: {self.parser.banner or 'Unknown'}")
 
             return True
         except Exception as e:
@@ -278,6 +357,7 @@ class AsteriskAMI:
                 f"Action: Login\r\n"
                 f"Username: {self.username}\r\n"
                 f"Secret: {self.secret}\r\n"
+                f"Events: off\r\n"
                 f"\r\n"
             )
             self.socket.send(command.encode())
@@ -315,6 +395,9 @@ class AsteriskAMI:
                         'duration': parse_duration(event.get('Duration', 0)),
                         'application': event.get('Application', ''),
                         'bridged': event.get('BridgedChannel', ''),
+                        'uniqueid': event.get('Uniqueid', ''),
+                        'linkedid': event.get('Linkedid', ''),
+                        'bridgeid': event.get('BridgeId', ''),
                     })
 
             return channels
@@ -322,63 +405,43 @@ class AsteriskAMI:
             print(f"Error getting channels: {e}")
             return []
 
+    def _next_frame(self):
+        """Return the next complete AMI frame, reading from the socket as needed"""
+        while not self._frames:
+            data = self.socket.recv(65536)
+            if not data:
+                self.logged_in = False
+                raise ConnectionError('AMI connection closed')
+            self._frames.extend(self.parser.feed(data))
+        return self._frames.popleft()
+
     def _read_response(self):
         """Read a single AMI response"""
-        response = {}
         try:
             while True:
-                line = self.socket.recv(1024).decode('utf-8', errors='ignore')
-                if not line:
-                    break
-
-                for l in line.split('\r\n'):
-                    if ':' in l:
-                        key, value = l.split(':', 1)
-                        response[key.strip()] = value.strip()
-                    elif l.strip() == '':
-                        return response
-
-                if '\r\n\r\n' in line:
-                    break
-
+                frame = self._next_frame()
+                if 'Response' in frame:
+                    return frame
         except socket.timeout:
             pass
         except Exception as e:
             print(f"Read error: {e}")
 
-        return response
+        return {}
 
     def _read_multi_response(self):
         """Read multiple AMI events until completion"""
         events = []
-        current_event = {}
-        buffer = ""
 
         try:
             self.socket.settimeout(3)
             while True:
-                data = self.socket.recv(4096).decode('utf-8', errors='ignore')
-                if not data:
-                    break
-
-                buffer += data
-
-                # Process complete lines
-                while '\r\n' in buffer:
-                    line, buffer = buffer.split('\r\n', 1)
-
-                    if ':' in line:
-                        key, value = line.split(':', 1)
-                        current_event[key.strip()] = value.strip()
-                    elif line.strip() == '':
-                        if current_event:
-                            events.append(current_event)
-
-                            # Check if we're done
-                            if current_event.get('Event') == 'CoreShowChannelsComplete':
-                                return events
+                frame = self._next_frame()
+                events.append(frame)
 
-                            current_event = {}
+                # Check if we're done
+                if frame.event == 'CoreShowChannelsComplete':
+                    return events
 
         except socket.timeout:
             pass
@@ -401,15 +464,7 @@ class AsteriskAMI:
 
 def extract_extension_from_channel(channel):
     """Extract extension number from PJSIP/SIP channel name"""
-    try:
-        # Pattern: PJSIP/1234-... or SIP/1234-...
-        import re
-        match = re.search(r'(?:PJSIP|SIP)/(\d+)', channel)
-        if match:
-            return match.group(1)
-    except:
-        pass
-    return None
+    return CHANNEL_CLASSIFIER.classify(channel).extension
 
 
 def calculate_extension_kpis(calls, channels):
@@ -456,7 +511,7 @@ def calculate_extension_kpis(calls, channels):
             }
 
     # Process all SIP/PJSIP channels to find extensions
-    sip_channels = [ch for ch in channels if 'SIP/' in ch['channel'] or 'PJSIP/' in ch['channel']]
+    sip_channels = [ch for ch in channels if CHANNEL_CLASSIFIER.is_sip(ch['channel'])]
 
     for ch in sip_channels:
         ext = extract_extension_from_channel(ch['channel'])
@@ -484,23 +539,17 @@ def calculate_extension_kpis(calls, channels):
                 # Update caller_id if we have a live channel
                 extension_stats[ext]['caller_id'] = caller_id_name
 
-    # Aggregate call statistics (live only)
+    # Aggregate call statistics (live only) for every extension on each call
     for call in calls:
-        # Extract extension from channel
-        ext = None
-        caller_id = None
-
-        if 'PJSIP/' in call.get('channel', '') or 'SIP/' in call.get('channel', ''):
-            ext = extract_extension_from_channel(call['channel'])
+        call_exts = []
+        for leg in (call.get('channel', ''), call.get('dstchannel', '')):
+            if leg:
+                leg_ext = extract_extension_from_channel(leg)
+                if leg_ext and leg_ext not in call_exts:
+                    call_exts.append(leg_ext)
+
+        for ext in call_exts:
             caller_id = call.get('callerid', ext).split('<')[0].strip()
-
-        # Also check destination channel
-        if not ext and call.get('dstchannel'):
-            if 'PJSIP/' in call['dstchannel'] or 'SIP/' in call['dstchannel']:
-                ext = extract_extension_from_channel(call['dstchannel'])
-                caller_id = call.get('callerid', ext).split('<')[0].strip()
-
-        if ext and ext.isdigit():
             # Track this extension as recently seen
             if caller_id:
                 RECENTLY_SEEN_EXTENSIONS[ext] = {
@@ -590,27 +639,20 @@ def calculate_extension_kpis(calls, channels):
 def process_channels(channels):
     """Process raw channel data into call information"""
     # Filter to SIP/PJSIP channels only
-    sip_channels = [ch for ch in channels if 'SIP/' in ch['channel'] or 'PJSIP/' in ch['channel']]
-
-    # Group channels by duration (same call has same/similar duration)
-    call_groups = {}
-    for ch in sip_channels:
-        duration_bucket = (ch['duration'] // 3) * 3  # Group by 3-second intervals
-        if duration_bucket not in call_groups:
-            call_groups[duration_bucket] = []
-        call_groups[duration_bucket].append(ch)
+    CHANNEL_CLASSIFIER.prune([ch['channel'] for ch in channels])
+    sip_channels = [ch for ch in channels if CHANNEL_CLASSIFIER.is_sip(ch['channel'])]
 
     calls = []
     active_count = 0
 
-    # Process each group
-    for duration, group_channels in call_groups.items():
+    # Process each call (legs grouped by Linkedid / bridge)
+    for call_id, group_channels in group_call_legs(sip_channels):
         # Separate gateway and extension channels
         gateway_legs = []
         extension_legs = []
 
         for ch in group_channels:
-            is_gateway = any(gw in ch['channel'].lower() for gw in GATEWAYS)
+            is_gateway = CHANNEL_CLASSIFIER.classify(ch['channel']).kind == 'gateway'
             if is_gateway:
                 gateway_legs.append(ch)
             else:
@@ -620,7 +662,7 @@ def process_channels(channels):
         if gateway_legs and extension_legs:
             # Bridged call between gateway and extension
             gateway_ch = gateway_legs[0]
-            extension_ch = extension_legs[0]
+            extension_ch = next((ch for ch in extension_legs if ch['state'] == 'Up'), extension_legs[0])
 
             # Check context to determine direction
             ext_context = extension_ch['context'].lower()
@@ -630,6 +672,7 @@ def process_channels(channels):
                 # OUTBOUND: Show extension channel with destination from gateway
                 direction = 'outbound'
                 call_info = {
+                    'call_id': call_id,
                     'channel': extension_ch['channel'],
                     'dstchannel': gateway_ch['channel'],  # Add destination channel
                     'callerid': f"{extension_ch['calleridname']} <{extension_ch['callerid']}>",
@@ -645,6 +688,7 @@ def process_channels(channels):
                 # INBOUND: Show gateway channel
                 direction = 'inbound'
                 call_info = {
+                    'call_id': call_id,
                     'channel': gateway_ch['channel'],
                     'dstchannel': extension_ch['channel'],  # Add destination channel
                     'callerid': f"{gateway_ch['calleridname']} <{gateway_ch['callerid']}>",
@@ -663,39 +707,43 @@ def process_channels(channels):
 
         elif gateway_legs:
             # Gateway only - INBOUND
-            for ch in gateway_legs:
-                call_info = {
-                    'channel': ch['channel'],
-                    'callerid': f"{ch['calleridname']} <{ch['callerid']}>",
-                    'extension': ch['extension'],
-                    'destination': ch['extension'],
-                    'context': ch['context'],
-                    'status': ch['state'],
-                    'duration': ch['duration'],
-                    'direction': 'inbound',
-                }
-                if ch['state'] == 'Up':
-                    active_count += 1
-                calls.append(call_info)
-                print(f"DEBUG: INBOUND call - {ch['channel']}")
+            ch = originating_leg(gateway_legs)
+            call_info = {
+                'call_id': call_id,
+                'channel': ch['channel'],
+                'callerid': f"{ch['calleridname']} <{ch['callerid']}>",
+                'extension': ch['extension'],
+                'destination': ch['extension'],
+                'context': ch['context'],
+                'status': ch['state'],
+                'duration': ch['duration'],
+                'direction': 'inbound',
+            }
+            if ch['state'] == 'Up':
+                active_count += 1
+            calls.append(call_info)
+            print(f"DEBUG: INBOUND call - {ch['channel']}")
 
         elif extension_legs:
             # Extension only - INTERNAL
-            for ch in extension_legs:
-                call_info = {
-                    'channel': ch['channel'],
-                    'callerid': f"{ch['calleridname']} <{ch['callerid']}>",
-                    'extension': ch['extension'],
-                    'destination': ch['extension'],
-                    'context': ch['context'],
-                    'status': ch['state'],
-                    'duration': ch['duration'],
-                    'direction': 'internal',
-                }
-                if ch['state'] == 'Up':
-                    active_count += 1
-                calls.append(call_info)
-                print(f"DEBUG: INTERNAL call - {ch['channel']}")
+            ch = originating_leg(extension_legs)
+            other = next((leg for leg in extension_legs if leg is not ch), None)
+            call_info = {
+                'call_id': call_id,
+                'channel': ch['channel'],
+                'dstchannel': other['channel'] if other else '',
+                'callerid': f"{ch['calleridname']} <{ch['callerid']}>",
+                'extension': ch['extension'],
+                'destination': ch['extension'],
+                'context': ch['context'],
+                'status': ch['state'],
+                'duration': ch['duration'],
+                'direction': 'internal',
+            }
+            if ch['state'] == 'Up':
+                active_count += 1
+            calls.append(call_info)
+            print(f"DEBUG: INTERNAL call - {ch['channel']}")
 
     # Calculate extension KPIs
     extension_kpis = calculate_extension_kpis(calls, channels)
@@ -771,12 +819,17 @@ def main():
 
             # Detect call hangup (channel count decreased)
             if LAST_CHANNEL_COUNT > 0 and current_channel_count < LAST_CHANNEL_COUNT:
-                print(f"Call hangup detected (channels: {LAST_CHANNEL_COUNT} → {current_channel_count}), reloading DB stats...")
-                load_extension_stats_from_db()
-                LAST_DB_RELOAD = current_time
+                print(f"Call hangup detected (channels: {LAST_CHANNEL_COUNT} → {current_channel_count}), requesting DB reload")
+                DB_REFRESH.trigger(current_time, after_hangup=True)
             # Periodic reload (every 30 seconds)
-            elif current_time - LAST_DB_RELOAD >= DB_RELOAD_INTERVAL:
-                print("Periodic reload of extension statistics from database...")
+            elif current_time - LAST_DB_RELOAD >= DB_RELOAD_INTERVAL and not DB_REFRESH.pending:
+                DB_REFRESH.trigger(current_time)
+
+            landed = DB_REFRESH.awaiting_cdr and DB_REFRESH.holdoff(current_time) == 0 and cdr_landed()
+            if DB_REFRESH.ready(current_time, landed):
+                DB_REFRESH.started(current_time)
+                print(f"Reloading extension statistics from database ({DB_REFRESH.describe()})...")
+                mark_cdr_baseline(channels, current_time)
                 load_extension_stats_from_db()
                 LAST_DB_RELOAD = current_time
 
@@ -784,6 +837,7 @@ def main():
 
             # Process and write data
             data = process_channels(channels)
+            data['db_refresh'] = DB_REFRESH.metrics()
             write_data_file(data)
 
             print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] Active: {data['active_calls']}, Total Channels: {data['total_channels']}, Extensions: {len(data.get('extension_kpis', []))}")
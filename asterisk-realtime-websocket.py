@@ -5,13 +5,19 @@ Real-time call monitoring with WebSocket push updates
 """
 
 import asyncio
+import gzip
+import hashlib
 import json
 import re
 import sys
 import time
 import signal
+from collections import deque, namedtuple
+from itertools import count, islice
 from datetime import datetime, date
-from typing import Set, Dict, Any
+from http import HTTPStatus
+from typing import Dict, Any
+from urllib.parse import parse_qs, urlsplit
 
 try:
     import websockets
@@ -36,9 +42,23 @@ except ImportError:
     print("Install with: pip3 install aiomysql")
     AIOMYSQL_AVAILABLE = False
 
+try:
+    import brotli
+    BROTLI_AVAILABLE = True
+except ImportError:
+    BROTLI_AVAILABLE = False
+
 import os
 import subprocess
 
+from ami_frames import AMIFrameParser
+from call_assembly import group_call_legs, originating_leg
+from channel_classifier import ChannelClassifier, SIP_TECHNOLOGIES
+from snapshot_delta import CODECS, DEFAULT_VARIANT, diff_snapshots, encode_delta, negotiate_variant
+from snapshot_feed import FeedServer, read_frame
+from cdr_stats import (CDRAccumulator, CDRWatermark, RefreshCoordinator, aggregate_query,
+                       landed_query, rolled_up_until, rollup_hours_query, rollup_query, rows_query)
+
 # Load configuration
 CONFIG_FILE = '/var/www/html/supervisor2/config.json'
 try:
@@ -59,6 +79,29 @@ WS_PORT = CONFIG.get('realtime', {}).get('websocketPort', 8765)
 DB_CONFIG_FILE = CONFIG.get('realtime', {}).get('dbConfigFile', '/etc/amportal.conf')
 QUEUE_LOG_PATH = CONFIG.get('asterisk', {}).get('queueLogPath', '/var/log/asterisk/queue_log')
 FULL_LOG_PATH  = CONFIG.get('asterisk', {}).get('fullLogPath', '/var/log/asterisk/full')
+CHANNEL_RECONCILE_INTERVAL = CONFIG.get('realtime', {}).get('channelReconcileInterval', 60)
+QUEUE_REFRESH = CONFIG.get('realtime', {}).get('queueRefresh', 'all')          # 'all' | 'changed'
+QUEUE_FULL_REFRESH_INTERVAL = CONFIG.get('realtime', {}).get('queueFullRefreshInterval', 60)
+QUEUE_RECONCILE_INTERVAL = CONFIG.get('realtime', {}).get('queueReconcileInterval', 60)
+EXTENSION_RECONCILE_INTERVAL = CONFIG.get('realtime', {}).get('extensionReconcileInterval', 300)
+BROADCAST_INTERVAL = CONFIG.get('realtime', {}).get('broadcastInterval', 2)   # heartbeat push
+PUSH_COALESCE_MS = CONFIG.get('realtime', {}).get('pushCoalesceMs', 150)
+COLLECTOR_CONFIG = CONFIG.get('realtime', {}).get('collectors', {})
+DELTA_HISTORY = CONFIG.get('realtime', {}).get('deltaHistory', 300)          # deltas kept for resuming clients
+CLIENT_SEND_TIMEOUT = CONFIG.get('realtime', {}).get('clientSendTimeout', 10)
+CLIENT_MAX_SKIPPED = CONFIG.get('realtime', {}).get('clientMaxSkipped', 15)   # coalesced updates before disconnect
+CLIENT_MAX_BACKLOG = CONFIG.get('realtime', {}).get('clientMaxBacklog', 10)   # deltas behind before a snapshot instead
+CDR_FULL_RELOAD_INTERVAL = CONFIG.get('realtime', {}).get('cdrFullReloadInterval', 900)
+CDR_SETTLE_TIME = CONFIG.get('realtime', {}).get('cdrSettleTime', 120)        # hangup to CDR row written
+DB_REFRESH_MIN_INTERVAL = CONFIG.get('realtime', {}).get('dbRefreshMinInterval', 5)
+CDR_LANDING_TIMEOUT = CONFIG.get('realtime', {}).get('cdrLandingTimeout', 5)  # wait for a hangup's CDR row
+CDR_LANDING_POLL = 0.5
+SUBSCRIPTION_IDLE_TTL = CONFIG.get('realtime', {}).get('subscriptionIdleTtl', 300)
+SUBSCRIPTION_MAX_GROUPS = CONFIG.get('realtime', {}).get('subscriptionMaxGroups', 50)     # HTTP polls beyond: not kept
+SUBSCRIPTION_MAX_INTERVAL = CONFIG.get('realtime', {}).get('subscriptionMaxInterval', 60)
+WS_COMPRESSION = CONFIG.get('realtime', {}).get('compression', 'deflate')     # 'deflate' | 'none'
+WS_WORKERS = CONFIG.get('realtime', {}).get('workers', 0)                     # 0: serve clients in-process
+COLLECTOR_SOCKET = CONFIG.get('realtime', {}).get('collectorSocket', '/tmp/asterisk-realtime-collector.sock')
 
 # Gateway configuration
 GATEWAYS = []
@@ -71,12 +114,17 @@ for gw in CONFIG.get('asterisk', {}).get('gateways', ['PJSIP/we']):
         GATEWAYS.append(gw)
 
 print(f"✓ Gateways: {GATEWAYS}")
+CHANNEL_CLASSIFIER = ChannelClassifier(GATEWAYS)
 
 # Global state
-connected_clients: Set[WebSocketServerProtocol] = set()
+connected_clients: Dict[WebSocketServerProtocol, 'ClientSession'] = {}
+snapshot_feed = None                              # FeedServer when serving through workers
 extension_stats_db: Dict[str, Dict[str, Any]] = {}
 last_db_reload = 0
 DB_RELOAD_INTERVAL = 30
+db_stats_loaded_at = 0.0                          # last successful DBStatsLoader.load()
+presence_polled_at = 0.0                          # last successful AstDB presence poll
+listener_lost_at = 0.0                            # when the event listener last went down
 presence_states: Dict[str, Dict[str, str]] = {}   # updated by event listener
 presence_prev:   Dict[str, Dict[str, str]] = {}   # snapshot for transition detection
 break_history:   Dict[str, list]           = {}
@@ -84,8 +132,64 @@ db_pool = None                                    # aiomysql async pool
 _last_agent_event: Dict[str, float] = {}          # dedup: "ext:type" -> timestamp
 
 
+class AMIActionPlan:
+    """Which optional AMI actions this PBX can answer.
+
+    Probed once per connection at login with ListCommands (actions the
+    manager user may call) and ModuleCheck (modules actually loaded), so the
+    poll cycle never sends SIPpeers to a PJSIP-only box (or vice versa) and
+    burns a read timeout waiting for a completion event that never comes.
+    If discovery itself fails every action is assumed to be available.
+    """
+
+    # action -> module that must be loaded for it to answer
+    OPTIONAL_ACTIONS = {
+        'SIPpeers':           'chan_sip',
+        'PJSIPShowEndpoints': 'chan_pjsip',
+        'QueueStatus':        'app_queue',
+        'QueueSummary':       'app_queue',
+        'Command':            None,
+    }
+
+    def __init__(self, actions=None, modules=None):
+        self.actions = actions       # lower-cased action names, None = unknown
+        self.modules = modules       # module -> loaded?, None = unknown
+
+    def supports(self, action: str) -> bool:
+        if self.actions is not None and action.lower() not in self.actions:
+            return False
+        module = self.OPTIONAL_ACTIONS.get(action)
+        if module and self.modules is not None:
+            return self.modules.get(module, True)
+        return True
+
+    def describe(self) -> str:
+        if self.actions is None:
+            return 'unknown (discovery failed, sending every action)'
+        return ', '.join(f"{a}={'yes' if self.supports(a) else 'no'}"
+                         for a in self.OPTIONAL_ACTIONS)
+
+
+class AMIPendingAction:
+    """Book-keeping for one in-flight AMI action awaiting its response"""
+
+    __slots__ = ('future', 'complete_event', 'events')
+
+    def __init__(self, future, complete_event):
+        self.future = future
+        self.complete_event = complete_event
+        self.events = []
+
+
 class AsteriskAMI:
-    """Asterisk Manager Interface client"""
+    """Asterisk Manager Interface client.
+
+    Every action is tagged with a unique ActionID and written immediately, so
+    any number of actions can be in flight on the one connection.  A single
+    reader task routes each response frame to the future of the action that
+    asked for it; frames without a known ActionID are dropped, so a stray
+    event can never end up in another action's result.
+    """
 
     def __init__(self, host, port, username, secret):
         self.host = host
@@ -95,14 +199,20 @@ class AsteriskAMI:
         self.reader = None
         self.writer = None
         self.connected = False
+        self._pending: Dict[str, AMIPendingAction] = {}
+        self._action_seq = 0
+        self._reader_task = None
+        self._drain_lock = asyncio.Lock()
+        self.plan = AMIActionPlan()
 
     async def connect(self):
         """Connect to AMI"""
         try:
             self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
-            # Read welcome message
-            await self.reader.read(1024)
+            # Read welcome banner ("Asterisk Call Manager/x.y.z")
+            await asyncio.wait_for(self.reader.readline(), timeout=5)
             self.connected = True
+            self._reader_task = asyncio.ensure_future(self._read_loop())
             print(f"✓ Connected to AMI at {self.host}:{self.port}")
             return True
         except Exception as e:
@@ -110,15 +220,17 @@ class AsteriskAMI:
             return False
 
     async def login(self):
-        """Login to AMI"""
+        """Login to AMI (events off: this connection only carries action responses)"""
         try:
-            command = f"Action: Login\r\nUsername: {self.username}\r\nSecret: {self.secret}\r\n\r\n"
-            self.writer.write(command.encode())
-            await self.writer.drain()
-
-            response = await self.reader.read(1024)
-            if b'Success' in response:
+            response = await self.send_action('Login', {
+                'Username': self.username,
+                'Secret': self.secret,
+                'Events': 'off',
+            }, timeout=5)
+            if response and response[0].get('Response') == 'Success':
                 print("✓ AMI login successful")
+                self.plan = await self.discover_capabilities()
+                print(f"✓ AMI action plan: {self.plan.describe()}")
                 return True
             print("✗ AMI login failed")
             return False
@@ -126,191 +238,135 @@ class AsteriskAMI:
             print(f"✗ AMI login error: {e}")
             return False
 
-    async def get_channels(self):
-        """Get active channels from AMI"""
+    async def discover_capabilities(self) -> AMIActionPlan:
+        """Probe supported actions and loaded modules for this connection"""
         try:
-            command = "Action: CoreShowChannels\r\n\r\n"
-            self.writer.write(command.encode())
-            await self.writer.drain()
+            modules = sorted({m for m in AMIActionPlan.OPTIONAL_ACTIONS.values() if m})
+            results = await asyncio.gather(
+                self.send_action('ListCommands'),
+                *(self.send_action('ModuleCheck', {'Module': m}) for m in modules)
+            )
+            listing = results[0][0] if results[0] else {}
+            if listing.get('Response') != 'Success':
+                return AMIActionPlan()
+            actions = {key.lower() for key in listing if key not in ('Response', 'ActionID')}
+            loaded = {m: bool(r) and r[0].get('Response') == 'Success'
+                      for m, r in zip(modules, results[1:])}
+            return AMIActionPlan(actions, loaded)
+        except Exception as e:
+            print(f"⚠ AMI capability discovery failed: {e}")
+            return AMIActionPlan()
 
-            channels = []
-            buffer = b""
-            timeout = time.time() + 3
+    async def send_action(self, action, fields=None, complete_event=None, timeout=3.0):
+        """Send an action and wait for its response.
 
-            while time.time() < timeout:
-                try:
-                    chunk = await asyncio.wait_for(self.reader.read(4096), timeout=1.0)
-                    if not chunk:
-                        break
-                    buffer += chunk
-
-                    # Check if we received the complete message
-                    if b'CoreShowChannelsComplete' in buffer:
-                        break
-                except asyncio.TimeoutError:
-                    break
+        For list actions pass ``complete_event`` (e.g. 'CoreShowChannelsComplete'):
+        the result is the list of events carrying this action's ActionID, in
+        arrival order.  Otherwise the result is ``[response_frame]``.  On
+        timeout whatever has arrived so far is returned.
+        """
+        if not self.connected:
+            raise ConnectionError('AMI not connected')
+
+        self._action_seq += 1
+        action_id = f"rt-{id(self):x}-{self._action_seq}"
+        pending = AMIPendingAction(asyncio.get_event_loop().create_future(), complete_event)
+        self._pending[action_id] = pending
+
+        lines = [f"Action: {action}", f"ActionID: {action_id}"]
+        for key, value in (fields or {}).items():
+            lines.append(f"{key}: {value}")
+        self.writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode())
+        try:
+            async with self._drain_lock:
+                await self.writer.drain()
+            return await asyncio.wait_for(asyncio.shield(pending.future), timeout=timeout)
+        except asyncio.TimeoutError:
+            print(f"⚠ AMI {action} timed out after {timeout}s ({len(pending.events)} events received)")
+            return pending.events
+        finally:
+            self._pending.pop(action_id, None)
 
-            # Parse events
-            events = buffer.decode('utf-8', errors='ignore').split('\r\n\r\n')
-            for event_text in events:
-                event = {}
-                for line in event_text.split('\r\n'):
-                    if ': ' in line:
-                        key, value = line.split(': ', 1)
-                        event[key.strip()] = value.strip()
-
-                if event.get('Event') == 'CoreShowChannel':
-                    channels.append({
-                        'channel': event.get('Channel', ''),
-                        'callerid': event.get('CallerIDNum', ''),
-                        'calleridname': event.get('CallerIDName', ''),
-                        'extension': event.get('Exten', ''),
-                        'context': event.get('Context', ''),
-                        'state': event.get('ChannelStateDesc', ''),
-                        'duration': parse_duration(event.get('Duration', '0')),
-                    })
-
-            return channels
+    async def _read_loop(self):
+        """Read frames off the socket and route them to pending actions"""
+        parser = AMIFrameParser()
+        try:
+            while True:
+                chunk = await self.reader.read(65536)
+                if not chunk:
+                    raise ConnectionError('connection closed by peer')
+                for frame in parser.feed(chunk):
+                    pending = self._pending.get(frame.get('ActionID', ''))
+                    if pending is None or pending.future.done():
+                        continue
+                    self._dispatch(pending, frame)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if self.connected:
+                print(f"✗ AMI connection lost: {e}")
+        finally:
+            self.connected = False
+            for pending in self._pending.values():
+                if not pending.future.done():
+                    pending.future.set_exception(ConnectionError('AMI connection lost'))
+
+    @staticmethod
+    def _dispatch(pending, frame):
+        """Apply one frame to a pending action, resolving it when complete"""
+        if pending.complete_event is None:
+            pending.future.set_result([frame])
+        elif 'Response' in frame:
+            # List actions answer "Success" + "EventList: start", then stream events.
+            if frame['Response'] == 'Error':
+                pending.future.set_result(pending.events)
+        elif frame.get('Event') == pending.complete_event or frame.get('EventList') == 'Complete':
+            pending.future.set_result(pending.events)
+        else:
+            pending.events.append(frame)
+
+    async def get_channels(self):
+        """Dump active channels with CoreShowChannels (None on failure)"""
+        try:
+            events = await self.send_action('CoreShowChannels',
+                                            complete_event='CoreShowChannelsComplete')
+            return [channel_from_event(event) for event in events
+                    if event.get('Event') == 'CoreShowChannel']
         except Exception as e:
             print(f"✗ Error getting channels: {e}")
-            return []
+            return None
 
     async def get_extension_states(self):
-        """Get SIP/PJSIP peer registration status"""
+        """Get SIP/PJSIP peer registration status (None if the dump failed)"""
         try:
-            command = "Action: SIPpeers\r\n\r\n"
-            self.writer.write(command.encode())
-            await self.writer.drain()
+            sip_events, pjsip_events = await asyncio.gather(
+                self.send_action('SIPpeers', complete_event='PeerlistComplete')
+                if self.plan.supports('SIPpeers') else asyncio.sleep(0, []),
+                self.send_action('PJSIPShowEndpoints', complete_event='EndpointListComplete')
+                if self.plan.supports('PJSIPShowEndpoints') else asyncio.sleep(0, []),
+            )
 
             peer_states = {}
-            buffer = b""
-            timeout = time.time() + 3
-
-            while time.time() < timeout:
-                try:
-                    chunk = await asyncio.wait_for(self.reader.read(4096), timeout=1.0)
-                    if not chunk:
-                        break
-                    buffer += chunk
-                    if b'PeerlistComplete' in buffer:
-                        break
-                except asyncio.TimeoutError:
-                    break
-
-            # Parse peer events
-            events = buffer.decode('utf-8', errors='ignore').split('\r\n\r\n')
-            for event_text in events:
-                event = {}
-                for line in event_text.split('\r\n'):
-                    if ': ' in line:
-                        key, value = line.split(': ', 1)
-                        event[key.strip()] = value.strip()
-
+            for event in sip_events:
                 if event.get('Event') == 'PeerEntry':
                     peer = event.get('ObjectName', '')
                     status = event.get('Status', '')
                     # Extract extension number
                     if peer.isdigit():
-                        peer_states[peer] = 'online' if 'OK' in status or 'Registered' in status else 'offline'
-
-            # Try PJSIP endpoints
-            command = "Action: PJSIPShowEndpoints\r\n\r\n"
-            self.writer.write(command.encode())
-            await self.writer.drain()
-
-            buffer = b""
-            timeout = time.time() + 3
-
-            while time.time() < timeout:
-                try:
-                    chunk = await asyncio.wait_for(self.reader.read(4096), timeout=1.0)
-                    if not chunk:
-                        break
-                    buffer += chunk
-                    if b'EndpointListComplete' in buffer:
-                        break
-                except asyncio.TimeoutError:
-                    break
-
-            events = buffer.decode('utf-8', errors='ignore').split('\r\n\r\n')
-            for event_text in events:
-                event = {}
-                for line in event_text.split('\r\n'):
-                    if ': ' in line:
-                        key, value = line.split(': ', 1)
-                        event[key.strip()] = value.strip()
+                        # chan_sip only knows reachability, not whether the peer is in use
+                        peer_states[peer] = REACHABLE if 'OK' in status or 'Registered' in status else 'offline'
 
+            for event in pjsip_events:
                 if event.get('Event') == 'EndpointList':
                     endpoint = event.get('ObjectName', '')
-                    device_state = event.get('DeviceState', '')
-                    if endpoint.isdigit():
-                        if 'Not in use' in device_state or 'Idle' in device_state:
-                            peer_states[endpoint] = 'online'
-                        elif 'Unavailable' in device_state or 'Invalid' in device_state:
-                            peer_states[endpoint] = 'offline'
-                        elif 'InUse' in device_state or 'Busy' in device_state:
-                            peer_states[endpoint] = 'busy'
-                        elif 'Ringing' in device_state:
-                            peer_states[endpoint] = 'ringing'
+                    status = device_state_status(event.get('DeviceState', ''))
+                    if endpoint.isdigit() and status:
+                        peer_states[endpoint] = status
 
             return peer_states
         except Exception as e:
             print(f"✗ Error getting extension states: {e}")
-            return {}
-
-    async def get_queue_paused_members(self):
-        """Get queue members that are paused"""
-        try:
-            command = "Action: QueueStatus\r\n\r\n"
-            self.writer.write(command.encode())
-            await self.writer.drain()
-
-            paused_extensions = set()
-            buffer = b""
-            timeout = time.time() + 3
-
-            while time.time() < timeout:
-                try:
-                    chunk = await asyncio.wait_for(self.reader.read(4096), timeout=1.0)
-                    if not chunk:
-                        break
-                    buffer += chunk
-                    if b'QueueStatusComplete' in buffer:
-                        break
-                except asyncio.TimeoutError:
-                    break
-
-            # Parse queue member events
-            events = buffer.decode('utf-8', errors='ignore').split('\r\n\r\n')
-            for event_text in events:
-                event = {}
-                for line in event_text.split('\r\n'):
-                    if ': ' in line:
-                        key, value = line.split(': ', 1)
-                        event[key.strip()] = value.strip()
-
-                if event.get('Event') == 'QueueMember':
-                    paused = event.get('Paused', '0')
-                    member_name = event.get('MemberName', '')
-                    location = event.get('Location', '')
-
-                    # Extract extension from member name or location
-                    ext = None
-                    if member_name.isdigit():
-                        ext = member_name
-                    else:
-                        # Try to extract from location like "PJSIP/1234"
-                        match = re.search(r'(?:PJSIP|SIP)/(\d+)', location)
-                        if match:
-                            ext = match.group(1)
-
-                    if ext and paused == '1':
-                        paused_extensions.add(ext)
-
-            return paused_extensions
-        except Exception as e:
-            print(f"✗ Error getting queue paused members: {e}")
-            return set()
+            return None
 
     async def get_presence_states(self):
         """Get FOP2/CustomPresence states from AstDB.
@@ -319,26 +375,13 @@ class AsteriskAMI:
         Value format: state[:subtype[:note]]
         e.g.  available  |  away:break:  |  xa::At lunch
         """
+        if not self.plan.supports('Command'):
+            return {}
         try:
-            command = "Action: Command\r\nCommand: database show CustomPresence\r\n\r\n"
-            self.writer.write(command.encode())
-            await self.writer.drain()
-
-            buffer = b""
-            timeout = time.time() + 3
-            while time.time() < timeout:
-                try:
-                    chunk = await asyncio.wait_for(self.reader.read(4096), timeout=1.0)
-                    if not chunk:
-                        break
-                    buffer += chunk
-                    if b'--END COMMAND--' in buffer:
-                        break
-                except asyncio.TimeoutError:
-                    break
+            response = await self.send_action('Command', {'Command': 'database show CustomPresence'})
 
             presence = {}
-            text = buffer.decode('utf-8', errors='ignore')
+            text = response[0].get('Output', '') if response else ''
             # AstDB states in Asterisk presence format
             _ast_presence_states = {'available', 'away', 'xa', 'dnd', 'chat', 'not_inuse'}
             for line in text.split('\n'):
@@ -366,110 +409,190 @@ class AsteriskAMI:
             print(f"✗ Error getting presence states: {e}")
             return {}
 
-    async def get_queue_status(self):
-        """Get detailed queue status including waiting calls and members"""
+    async def get_queue_status(self, queue=None):
+        """Get detailed queue status (members, waiting calls, metrics) in one
+        QueueStatus pass; ``queue`` restricts the dump to a single queue"""
+        if not self.plan.supports('QueueStatus'):
+            return {}
         try:
-            command = "Action: QueueStatus\r\n\r\n"
-            self.writer.write(command.encode())
-            await self.writer.drain()
-
-            queues = {}
-            current_queue = None
-            buffer = b""
-            timeout = time.time() + 3
-
-            while time.time() < timeout:
-                try:
-                    chunk = await asyncio.wait_for(self.reader.read(4096), timeout=1.0)
-                    if not chunk:
-                        break
-                    buffer += chunk
-                    if b'QueueStatusComplete' in buffer:
-                        break
-                except asyncio.TimeoutError:
-                    break
-
-            # Parse events
-            events = buffer.decode('utf-8', errors='ignore').split('\r\n\r\n')
-            for event_text in events:
-                event = {}
-                for line in event_text.split('\r\n'):
-                    if ': ' in line:
-                        key, value = line.split(': ', 1)
-                        event[key.strip()] = value.strip()
-
-                event_type = event.get('Event', '')
-
-                if event_type == 'QueueParams':
-                    queue_name = event.get('Queue', '')
-                    if queue_name:
-                        current_queue = queue_name
-                        queues[queue_name] = {
-                            'name': queue_name,
-                            'max': int(event.get('Max', 0)),
-                            'calls_waiting': int(event.get('Calls', 0)),
-                            'hold_time': int(event.get('Holdtime', 0)),
-                            'talk_time': int(event.get('TalkTime', 0)),
-                            'service_level': int(event.get('ServiceLevel', 0)),
-                            'service_level_perf': float(event.get('ServicelevelPerf', 0)),
-                            'weight': int(event.get('Weight', 0)),
-                            'completed': int(event.get('Completed', 0)),
-                            'abandoned': int(event.get('Abandoned', 0)),
-                            'members': [],
-                            'entries': []
-                        }
-
-                elif event_type == 'QueueMember' and current_queue:
-                    member_name = event.get('MemberName', event.get('Name', ''))
-                    location = event.get('Location', '')
-
-                    # Extract extension
-                    ext = None
-                    if member_name.isdigit():
-                        ext = member_name
-                    else:
-                        match = re.search(r'(?:PJSIP|SIP)/(\d+)', location)
-                        if match:
-                            ext = match.group(1)
-
-                    queues[current_queue]['members'].append({
-                        'name': member_name,
-                        'extension': ext or member_name,
-                        'location': location,
-                        'status': event.get('Status', ''),
-                        'paused': event.get('Paused', '0') == '1',
-                        'calls_taken': int(event.get('CallsTaken', 0)),
-                        'last_call': int(event.get('LastCall', 0)),
-                        'in_call': event.get('InCall', '0') == '1',
-                    })
-
-                elif event_type == 'QueueEntry' and current_queue:
-                    queues[current_queue]['entries'].append({
-                        'position': int(event.get('Position', 0)),
-                        'channel': event.get('Channel', ''),
-                        'callerid': event.get('CallerIDNum', ''),
-                        'calleridname': event.get('CallerIDName', ''),
-                        'wait_time': int(event.get('Wait', 0)),
-                    })
-
-            return queues
+            events = await self.send_action('QueueStatus', {'Queue': queue} if queue else None,
+                                            complete_event='QueueStatusComplete')
+            return parse_queue_status(events)
         except Exception as e:
             print(f"✗ Error getting queue status: {e}")
-            return {}
+            return None
+
+    async def get_queue_summary(self):
+        """Get one QueueSummary row per queue (cheap change detector)"""
+        try:
+            events = await self.send_action('QueueSummary', complete_event='QueueSummaryComplete')
+            return {
+                e.get('Queue', ''): (e.get('LoggedIn'), e.get('Available'), e.get('Callers'),
+                                     e.get('HoldTime'), e.get('TalkTime'), e.get('LongestHoldTime'))
+                for e in events if e.get('Event') == 'QueueSummary'
+            }
+        except Exception as e:
+            print(f"✗ Error getting queue summary: {e}")
+            return None
 
     async def close(self):
         """Close AMI connection"""
         if self.writer:
             try:
-                self.writer.write(b"Action: Logoff\r\n\r\n")
-                await self.writer.drain()
+                if self.connected:
+                    self.writer.write(b"Action: Logoff\r\n\r\n")
+                    await self.writer.drain()
                 self.writer.close()
-                await self.writer.wait_closed()
             except:
                 pass
+        if self._reader_task:
+            self._reader_task.cancel()
         self.connected = False
 
 
+# ── Live Channel Table ──────────────────────────────────────────────
+
+CHANNEL_EVENTS = {'Newchannel', 'Newstate', 'NewCallerid', 'Rename',
+                  'BridgeEnter', 'BridgeLeave', 'Hangup'}
+
+
+def channel_from_event(event: Dict[str, str]) -> Dict[str, Any]:
+    """Build a channel record from a CoreShowChannel / Newchannel-style event"""
+    return {
+        'channel': event.get('Channel', ''),
+        'callerid': event.get('CallerIDNum', ''),
+        'calleridname': event.get('CallerIDName', ''),
+        'extension': event.get('Exten', ''),
+        'context': event.get('Context', ''),
+        'state': event.get('ChannelStateDesc', ''),
+        'duration': parse_duration(event.get('Duration', '0')),
+        'uniqueid': event.get('Uniqueid', ''),
+        'linkedid': event.get('Linkedid', ''),
+        'bridgeid': event.get('BridgeId', ''),
+    }
+
+
+class ChannelTable:
+    """In-memory table of live channels keyed by Uniqueid.
+
+    Kept current from Newchannel/Newstate/NewCallerid/Rename/BridgeEnter/
+    BridgeLeave/Hangup events on the event listener connection, and
+    reconciled against a CoreShowChannels dump only every
+    CHANNEL_RECONCILE_INTERVAL seconds (or every cycle while the listener is
+    down), so per-cycle work follows the number of channel changes rather
+    than a full dump of every channel.
+    """
+
+    def __init__(self):
+        self.channels: Dict[str, Dict[str, Any]] = {}
+        self.live = False            # event listener connected and subscribed
+        self.last_reconcile = 0.0
+        self.version = 0             # bumped on every applied change
+        self._started: Dict[str, float] = {}
+        self._touched: Dict[str, float] = {}
+        self._hungup: Dict[str, float] = {}
+        self._list = []
+        self._list_version = -1
+
+    def attach(self):
+        """Event listener (re)subscribed — force a reconcile to get a baseline"""
+        self.live = True
+        self.last_reconcile = 0.0
+
+    def detach(self):
+        """Event listener lost — fall back to polling until it is back"""
+        self.live = False
+
+    def needs_reconcile(self, now: float) -> bool:
+        return not self.live or now - self.last_reconcile >= CHANNEL_RECONCILE_INTERVAL
+
+    def apply_event(self, evt: str, fields: Dict[str, str]) -> None:
+        """Apply one channel event from the AMI event stream"""
+        uid = fields.get('Uniqueid', '')
+        if not uid:
+            return
+        now = time.time()
+
+        if evt == 'Hangup':
+            if self.channels.pop(uid, None) is not None:
+                self.version += 1
+            self._started.pop(uid, None)
+            self._touched.pop(uid, None)
+            self._hungup[uid] = now
+            return
+
+        ch = self.channels.get(uid)
+        if ch is None:
+            if uid in self._hungup:
+                return       # late event for a channel already gone
+            ch = channel_from_event(fields)
+            self.channels[uid] = ch
+            self._started[uid] = now
+        elif evt == 'Rename':
+            ch['channel'] = fields.get('Newname', ch['channel'])
+        else:
+            for key, field in (('channel', 'Channel'), ('callerid', 'CallerIDNum'),
+                               ('calleridname', 'CallerIDName'), ('extension', 'Exten'),
+                               ('context', 'Context'), ('state', 'ChannelStateDesc'),
+                               ('linkedid', 'Linkedid')):
+                if field in fields:
+                    ch[key] = fields[field]
+
+        if evt == 'BridgeEnter':
+            ch['bridgeid'] = fields.get('BridgeUniqueid', '')
+        elif evt == 'BridgeLeave':
+            ch['bridgeid'] = ''
+        self._touched[uid] = now
+        self.version += 1
+
+    def reconcile(self, dump: list, requested_at: float) -> None:
+        """Replace the table with a CoreShowChannels dump taken at ``requested_at``.
+
+        Channels created or hung up by events after the dump was requested are
+        newer than the dump and win over it.
+        """
+        now = time.time()
+        fresh = {}
+        for ch in dump:
+            uid = ch.get('uniqueid') or ch['channel']
+            if self._hungup.get(uid, 0) >= requested_at:
+                continue
+            current = self.channels.get(uid)
+            if current is not None and self._touched.get(uid, 0) >= requested_at:
+                fresh[uid] = current
+                continue
+            fresh[uid] = ch
+            self._started[uid] = now - ch['duration']
+        for uid, ch in self.channels.items():
+            if uid not in fresh and self._touched.get(uid, 0) >= requested_at:
+                fresh[uid] = ch
+
+        self.channels = fresh
+        self._started = {uid: self._started.get(uid, now) for uid in fresh}
+        self._touched = {uid: ts for uid, ts in self._touched.items() if uid in fresh}
+        self._hungup = {uid: ts for uid, ts in self._hungup.items() if now - ts < 60}
+        self.last_reconcile = now
+        self.version += 1
+
+    def start_times(self) -> Dict[str, float]:
+        """Start time of every live channel, by Uniqueid"""
+        return dict(self._started)
+
+    def snapshot(self) -> list:
+        """Current channels as a list of channel dicts with live durations"""
+        if self._list_version != self.version:
+            self._list = list(self.channels.values())
+            self._list_version = self.version
+        now = time.time()
+        started = self._started
+        for ch in self._list:
+            ch['duration'] = int(now - started.get(ch['uniqueid'] or ch['channel'], now))
+        return self._list
+
+
+channel_table = ChannelTable()
+
+
 def parse_duration(duration_str):
     """Convert HH:MM:SS or seconds to integer seconds"""
     try:
@@ -486,160 +609,673 @@ def parse_duration(duration_str):
         return 0
 
 
-def extract_extension(channel):
-    """Extract extension number from channel name"""
-    match = re.search(r'(?:PJSIP|SIP)/(\d+)', channel)
+# ── Queue State ─────────────────────────────────────────────────────
+
+def member_extension(member_name: str, location: str):
+    """Extension of a queue member from its name or interface (e.g. "PJSIP/1234")"""
+    if member_name.isdigit():
+        return member_name
+    match = re.search(r'(?:PJSIP|SIP)/(\d+)', location)
     return match.group(1) if match else None
 
 
+def parse_queue_status(events) -> Dict[str, Dict[str, Any]]:
+    """Build queues (params, members, entries and member counters) from the
+    events of one QueueStatus response"""
+    now = time.time()
+    queues = {}
+    current_queue = None
+    for event in events:
+        event_type = event.get('Event', '')
+
+        if event_type == 'QueueParams':
+            queue_name = event.get('Queue', '')
+            if queue_name:
+                current_queue = queues[queue_name] = {
+                    'name': queue_name,
+                    'max': int(event.get('Max', 0)),
+                    'calls_waiting': int(event.get('Calls', 0)),
+                    'hold_time': int(event.get('Holdtime', 0)),
+                    'talk_time': int(event.get('TalkTime', 0)),
+                    'service_level': int(event.get('ServiceLevel', 0)),
+                    'service_level_perf': float(event.get('ServicelevelPerf', 0)),
+                    'weight': int(event.get('Weight', 0)),
+                    'completed': int(event.get('Completed', 0)),
+                    'abandoned': int(event.get('Abandoned', 0)),
+                    'members': [],
+                    'entries': [],
+                    'total_members': 0,
+                    'available_members': 0,
+                    'paused_members': 0,
+                    'busy_members': 0,
+                }
+
+        elif event_type == 'QueueMember' and current_queue:
+            member_name = event.get('MemberName', event.get('Name', ''))
+            location = event.get('Location', '')
+            ext = member_extension(member_name, location)
+            paused = event.get('Paused', '0') == '1'
+            in_call = event.get('InCall', '0') == '1'
+
+            current_queue['members'].append({
+                'name': member_name,
+                'extension': ext or member_name,
+                'location': location,
+                'status': event.get('Status', ''),
+                'paused': paused,
+                'calls_taken': int(event.get('CallsTaken', 0)),
+                'last_call': int(event.get('LastCall', 0)),
+                'in_call': in_call,
+            })
+            current_queue['total_members'] += 1
+            current_queue['paused_members'] += paused
+            current_queue['busy_members'] += in_call
+            current_queue['available_members'] += not paused and not in_call
+
+        elif event_type == 'QueueEntry' and current_queue:
+            wait = int(event.get('Wait', 0))
+            current_queue['entries'].append({
+                'position': int(event.get('Position', 0)),
+                'channel': event.get('Channel', ''),
+                'callerid': event.get('CallerIDNum', ''),
+                'uniqueid': event.get('Uniqueid', ''),
+                'calleridname': event.get('CallerIDName', ''),
+                'wait_time': wait,
+                'joined_at': now - wait,
+            })
+
+    return queues
+
+
+class QueueStateCollector:
+    """Queue state for one cycle from a single QueueStatus pass.
+
+    The paused-extension set, per-queue members/entries and the
+    process_queue_data counters all come from the same parse.  With
+    ``realtime.queueRefresh`` set to "changed", a cheap QueueSummary decides
+    which queues changed and only those are re-dumped (with a full dump every
+    QUEUE_FULL_REFRESH_INTERVAL seconds as a safety net).
+    """
+
+    def __init__(self):
+        self.queues: Dict[str, Dict[str, Any]] = {}
+        self.paused_extensions = set()
+        self._summary = {}
+        self._last_full = 0.0
+
+    async def collect(self, ami) -> bool:
+        """Refresh queue state; False if the dump failed and nothing changed"""
+        now = time.time()
+        incremental = QUEUE_REFRESH == 'changed' and ami.plan.supports('QueueSummary')
+        if not incremental or now - self._last_full >= QUEUE_FULL_REFRESH_INTERVAL:
+            queues = await ami.get_queue_status()
+            if queues is None:
+                return False
+            self.queues = queues
+            self._last_full = now
+            if incremental:
+                self._summary = await ami.get_queue_summary() or {}
+        else:
+            summary = await ami.get_queue_summary()
+            if summary is None:
+                return False
+            changed = [q for q, row in summary.items() if self._summary.get(q) != row]
+            results = await asyncio.gather(*(ami.get_queue_status(q) for q in changed))
+            for queue_name, result in zip(changed, results):
+                if result is None:
+                    summary.pop(queue_name, None)     # retry next cycle
+                elif queue_name in result:
+                    self.queues[queue_name] = result[queue_name]
+            for queue_name in set(self.queues) - set(summary):
+                del self.queues[queue_name]
+            self._summary = summary
+
+        self.paused_extensions = {
+            m['extension'] for q in self.queues.values() for m in q['members']
+            if m['paused'] and m['extension'].isdigit()
+        }
+        return True
+
+
+queue_collector = QueueStateCollector()
+
+
+QUEUE_EVENTS = {'QueueMemberStatus', 'QueueMemberPause', 'QueueMemberPaused',
+                'QueueMemberAdded', 'QueueMemberRemoved',
+                'QueueCallerJoin', 'QueueCallerLeave', 'QueueCallerAbandon',
+                'AgentConnect', 'AgentComplete'}
+
+
+class QueueStateEngine:
+    """Queue state kept current from AMI queue events.
+
+    Member and caller events on the event listener connection update the
+    queues in place, together with their member counters and the
+    paused-extension set, so waiting-call counts change within milliseconds
+    and process_queue_data only reads ready-made numbers.  A QueueStatus dump
+    (via QueueStateCollector) reconciles the state every
+    QUEUE_RECONCILE_INTERVAL seconds, or every cycle while the listener is down.
+    """
+
+    def __init__(self):
+        self.queues: Dict[str, Dict[str, Any]] = {}
+        self.live = False
+        self.last_reconcile = 0.0
+        self.version = 0
+        self._members: Dict[str, Dict[str, Dict[str, Any]]] = {}   # queue -> interface -> member
+        self._entries: Dict[str, Dict[str, Dict[str, Any]]] = {}   # queue -> uniqueid -> entry
+        self._paused: Dict[str, int] = {}                          # extension -> paused memberships
+        self._touched: Dict[tuple, float] = {}                     # (queue, 'member'|'entry', key) -> last event
+
+    @property
+    def paused_extensions(self):
+        return {ext for ext, count in self._paused.items() if count > 0}
+
+    def attach(self):
+        self.live = True
+        self.last_reconcile = 0.0
+
+    def detach(self):
+        self.live = False
+
+    def needs_reconcile(self, now: float) -> bool:
+        return not self.live or now - self.last_reconcile >= QUEUE_RECONCILE_INTERVAL
+
+    def load(self, queues: Dict[str, Dict[str, Any]], requested_at: float) -> None:
+        """Adopt a QueueStatus dump (from QueueStateCollector) requested at
+        ``requested_at``.
+
+        Members and callers changed by events after the dump was requested
+        are newer than the dump and keep their event state: a caller that
+        left or a member removed meanwhile stays gone, one that joined stays.
+        The dump is copied, so the collector's dicts are never mutated.
+        """
+        fresh = {}
+        for name, dumped in queues.items():
+            queue = dict(dumped)
+            members = {m['location']: dict(m) for m in dumped['members']}
+            entries = {(e['uniqueid'] or e['channel']): dict(e) for e in dumped['entries']}
+            touched = False
+            for (queue_name, kind, key), ts in self._touched.items():
+                if queue_name != name or ts < requested_at:
+                    continue
+                touched = True
+                table, current = (members, self._members) if kind == 'member' else (entries, self._entries)
+                item = current.get(name, {}).get(key)
+                if item is None:
+                    table.pop(key, None)
+                else:
+                    table[key] = item
+            queue['members'] = list(members.values())
+            queue['entries'] = sorted(entries.values(), key=lambda e: e['position'])
+            if touched:
+                for position, entry in enumerate(queue['entries'], 1):
+                    entry['position'] = position
+                queue['calls_waiting'] = len(queue['entries'])
+                previous = self.queues.get(name, {})
+                for counter in ('completed', 'abandoned'):
+                    queue[counter] = max(queue[counter], previous.get(counter, 0))
+            fresh[name] = queue
+
+        self.queues = fresh
+        self._members = {}
+        self._entries = {}
+        self._paused = {}
+        for name, queue in fresh.items():
+            self._members[name] = {m['location']: m for m in queue['members']}
+            self._entries[name] = {(e['uniqueid'] or e['channel']): e for e in queue['entries']}
+            for counter in ('total_members', 'paused_members', 'busy_members', 'available_members'):
+                queue[counter] = 0
+            for member in queue['members']:
+                self._account(queue, member, +1)
+        self._touched = {key: ts for key, ts in self._touched.items() if ts >= requested_at}
+        self.last_reconcile = time.time()
+        self.version += 1
+
+    def _account(self, queue, member, sign):
+        """Add (+1) or remove (-1) a member's contribution to the counters"""
+        queue['total_members'] += sign
+        queue['paused_members'] += sign * member['paused']
+        queue['busy_members'] += sign * member['in_call']
+        queue['available_members'] += sign * (not member['paused'] and not member['in_call'])
+        ext = member['extension']
+        if member['paused'] and ext.isdigit():
+            self._paused[ext] = self._paused.get(ext, 0) + sign
+
+    def apply_event(self, evt: str, fields: Dict[str, str]) -> None:
+        """Apply one queue event from the AMI event stream"""
+        queue = self.queues.get(fields.get('Queue', ''))
+        if queue is None:
+            # Queue not seen yet (new or reloaded) — pick it up on the next reconcile
+            self.last_reconcile = 0.0
+            return
+        name = queue['name']
+        members = self._members[name]
+        entries = self._entries[name]
+        interface = fields.get('Interface') or fields.get('Location', '')
+
+        if evt in ('QueueCallerJoin', 'QueueCallerLeave', 'QueueCallerAbandon'):
+            key = fields.get('Uniqueid') or fields.get('Channel', '')
+            self._touched[(name, 'entry', key)] = time.time()
+            if evt == 'QueueCallerJoin':
+                entry = {
+                    'position': int(fields.get('Position', 0)),
+                    'channel': fields.get('Channel', ''),
+                    'uniqueid': fields.get('Uniqueid', ''),
+                    'callerid': fields.get('CallerIDNum', ''),
+                    'calleridname': fields.get('CallerIDName', ''),
+                    'wait_time': 0,
+                    'joined_at': time.time(),
+                }
+                entries[key] = entry
+                queue['entries'].append(entry)
+            elif evt == 'QueueCallerAbandon':
+                queue['abandoned'] += 1
+            else:
+                entry = entries.pop(key, None)
+                if entry is not None:
+                    queue['entries'].remove(entry)
+                    for other in queue['entries']:
+                        if other['position'] > entry['position']:
+                            other['position'] -= 1
+            if evt != 'QueueCallerAbandon':
+                queue['calls_waiting'] = int(fields.get('Count', len(queue['entries'])))
+
+        elif evt == 'QueueMemberRemoved':
+            self._touched[(name, 'member', interface)] = time.time()
+            member = members.pop(interface, None)
+            if member is not None:
+                self._account(queue, member, -1)
+                queue['members'].remove(member)
+
+        else:
+            member = members.get(interface)
+            if member is None:
+                if evt not in ('QueueMemberAdded', 'QueueMemberStatus'):
+                    return
+                member_name = fields.get('MemberName', '')
+                ext = member_extension(member_name, interface)
+                member = {
+                    'name': member_name,
+                    'extension': ext or member_name,
+                    'location': interface,
+                    'status': '',
+                    'paused': False,
+                    'calls_taken': 0,
+                    'last_call': 0,
+                    'in_call': False,
+                }
+                members[interface] = member
+                queue['members'].append(member)
+            else:
+                self._account(queue, member, -1)
+            self._touched[(name, 'member', interface)] = time.time()
+
+            if evt == 'AgentConnect':
+                member['in_call'] = True
+            elif evt == 'AgentComplete':
+                member['in_call'] = False
+                member['calls_taken'] += 1
+                member['last_call'] = int(time.time())
+                queue['completed'] += 1
+            else:
+                if 'Paused' in fields:
+                    member['paused'] = fields['Paused'] == '1'
+                if 'Status' in fields:
+                    member['status'] = fields['Status']
+                if 'InCall' in fields:
+                    member['in_call'] = fields['InCall'] == '1'
+                if 'CallsTaken' in fields:
+                    member['calls_taken'] = int(fields['CallsTaken'] or 0)
+                if 'LastCall' in fields:
+                    member['last_call'] = int(fields['LastCall'] or 0)
+            self._account(queue, member, +1)
+
+        self.version += 1
+
+
+queue_state = QueueStateEngine()
+
+
+# ── Extension State ─────────────────────────────────────────────────
+
+EXTENSION_EVENTS = {'DeviceStateChange', 'ExtensionStatus', 'PeerStatus', 'ContactStatus'}
+
+_DEVICE_RE = re.compile(r'^(?:PJSIP|SIP)/(\d+)$', re.IGNORECASE)
+
+# Device / hint state (any spelling, letters only, upper-cased) -> extension status.
+# Covers DeviceStateChange (NOT_INUSE), PJSIPShowEndpoints (Not in use) and
+# ExtensionStatus StatusText (Idle, InUse, RingInUse, Hold).
+DEVICE_STATUS = {
+    'NOTINUSE': 'online', 'IDLE': 'online',
+    'INUSE': 'busy', 'BUSY': 'busy', 'ONHOLD': 'busy', 'HOLD': 'busy',
+    'RINGING': 'ringing', 'RINGINUSE': 'ringing',
+    'UNAVAILABLE': 'offline', 'INVALID': 'offline',
+}
+
+
+# Endpoint dump value for a peer that is registered but whose device state
+# the dump does not carry (chan_sip SIPpeers)
+REACHABLE = 'reachable'
+
+
+def device_state_status(device_state: str):
+    """Map an Asterisk device state to online/busy/ringing/offline (None if unknown)"""
+    return DEVICE_STATUS.get(re.sub(r'[^A-Z]', '', device_state.upper()))
+
+
+class ExtensionStateMap:
+    """Extension registration / device status kept current from AMI events.
+
+    DeviceStateChange and ExtensionStatus carry the device state (idle, in
+    use, ringing, unavailable); PeerStatus and ContactStatus carry
+    registration.  Losing registration makes an extension offline straight
+    away; regaining it only lifts it out of offline, the device state that
+    follows says whether it is idle or busy.  The SIPpeers /
+    PJSIPShowEndpoints dump only reconciles the map every
+    EXTENSION_RECONCILE_INTERVAL seconds, or every cycle while the event
+    listener is down.
+    """
+
+    def __init__(self):
+        self.states: Dict[str, str] = {}
+        self.live = False
+        self.last_reconcile = 0.0
+        self.version = 0
+        self._touched: Dict[str, float] = {}
+
+    def attach(self):
+        self.live = True
+        self.last_reconcile = 0.0
+
+    def detach(self):
+        self.live = False
+
+    def needs_reconcile(self, now: float) -> bool:
+        return not self.live or now - self.last_reconcile >= EXTENSION_RECONCILE_INTERVAL
+
+    def _set(self, ext: str, status: str) -> None:
+        self._touched[ext] = time.time()
+        if self.states.get(ext) != status:
+            self.states[ext] = status
+            self.version += 1
+
+    def apply_event(self, evt: str, fields: Dict[str, str]) -> None:
+        """Apply one device/registration event from the AMI event stream"""
+        if evt == 'DeviceStateChange':
+            match = _DEVICE_RE.match(fields.get('Device', ''))
+            status = device_state_status(fields.get('State', ''))
+            if match and status:
+                self._set(match.group(1), status)
+
+        elif evt == 'ExtensionStatus':
+            ext = fields.get('Exten', '')
+            status = device_state_status(fields.get('StatusText', ''))
+            if ext.isdigit() and status:
+                self._set(ext, status)
+
+        else:
+            if evt == 'PeerStatus':
+                match = _DEVICE_RE.match(fields.get('Peer', ''))
+                ext = match.group(1) if match else None
+                status = fields.get('PeerStatus', '')
+                lost = status in ('Unregistered', 'Unreachable')
+            else:
+                # ContactStatus: an endpoint may have several contacts, so a
+                # removed one does not mean offline — the DeviceStateChange to
+                # UNAVAILABLE that follows the last one does.
+                aor = fields.get('AOR', '')
+                ext = aor if aor.isdigit() else None
+                status = fields.get('ContactStatus', '')
+                lost = False
+            if not ext:
+                return
+            if lost:
+                self._set(ext, 'offline')
+            elif status in ('Registered', 'Reachable', 'Created') and self.states.get(ext, 'offline') == 'offline':
+                self._set(ext, 'online')
+
+    def reconcile(self, dump: Dict[str, str], requested_at: float) -> None:
+        """Replace the map with a SIPpeers/PJSIPShowEndpoints dump taken at
+        ``requested_at``; extensions changed by events since then keep their
+        event state.  A REACHABLE peer only lifts an extension out of offline:
+        a busy or ringing state from its events stays."""
+        fresh = {}
+        for ext, status in dump.items():
+            if status == REACHABLE:
+                current = self.states.get(ext, 'offline')
+                status = 'online' if current == 'offline' else current
+            fresh[ext] = status
+        for ext, ts in self._touched.items():
+            if ts >= requested_at and ext in self.states:
+                fresh[ext] = self.states[ext]
+        if fresh != self.states:
+            self.states = fresh
+            self.version += 1
+        self._touched = {ext: ts for ext, ts in self._touched.items() if ts >= requested_at}
+        self.last_reconcile = time.time()
+
+
+extension_state = ExtensionStateMap()
+
+
 def process_queue_data(queue_status):
     """Process queue data into structured format"""
     queue_list = []
+    now = time.time()
 
     for queue_name, queue_info in sorted(queue_status.items()):
-        # Calculate metrics
-        total_members = len(queue_info['members'])
-        available_members = sum(1 for m in queue_info['members'] if not m['paused'] and not m['in_call'])
-        paused_members = sum(1 for m in queue_info['members'] if m['paused'])
-        busy_members = sum(1 for m in queue_info['members'] if m['in_call'])
-
-        # Get longest wait time
+        # Waiting times advance between dumps; derive them from join time
+        for entry in queue_info['entries']:
+            entry['wait_time'] = int(now - entry['joined_at'])
         longest_wait = max((e['wait_time'] for e in queue_info['entries']), default=0)
 
         queue_list.append({
             'name': queue_info['name'],
             'calls_waiting': queue_info['calls_waiting'],
             'longest_wait': longest_wait,
-            'total_members': total_members,
-            'available_members': available_members,
-            'paused_members': paused_members,
-            'busy_members': busy_members,
+            'total_members': queue_info['total_members'],
+            'available_members': queue_info['available_members'],
+            'paused_members': queue_info['paused_members'],
+            'busy_members': queue_info['busy_members'],
             'completed': queue_info['completed'],
             'abandoned': queue_info['abandoned'],
             'avg_hold_time': queue_info['hold_time'],
             'avg_talk_time': queue_info['talk_time'],
             'service_level_perf': queue_info['service_level_perf'],
-            'waiting_calls': queue_info['entries'],
-            'members': queue_info['members'],
+            # copies: the queue engine updates these in place, published
+            # entries must not change (see snapshot_delta)
+            'waiting_calls': [dict(entry) for entry in queue_info['entries']],
+            'members': [dict(member) for member in queue_info['members']],
         })
 
     return queue_list
 
 
-def load_db_stats():
-    """Load today's extension statistics from database"""
-    global extension_stats_db
+def query_rows(query, timeout=None):
+    """Run ``(sql, params)`` on a fresh pymysql connection.  Blocking: only
+    used from a worker thread, when aiomysql is not installed."""
+    db_config = get_db_config()
+    if timeout:
+        db_config['connect_timeout'] = timeout
+        db_config['read_timeout'] = timeout
+    conn = pymysql.connect(**db_config)
+    try:
+        cursor = conn.cursor(pymysql.cursors.DictCursor)
+        cursor.execute(*query)
+        return cursor.fetchall()
+    finally:
+        conn.close()
 
-    if not MYSQL_AVAILABLE:
-        return
 
-    try:
-        # Parse database config
-        db_config = {'host': 'localhost', 'user': 'root', 'password': '', 'database': 'asteriskcdrdb', 'port': 3306}
+async def fetch_rows(query, timeout=None):
+    """Rows of ``(sql, params)`` within ``timeout``, without blocking the event loop"""
+    if db_pool is None:
+        future = asyncio.get_event_loop().run_in_executor(None, query_rows, query, timeout)
+        return await asyncio.wait_for(future, timeout=timeout)
+    async with db_pool.acquire() as conn:
         try:
-            with open(DB_CONFIG_FILE, 'r') as f:
-                for line in f:
-                    line = line.strip()
-                    if '=' in line and not line.startswith('#'):
-                        key, value = line.split('=', 1)
-                        key, value = key.strip(), value.strip().strip('"').strip("'")
-                        if key == 'AMPDBHOST': db_config['host'] = value
-                        elif key == 'AMPDBUSER': db_config['user'] = value
-                        elif key == 'AMPDBPASS': db_config['password'] = value
-                        elif key == 'AMPDBPORT': db_config['port'] = int(value) if value.isdigit() else 3306
-        except:
-            pass
-
-        # Connect and query
-        conn = pymysql.connect(**db_config)
-        cursor = conn.cursor(pymysql.cursors.DictCursor)
+            async with conn.cursor(aiomysql.DictCursor) as cur:
+                await asyncio.wait_for(cur.execute(*query), timeout=timeout)
+                return await asyncio.wait_for(cur.fetchall(), timeout=timeout)
+        except BaseException:
+            conn.close()    # interrupted mid-result: not fit to go back to the pool
+            raise
+
+
+class DBStatsLoader:
+    """Refreshes extension_stats_db in the background.
+
+    CDR queries run as their own task on the aiomysql pool (or on a worker
+    thread with pymysql), so the event loop keeps handling AMI events and
+    clients meanwhile.  The db schedule and hangups (request()) trigger
+    refreshes through a RefreshCoordinator: at most one runs at a time,
+    at least DB_REFRESH_MIN_INTERVAL apart, and after a hangup only once the
+    CDR row has landed.  Refreshes are incremental (see cdr_stats.py): only
+    CDR rows that can be new since the last one are read, and the whole day
+    is aggregated again only on a full load.  The result replaces
+    extension_stats_db in a single assignment: readers see the previous
+    stats or the new ones.
+    """
 
-        today = date.today().strftime('%Y-%m-%d')
-        # Quadruple %: f-string resolves %% to %, then pymysql resolves %% to %
-        gateway_like = " OR ".join([f"channel LIKE '%%%%{gw}%%%%' OR dstchannel LIKE '%%%%{gw}%%%%'" for gw in GATEWAYS])
-
-        query = f"""
-        SELECT
-            extension,
-            SUM(total_calls) as total_calls,
-            SUM(answered_calls) as answered_calls,
-            SUM(total_duration) as total_duration,
-            SUM(missed_calls) as missed_calls,
-            SUM(inbound_calls) as inbound_calls,
-            SUM(outbound_calls) as outbound_calls,
-            SUM(internal_calls) as internal_calls,
-            MIN(first_call_start) as first_call_start,
-            MAX(last_call_end) as last_call_end
-        FROM (
-            SELECT
-                SUBSTRING_INDEX(SUBSTRING_INDEX(channel, '/', -1), '-', 1) AS extension,
-                COUNT(*) as total_calls,
-                SUM(CASE WHEN disposition = 'ANSWERED' THEN 1 ELSE 0 END) as answered_calls,
-                SUM(billsec) as total_duration,
-                SUM(CASE WHEN disposition IN ('NO ANSWER', 'NOANSWER') THEN 1 ELSE 0 END) as missed_calls,
-                SUM(CASE WHEN ({gateway_like}) AND dstchannel REGEXP '^(PJSIP|SIP)/.*' THEN 1 ELSE 0 END) as outbound_calls,
-                0 as inbound_calls,
-                SUM(CASE WHEN NOT ({gateway_like}) OR dstchannel NOT REGEXP '^(PJSIP|SIP)/.*' THEN 1 ELSE 0 END) as internal_calls,
-                MIN(calldate) as first_call_start,
-                MAX(DATE_ADD(calldate, INTERVAL billsec SECOND)) as last_call_end
-            FROM cdr
-            WHERE calldate >= %s AND calldate < DATE_ADD(%s, INTERVAL 1 DAY)
-            AND (channel LIKE 'PJSIP/%%%%' OR channel LIKE 'SIP/%%%%')
-            AND channel REGEXP '^(PJSIP|SIP)/[0-9]+'
-            GROUP BY extension
-
-            UNION ALL
-
-            SELECT
-                SUBSTRING_INDEX(SUBSTRING_INDEX(dstchannel, '/', -1), '-', 1) AS extension,
-                COUNT(*) as total_calls,
-                SUM(CASE WHEN disposition = 'ANSWERED' AND dstchannel REGEXP '^(PJSIP|SIP)/[0-9]+' THEN 1 ELSE 0 END) as answered_calls,
-                SUM(billsec) as total_duration,
-                SUM(CASE WHEN disposition IN ('NO ANSWER', 'NOANSWER') THEN 1 ELSE 0 END) as missed_calls,
-                0 as outbound_calls,
-                SUM(CASE WHEN ({gateway_like}) AND channel REGEXP '^(PJSIP|SIP)/.*' THEN 1 ELSE 0 END) as inbound_calls,
-                SUM(CASE WHEN NOT ({gateway_like}) OR channel NOT REGEXP '^(PJSIP|SIP)/.*' THEN 1 ELSE 0 END) as internal_calls,
-                MIN(calldate) as first_call_start,
-                MAX(DATE_ADD(calldate, INTERVAL billsec SECOND)) as last_call_end
-            FROM cdr
-            WHERE calldate >= %s AND calldate < DATE_ADD(%s, INTERVAL 1 DAY)
-            AND (dstchannel LIKE 'PJSIP/%%%%' OR dstchannel LIKE 'SIP/%%%%')
-            AND dstchannel REGEXP '^(PJSIP|SIP)/[0-9]+'
-            GROUP BY extension
-        ) combined
-        WHERE extension REGEXP '^[0-9]+$'
-        GROUP BY extension
-        """
+    def __init__(self):
+        self.task = None
+        self.accumulator = None
+        self.watermark = CDRWatermark(CDR_SETTLE_TIME)
+        self.full_loaded_at = 0.0
+        self.coordinator = RefreshCoordinator(DB_REFRESH_MIN_INTERVAL, CDR_LANDING_TIMEOUT)
+        self.landed = None           # (since, CDR row count) before the last refresh
+        self.rollup_warned = False
+        self._wakeup = asyncio.Event()
+
+    @property
+    def running(self) -> bool:
+        return self.task is not None and not self.task.done()
+
+    def start(self, schedule: 'PollSchedule') -> None:
+        """Run refreshes on ``schedule`` (and on request) until cancelled"""
+        if not self.running:
+            self.task = asyncio.ensure_future(self._run(schedule))
+
+    def request(self, after_hangup=False) -> None:
+        self.coordinator.trigger(time.time(), after_hangup)
+        self._wakeup.set()
+
+    def cancel(self) -> None:
+        if self.running:
+            self.task.cancel()
+
+    async def _cdr_landed(self) -> bool:
+        """True once CDR rows were written since the last refresh"""
+        if self.landed is None:
+            return True
+        since, count = self.landed
+        try:
+            rows = await fetch_rows(landed_query(since), CDR_LANDING_POLL * 4)
+        except Exception:
+            return True              # cannot tell: do not hold the refresh back
+        return rows[0]['n'] > count
+
+    async def _run(self, schedule: 'PollSchedule'):
+        coordinator = self.coordinator
+        while True:
+            if not coordinator.pending:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(),
+                                           timeout=max(0.0, schedule.next_run - time.time()))
+                except asyncio.TimeoutError:
+                    coordinator.trigger(time.time())
+                self._wakeup.clear()
+                continue
+            holdoff = coordinator.holdoff(time.time())
+            if holdoff > 0:
+                await asyncio.sleep(holdoff)
+                continue
+            landed = coordinator.awaiting_cdr and await self._cdr_landed()
+            if not coordinator.ready(time.time(), landed):
+                await asyncio.sleep(CDR_LANDING_POLL)
+                continue
+            coordinator.started(time.time())
+            await self._refresh(schedule)
 
-        cursor.execute(query, (today, today, today, today))
-        results = cursor.fetchall()
-
-        extension_stats_db = {}
-        for row in results:
-            ext = row['extension'].replace('PJSIP/', '').replace('SIP/', '')
-            if ext.isdigit():
-                # Convert datetime objects to strings for JSON serialization
-                first_call = row['first_call_start'].strftime('%H:%M:%S') if row.get('first_call_start') else ''
-                last_call = row['last_call_end'].strftime('%H:%M:%S') if row.get('last_call_end') else ''
-
-                extension_stats_db[ext] = {
-                    'total_calls_today': int(row['total_calls'] or 0),
-                    'answered_today': int(row['answered_calls'] or 0),
-                    'missed_today': int(row['missed_calls'] or 0),
-                    'total_duration_today': int(row['total_duration'] or 0),
-                    'inbound_today': int(row['inbound_calls'] or 0),
-                    'outbound_today': int(row['outbound_calls'] or 0),
-                    'internal_today': int(row['internal_calls'] or 0),
-                    'first_call_start': first_call,
-                    'last_call_end': last_call,
-                }
+    async def load(self, timeout=None) -> bool:
+        """Load and publish today's stats; True if they changed"""
+        global extension_stats_db, db_stats_loaded_at
+        if db_pool is None and not MYSQL_AVAILABLE:
+            return False
+        now = time.time()
+        today = date.today()
+        since = max(self.watermark.update(channel_table.start_times(), now),
+                    datetime.combine(today, datetime.min.time()))
+        acc = self.accumulator
+        # The watermark needs to know every call that is up
+        tracked = channel_table.live or now - channel_table.last_reconcile < 30
+        full = (acc is None or acc.day != today or not tracked or since < acc.floor
+                or now - self.full_loaded_at >= CDR_FULL_RELOAD_INTERVAL)
+
+        self.landed = (since, (await fetch_rows(landed_query(since), timeout))[0]['n'])
+
+        # Rows first: one written while the aggregate runs is then either in
+        # the aggregate or read again next time
+        rows = await fetch_rows(rows_query(today, since), timeout)
+        rolled = 0
+        if full:
+            acc = CDRAccumulator(today, GATEWAYS)
+            start, rolled = await self._add_rollup(acc, today, since, timeout)
+            acc.add_totals(await fetch_rows(aggregate_query(GATEWAYS, today, since, start), timeout), since)
+        else:
+            acc.forget_before(since)
+        added = acc.fold(rows)
+        if full:
+            self.accumulator, self.full_loaded_at = acc, now
+
+        stats = acc.stats()
+        changed = stats != extension_stats_db
+        extension_stats_db = stats
+        db_stats_loaded_at = time.time()
+        print(f"✓ Loaded DB stats for {len(stats)} extensions "
+              f"({f'full load, {rolled}h from rollup' if full else f'{added} new CDR rows'}; "
+              f"{self.coordinator.describe()})")
+        return changed
+
+    async def _add_rollup(self, acc: CDRAccumulator, today: date, since: datetime, timeout):
+        """Fold the hours cdr-rollup.py keeps current in extension_daily_stats
+        into ``acc``; returns where aggregating cdr has to start, and how many
+        hours came from the rollup (none if its tables are missing)"""
+        midnight = datetime.combine(today, datetime.min.time())
+        try:
+            start = rolled_up_until(today, since, await fetch_rows(rollup_hours_query(today, since), timeout))
+            hours = int((start - midnight).total_seconds() // 3600)
+            rows = await fetch_rows(rollup_query(today, hours), timeout) if hours else []
+        except asyncio.TimeoutError:
+            raise
+        except Exception as e:
+            if not self.rollup_warned:
+                print(f"⚠ CDR rollup not used, aggregating cdr instead: {e}")
+                self.rollup_warned = True
+            return midnight, 0
+        acc.add_rollup(rows)
+        return start, hours
+
+    async def _refresh(self, schedule: 'PollSchedule'):
+        global last_db_reload
+        last_db_reload = time.time()
+        try:
+            changed = await self.load(schedule.timeout)
+        except asyncio.TimeoutError:
+            print(f"⚠ Database stats load timed out after {schedule.timeout:g}s")
+            schedule.failed(time.time())
+            return
+        except Exception as e:
+            print(f"⚠ Database stats load failed: {e}")
+            schedule.failed(time.time())
+            return
+        schedule.record(time.time(), changed)
+        if changed:
+            push_trigger.mark()
 
-        cursor.close()
-        conn.close()
-        print(f"✓ Loaded DB stats for {len(extension_stats_db)} extensions")
 
-    except Exception as e:
-        print(f"⚠ Database stats load failed: {e}")
+db_loader = DBStatsLoader()
 
 
 # ── Agent Event DB (async) ──────────────────────────────────────────
@@ -664,7 +1300,7 @@ def get_db_config() -> dict:
 
 
 async def init_db_pool():
-    """Create aiomysql connection pool for agent_event writes."""
+    """Create aiomysql connection pool for agent_event writes and CDR stats."""
     global db_pool
     if not AIOMYSQL_AVAILABLE:
         print("⚠ aiomysql not available — agent event logging disabled")
@@ -850,36 +1486,42 @@ def process_channels(channels, extension_states=None, paused_extensions=None, pr
     if paused_extensions is None:
         paused_extensions = set()
 
-    # Group channels by duration (merge call legs)
-    sip_channels = [ch for ch in channels if 'SIP/' in ch['channel'] or 'PJSIP/' in ch['channel']]
-
-    call_groups = {}
-    for ch in sip_channels:
-        bucket = (ch['duration'] // 3) * 3
-        if bucket not in call_groups:
-            call_groups[bucket] = []
-        call_groups[bucket].append(ch)
+    # Assemble calls from legs sharing a Linkedid / bridge
+    classify = CHANNEL_CLASSIFIER.classify
+    CHANNEL_CLASSIFIER.prune([ch['channel'] for ch in channels])
+    sip_channels = [ch for ch in channels if classify(ch['channel']).technology in SIP_TECHNOLOGIES]
 
     calls = []
     extension_kpis = {}
     extensions_on_call = set()  # Track which extensions are currently on calls
 
-    # Process each group
-    for duration, group in call_groups.items():
-        gateway_legs = [ch for ch in group if any(gw in ch['channel'].lower() for gw in GATEWAYS)]
-        extension_legs = [ch for ch in group if not any(gw in ch['channel'].lower() for gw in GATEWAYS)]
+    def kpi_for(ext, caller_id):
+        if ext not in extension_kpis:
+            extension_kpis[ext] = {'extension': ext, 'caller_id': caller_id, 'active': 0, 'in': 0, 'out': 0, 'int': 0, 'status': 'online', 'on_hold': False}
+        return extension_kpis[ext]
+
+    # Process each call
+    for call_id, group in group_call_legs(sip_channels):
+        gateway_legs = []
+        extension_legs = []
+        for ch in group:
+            if classify(ch['channel']).kind == 'gateway':
+                gateway_legs.append(ch)
+            else:
+                extension_legs.append(ch)
 
         if gateway_legs and extension_legs:
-            # Bridged call (gateway + extension)
+            # Bridged call (gateway + extension); prefer the answered extension leg
             gw_ch = gateway_legs[0]
-            ext_ch = extension_legs[0]
-            ext = extract_extension(ext_ch['channel'])
+            ext_ch = next((ch for ch in extension_legs if ch['state'] == 'Up'), extension_legs[0])
+            ext = classify(ext_ch['channel']).extension
 
             is_outbound = any(p in ext_ch['context'].lower() for p in ['macro-dialout', 'outbound', 'dialout-trunk'])
             direction = 'outbound' if is_outbound else 'inbound'
 
             if is_outbound:
                 calls.append({
+                    'call_id': call_id,
                     'channel': ext_ch['channel'],
                     'dstchannel': gw_ch['channel'],
                     'callerid': f"{ext_ch['calleridname']} <{ext_ch['callerid']}>",
@@ -891,6 +1533,7 @@ def process_channels(channels, extension_states=None, paused_extensions=None, pr
                 })
             else:
                 calls.append({
+                    'call_id': call_id,
                     'channel': gw_ch['channel'],
                     'dstchannel': ext_ch['channel'],
                     'callerid': f"{gw_ch['calleridname']} <{gw_ch['callerid']}>",
@@ -903,61 +1546,72 @@ def process_channels(channels, extension_states=None, paused_extensions=None, pr
 
             # Track extension KPI
             if ext and ext.isdigit():
-                if ext not in extension_kpis:
-                    extension_kpis[ext] = {'extension': ext, 'caller_id': ext_ch['calleridname'], 'active': 0, 'in': 0, 'out': 0, 'int': 0, 'status': 'online', 'on_hold': False}
+                kpi = kpi_for(ext, ext_ch['calleridname'])
                 if direction == 'outbound':
-                    extension_kpis[ext]['out'] += 1
+                    kpi['out'] += 1
                 else:
-                    extension_kpis[ext]['in'] += 1
+                    kpi['in'] += 1
                 if ext_ch['state'] == 'Up':
-                    extension_kpis[ext]['active'] += 1
+                    kpi['active'] += 1
                     extensions_on_call.add(ext)
                     # Check if on hold (muted or no audio)
                     if 'hold' in ext_ch['context'].lower() or ext_ch['state'] == 'Hold':
-                        extension_kpis[ext]['on_hold'] = True
+                        kpi['on_hold'] = True
                 elif ext_ch['state'] in ['Ringing', 'Ring']:
                     extensions_on_call.add(ext)
 
-        elif gateway_legs and not extension_legs:
+            # Other extensions still ringing for the same call (ring groups, queues)
+            for other in extension_legs:
+                if other is not ext_ch and other['state'] in ['Ringing', 'Ring']:
+                    other_ext = classify(other['channel']).extension
+                    if other_ext and other_ext.isdigit():
+                        kpi_for(other_ext, other['calleridname'])
+                        extensions_on_call.add(other_ext)
+
+        elif gateway_legs:
             # Inbound call not yet bridged (in IVR, queue, ringing, etc.)
-            for gw_ch in gateway_legs:
-                # Check if it's an outbound context (unlikely for gateway-only, but check anyway)
-                is_outbound_context = any(p in gw_ch['context'].lower() for p in ['macro-dialout', 'outbound', 'dialout-trunk'])
-                if not is_outbound_context:
-                    # It's an inbound call in IVR/announcement/queue
-                    calls.append({
-                        'channel': gw_ch['channel'],
-                        'dstchannel': '',
-                        'callerid': f"{gw_ch['calleridname']} <{gw_ch['callerid']}>",
-                        'extension': gw_ch['extension'],
-                        'destination': gw_ch['context'],  # Show context as destination
-                        'status': gw_ch['state'],
-                        'duration': gw_ch['duration'],
-                        'direction': 'inbound',
-                    })
-
-        elif extension_legs and not gateway_legs:
-            # Extension-only calls (could be internal calls or ringing extensions)
-            for ext_ch in extension_legs:
-                ext = extract_extension(ext_ch['channel'])
+            gw_ch = originating_leg(gateway_legs)
+            # Check if it's an outbound context (unlikely for gateway-only, but check anyway)
+            is_outbound_context = any(p in gw_ch['context'].lower() for p in ['macro-dialout', 'outbound', 'dialout-trunk'])
+            if not is_outbound_context:
+                # It's an inbound call in IVR/announcement/queue
+                other = next((ch for ch in gateway_legs if ch is not gw_ch), None)
                 calls.append({
-                    'channel': ext_ch['channel'],
-                    'dstchannel': '',
-                    'callerid': f"{ext_ch['calleridname']} <{ext_ch['callerid']}>",
-                    'extension': ext_ch['extension'],
-                    'destination': ext_ch['context'],
-                    'status': ext_ch['state'],
-                    'duration': ext_ch['duration'],
-                    'direction': 'internal',
+                    'call_id': call_id,
+                    'channel': gw_ch['channel'],
+                    'dstchannel': other['channel'] if other else '',
+                    'callerid': f"{gw_ch['calleridname']} <{gw_ch['callerid']}>",
+                    'extension': gw_ch['extension'],
+                    'destination': gw_ch['context'],  # Show context as destination
+                    'status': gw_ch['state'],
+                    'duration': gw_ch['duration'],
+                    'direction': 'inbound',
                 })
 
-                # Track extension KPI for internal calls
+        else:
+            # Extension-only call (internal call, or an extension ringing / in the dialplan)
+            origin = originating_leg(extension_legs)
+            other = next((ch for ch in extension_legs if ch is not origin), None)
+            calls.append({
+                'call_id': call_id,
+                'channel': origin['channel'],
+                'dstchannel': other['channel'] if other else '',
+                'callerid': f"{origin['calleridname']} <{origin['callerid']}>",
+                'extension': origin['extension'],
+                'destination': (classify(other['channel']).extension or other['extension']) if other else origin['context'],
+                'status': origin['state'],
+                'duration': origin['duration'],
+                'direction': 'internal',
+            })
+
+            # Track extension KPI for every extension on the internal call
+            for ext_ch in extension_legs:
+                ext = classify(ext_ch['channel']).extension
                 if ext and ext.isdigit():
-                    if ext not in extension_kpis:
-                        extension_kpis[ext] = {'extension': ext, 'caller_id': ext_ch['calleridname'], 'active': 0, 'in': 0, 'out': 0, 'int': 0, 'status': 'online', 'on_hold': False}
-                    extension_kpis[ext]['int'] += 1
+                    kpi = kpi_for(ext, ext_ch['calleridname'])
+                    kpi['int'] += 1
                     if ext_ch['state'] == 'Up':
-                        extension_kpis[ext]['active'] += 1
+                        kpi['active'] += 1
                         extensions_on_call.add(ext)
                     elif ext_ch['state'] in ['Ringing', 'Ring']:
                         extensions_on_call.add(ext)
@@ -1057,49 +1711,573 @@ def process_channels(channels, extension_states=None, paused_extensions=None, pr
     }
 
 
+# ── Client Protocol ─────────────────────────────────────────────────
+#
+# Legacy clients get the full snapshot dict on every broadcast.  A client
+# that sends {"type": "hello", "protocol": 2} gets
+#   {"type": "snapshot", "seq": N, "epoch": E, "data": {...}}   once, then
+#   {"type": "delta", "seq": N+1, ...}                           per broadcast (see snapshot_delta)
+# and can send {"type": "resync"} at any time to get a fresh snapshot.
+# A reconnecting client adds "epoch" and "last_seq" to its hello; if those
+# deltas are still in the ring buffer it gets only the ones it missed.
+# A "subscribe" object (in the hello, or as {"type": "subscribe", ...} later)
+# narrows what the client receives; see Subscription.  "encoding" ("json" or
+# "msgpack") and "layout" ("objects" or "columns") in the hello pick the wire
+# format of snapshots and deltas (see snapshot_delta); the snapshot echoes
+# what was granted.
+
+PROTOCOL_VERSION = 2
+_publisher_ids = count()
+
+# Snapshot fields that move with the clock (db_refresh with the db schedule):
+# a snapshot that differs from the last one only in these is not a new
+# version while every source is live
+CLOCK_FIELDS = frozenset(('timestamp', 'freshness', 'db_refresh'))
+
+
+def sources_live(data: Dict[str, Any]) -> bool:
+    """True when every AMI source of ``data`` was current as of its timestamp"""
+    timestamp = data.get('timestamp')
+    return all(seen == timestamp for source, seen in data.get('freshness', {}).items()
+               if source != 'db_stats')
+
+
+class SnapshotPublisher:
+    """Sequence-numbered snapshots and deltas.  Every message is encoded once
+    per wire variant (codec and layout) and shared by all clients using it."""
+
+    def __init__(self, history=DELTA_HISTORY):
+        # seqs restart with the process and with every subscription group,
+        # unless publish() is given the collector's stream to follow
+        self.epoch = f"{os.getpid():x}-{int(time.time()):x}-{next(_publisher_ids)}"
+        self.seq = 0
+        self.data = None
+        self.generated_at = None     # when self.data was published
+        self.history = deque(maxlen=history)    # (seq, base seq, delta, {variant: message}), oldest first
+        self._index = None
+        self._snapshot_messages = {}
+        self._http_bodies = {}
+        self._etag = None
+
+    def publish(self, data: Dict[str, Any], stream=None) -> bool:
+        """Adopt a new snapshot; False if nothing changed since the last one.
+
+        ``stream`` is ``(epoch, seq)`` to number the snapshot in another
+        process's stream (a worker following the collector) rather than
+        this publisher's own.  Seqs may then skip values, so every delta
+        names the seq it applies to (``base``).
+        """
+        if stream is not None and stream[0] != self.epoch:
+            self.epoch = stream[0]
+            self._index = None       # nothing to diff against in a new stream
+        delta, index = diff_snapshots(self._index, data)
+        if delta == {} or (delta is not None and self._clock_only(delta, data)):
+            return False
+        self._index = index
+        base = self.seq
+        self.seq = stream[1] if stream is not None else self.seq + 1
+        self.data = data
+        self.generated_at = time.time()
+        if delta is not None:
+            self.history.append((self.seq, base, delta, {}))
+        else:
+            self.history.clear()
+        self._snapshot_messages = {}
+        self._http_bodies = {}
+        self._etag = None
+        return True
+
+    def _clock_only(self, delta, data) -> bool:
+        """Whether ``delta`` only moves the timestamp and the freshness of
+        live sources.  It is not published (messages, bodies and ETag stay
+        cached); the new values go out with the next real change.  While a
+        source lags, its growing age is news and is published."""
+        return (delta.keys() == {'set'} and delta['set'].keys() <= CLOCK_FIELDS
+                and sources_live(self.data) and sources_live(data))
+
+    def deltas_since(self, epoch, last_seq, variant=DEFAULT_VARIANT):
+        """Delta messages after ``last_seq``, or None if they are no longer
+        (or never were) in the ring buffer"""
+        if epoch != self.epoch or not isinstance(last_seq, int) or last_seq > self.seq:
+            return None
+        if last_seq == self.seq:
+            return []
+        count = 0
+        for seq, base, delta, messages in reversed(self.history):
+            count += 1
+            if base <= last_seq:
+                break
+        else:
+            return None
+        if base != last_seq:
+            return None              # last_seq was never published here
+        missed = []
+        for seq, base, delta, messages in islice(reversed(self.history), count):
+            message = messages.get(variant)
+            if message is None:
+                message = messages[variant] = encode_delta(delta, variant, type='delta', seq=seq, base=base)
+            missed.append(message)
+        missed.reverse()
+        return missed
+
+    def snapshot_message(self, variant=DEFAULT_VARIANT):
+        message = self._snapshot_messages.get(variant)
+        if message is None:
+            codec = CODECS[variant.codec]
+            header = {'type': 'snapshot', 'seq': self.seq, 'epoch': self.epoch,
+                      'generated_at': round(self.generated_at, 3),
+                      'encoding': variant.codec, 'layout': 'columns' if variant.columns else 'objects'}
+            message = self._snapshot_messages[variant] = codec.mapping(
+                [(key, codec.value(value)) for key, value in header.items()]
+                + [('data', self._index.encode(variant))])
+        return message
+
+    def legacy_message(self) -> str:
+        return self._index.encode()
+
+    @property
+    def etag(self) -> str:
+        """Hash of the snapshot, without the clock fields while every source
+        is live: equal data gets equal tags in every worker process, however
+        each numbered it and whichever heartbeat each last published"""
+        if self._etag is None:
+            data = self.data
+            if sources_live(data):
+                data = {key: value for key, value in data.items() if key not in CLOCK_FIELDS}
+            digest = hashlib.sha1(json.dumps(data, sort_keys=True, separators=(',', ':')).encode())
+            self._etag = f'"{digest.hexdigest()[:20]}"'
+        return self._etag
+
+    def http_body(self, encoding='identity') -> bytes:
+        """The snapshot as a GET /snapshot body, compressed at most once per
+        version and content coding"""
+        body = self._http_bodies.get(encoding)
+        if body is None:
+            body = self.legacy_message().encode()
+            if encoding == 'gzip':
+                body = gzip.compress(body, 6)
+            elif encoding == 'br':
+                body = brotli.compress(body, quality=5)
+            self._http_bodies[encoding] = body
+        return body
+
+
+publisher = SnapshotPublisher()
+
+
+TOPICS = frozenset(('calls', 'extension_kpis', 'queues', 'breaks'))
+
+
+def parse_extension_ranges(values):
+    """["100-199", "205", 300] -> ((100, 199), (205, 205), (300, 300))"""
+    ranges = []
+    for value in values:
+        low, _, high = str(value).partition('-')
+        ranges.append((int(low), int(high or low)))
+    return tuple(sorted(ranges))
+
+
+class Subscription(namedtuple('Subscription', 'topics queues extensions')):
+    """What one group of clients receives.
+
+    topics      subset of TOPICS; 'breaks' adds each extension's break_history
+                (the KPIs otherwise go out without it)
+    queues      queue names to include, or None for all
+    extensions  (low, high) extension ranges for calls and KPIs, or None for all
+
+    Clients with equal subscriptions share one SnapshotPublisher, so each
+    group is projected, diffed and serialized once per broadcast.
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def parse(cls, request: Dict[str, Any]) -> 'Subscription':
+        """From a {"topics": [...], "queues": [...], "extensions": [...]} object;
+        raises ValueError on anything malformed"""
+        topics = frozenset(request.get('topics') or TOPICS)
+        if not topics <= TOPICS:
+            raise ValueError(f"unknown topics {sorted(topics - TOPICS)}")
+        queues = request.get('queues')
+        extensions = request.get('extensions')
+        return cls(topics,
+                   frozenset(str(q) for q in queues) if queues is not None else None,
+                   parse_extension_ranges(extensions) if extensions is not None else None)
+
+    @property
+    def tag(self) -> str:
+        """Short name of this subscription, the same in every process"""
+        key = json.dumps([sorted(self.topics), sorted(self.queues) if self.queues is not None else None,
+                          self.extensions])
+        return hashlib.sha1(key.encode()).hexdigest()[:10]
+
+    def _wanted(self, extension) -> bool:
+        if self.extensions is None:
+            return True
+        try:
+            number = int(extension)
+        except (TypeError, ValueError):
+            return False
+        return any(low <= number <= high for low, high in self.extensions)
+
+    def project(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        """This subscription's view of a full snapshot"""
+        if self == FULL_SUBSCRIPTION:
+            return data
+        view = {key: value for key, value in data.items()
+                if key not in ('calls', 'extension_kpis', 'queues')}
+        if 'calls' in self.topics:
+            view['calls'] = [c for c in data.get('calls', []) if self._wanted(c.get('extension'))]
+        if 'breaks' in self.topics:
+            view['extension_kpis'] = [k for k in data.get('extension_kpis', []) if self._wanted(k['extension'])]
+        elif 'extension_kpis' in self.topics:
+            view['extension_kpis'] = [{key: value for key, value in k.items() if key != 'break_history'}
+                                      for k in data.get('extension_kpis', []) if self._wanted(k['extension'])]
+        if 'queues' in self.topics:
+            view['queues'] = [q for q in data.get('queues', [])
+                              if self.queues is None or q['name'] in self.queues]
+        return view
+
+
+FULL_SUBSCRIPTION = Subscription(TOPICS, None, None)
+
+
+class SubscriptionGroups:
+    """One SnapshotPublisher per distinct subscription in use.
+
+    A group outlives its last client by SUBSCRIPTION_IDLE_TTL seconds so a
+    reconnecting client can still resume from its ring buffer.
+    """
+
+    def __init__(self):
+        self.publishers: Dict[Subscription, SnapshotPublisher] = {FULL_SUBSCRIPTION: publisher}
+        self._last_used: Dict[Subscription, float] = {}
+        self.stream = None           # collector's (epoch, seq) when this is a worker
+
+    def _group_stream(self, subscription: Subscription):
+        """The collector's numbering, with an epoch per subscription so that
+        every worker numbers a group's snapshots the same way"""
+        if self.stream is None or subscription == FULL_SUBSCRIPTION:
+            return self.stream
+        epoch, seq = self.stream
+        return f"{epoch}.{subscription.tag}", seq
+
+    def publisher_for(self, subscription: Subscription, keep=True) -> SnapshotPublisher:
+        """The group's publisher; with ``keep`` False (an HTTP poll) a new
+        group is only kept while there are fewer than SUBSCRIPTION_MAX_GROUPS,
+        otherwise the view is built for this one request"""
+        group = self.publishers.get(subscription)
+        if group is None:
+            group = SnapshotPublisher()
+            if publisher.data is not None:
+                group.publish(subscription.project(publisher.data), self._group_stream(subscription))
+            if not keep and len(self.publishers) >= SUBSCRIPTION_MAX_GROUPS:
+                return group
+            self.publishers[subscription] = group
+        self._last_used[subscription] = time.time()
+        return group
+
+    def publish(self, data: Dict[str, Any], sessions, stream=None) -> None:
+        """Publish a full snapshot to every group and wake the clients whose
+        group changed; ``stream`` is the collector's (epoch, seq) in a worker"""
+        self.stream = stream
+        now = time.time()
+        for session in sessions:
+            self._last_used[session.subscription] = now
+        if not publisher.publish(data, stream):
+            return                   # no view of an unchanged snapshot changed either
+        changed = {FULL_SUBSCRIPTION}
+        for subscription, group in list(self.publishers.items()):
+            if subscription == FULL_SUBSCRIPTION:
+                continue
+            if now - self._last_used.get(subscription, 0) > SUBSCRIPTION_IDLE_TTL:
+                del self.publishers[subscription]
+                self._last_used.pop(subscription, None)
+            elif group.publish(subscription.project(data), self._group_stream(subscription)):
+                changed.add(subscription)
+        for session in sessions:
+            if session.subscription in changed:
+                session.notify()
+
+
+subscriptions = SubscriptionGroups()
+
+
+class ClientSession:
+    """One connected client and its sender task.
+
+    Nothing is queued per client: a session only remembers the last seq it
+    sent, and its sender works out what to send from the publisher when it
+    wakes up: the latest full snapshot for legacy clients, or the deltas
+    since that seq for protocol-2 clients (a snapshot instead once they are
+    too far behind or evicted from the ring buffer).  Publishing therefore
+    costs one flag per client however slow it is.  Updates coalesced while a
+    send is still in flight count as skipped; a client that keeps skipping,
+    or whose send exceeds CLIENT_SEND_TIMEOUT, is disconnected.
+    """
+
+    def __init__(self, websocket: WebSocketServerProtocol, protocol=1):
+        self.websocket = websocket
+        self.protocol = protocol
+        self.subscription = FULL_SUBSCRIPTION
+        self.publisher = publisher
+        self.variant = DEFAULT_VARIANT   # wire codec and layout (protocol 2)
+        self.interval = 0            # minimum seconds between updates
+        self.epoch = None
+        self.sent_seq = None         # None: next send is a full snapshot
+        self.skipped = 0
+        self._wakeup = asyncio.Event()
+        self._busy = False
+        if protocol < PROTOCOL_VERSION:
+            self._wakeup.set()       # the cached snapshot goes out right away
+        self._task = asyncio.ensure_future(self._sender())
+
+    def notify(self) -> None:
+        """A new snapshot was published for this client's group"""
+        if self._busy:
+            self.skipped += 1
+        self._wakeup.set()
+
+    def subscribe(self, subscription: Subscription, interval=0) -> None:
+        """Raises TypeError/ValueError on a bad ``interval``, before anything changed"""
+        interval = min(max(0.0, float(interval or 0)), SUBSCRIPTION_MAX_INTERVAL)
+        self.subscription = subscription
+        self.publisher = subscriptions.publisher_for(subscription)
+        self.interval = interval
+
+    def start_delta_protocol(self, epoch=None, last_seq=None) -> None:
+        """hello / resync: switch to protocol 2, resuming after ``last_seq`` if given"""
+        self.protocol = PROTOCOL_VERSION
+        self.epoch = epoch
+        self.sent_seq = last_seq if isinstance(last_seq, int) else None
+        self._wakeup.set()
+
+    def _outgoing(self):
+        """Messages that bring this client up to date with the publisher"""
+        group = self.publisher
+        if group.data is None or (self.sent_seq == group.seq and self.epoch == group.epoch):
+            return []
+        if self.protocol < PROTOCOL_VERSION:
+            messages = [group.legacy_message()]
+        else:
+            missed = group.deltas_since(self.epoch, self.sent_seq, self.variant)
+            if missed is None or len(missed) > CLIENT_MAX_BACKLOG:
+                missed = [group.snapshot_message(self.variant)]
+            messages = missed
+        self.epoch, self.sent_seq = group.epoch, group.seq
+        return messages
+
+    async def _sender(self):
+        try:
+            while True:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                if self.skipped >= CLIENT_MAX_SKIPPED:
+                    self.disconnect(f"skipped {self.skipped} updates")
+                    return
+                self._busy = True
+                for message in self._outgoing():
+                    await asyncio.wait_for(self.websocket.send(message), timeout=CLIENT_SEND_TIMEOUT)
+                self._busy = False
+                if not self._wakeup.is_set():
+                    self.skipped = 0        # caught up
+                if self.interval:
+                    await asyncio.sleep(self.interval)
+        except asyncio.TimeoutError:
+            self.disconnect(f"send took over {CLIENT_SEND_TIMEOUT}s")
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+    def disconnect(self, reason: str) -> None:
+        print(f"⚠ Dropping slow client {self.websocket.remote_address}: {reason}")
+        asyncio.ensure_future(self.websocket.close(1013, 'client too slow'))
+
+    def close(self) -> None:
+        self._task.cancel()
+
+
+def _is_int(value) -> bool:
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def valid_hello(request: Dict[str, Any]) -> bool:
+    """Whether a hello's fields have the types the protocol expects; a
+    malformed hello is ignored like a message that is not JSON"""
+    last_seq = request.get('last_seq')
+    return (_is_int(request.get('protocol', 1))
+            and (last_seq is None or _is_int(last_seq))
+            and all(isinstance(request.get(key), (str, type(None))) for key in ('epoch', 'encoding', 'layout')))
+
+
+def subscribe_client(session: ClientSession, request: Dict[str, Any]) -> bool:
+    try:
+        session.subscribe(Subscription.parse(request), request.get('interval', 0))
+        return True
+    except (TypeError, ValueError) as e:
+        print(f"⚠ Rejected subscription from {session.websocket.remote_address}: {e}")
+        return False
+
+
 async def handle_client(websocket: WebSocketServerProtocol, path: str):
-    """Handle WebSocket client connection"""
-    connected_clients.add(websocket)
+    """Handle WebSocket client connection.
+
+    Clients are served from the publishers' cached snapshot: a legacy client
+    gets it as soon as it connects, a client that connects with
+    ``?protocol=2`` as soon as its hello arrives.  Connecting never costs an
+    AMI or DB round, however many clients reconnect at once.
+    """
+    query = parse_qs(urlsplit(path or '').query)
+    protocol = PROTOCOL_VERSION if query.get('protocol') == [str(PROTOCOL_VERSION)] else 1
+    session = connected_clients[websocket] = ClientSession(websocket, protocol)
     client_addr = websocket.remote_address
     print(f"✓ Client connected: {client_addr} (total: {len(connected_clients)})")
 
     try:
         async for message in websocket:
-            # Handle client messages if needed
-            pass
+            try:
+                request = json.loads(message)
+            except ValueError:
+                continue
+            if not isinstance(request, dict):
+                continue
+            kind = request.get('type')
+            if kind == 'hello' and valid_hello(request) and request.get('protocol', 1) >= PROTOCOL_VERSION:
+                session.variant = negotiate_variant(request.get('encoding'), request.get('layout'))
+                if isinstance(request.get('subscribe'), dict) and not subscribe_client(session, request['subscribe']):
+                    continue
+                session.start_delta_protocol(request.get('epoch'), request.get('last_seq'))
+            elif kind == 'subscribe':
+                if subscribe_client(session, request):
+                    session.start_delta_protocol()
+            elif kind == 'resync' and session.protocol >= PROTOCOL_VERSION:
+                session.start_delta_protocol()
     except websockets.exceptions.ConnectionClosed:
         pass
     finally:
-        connected_clients.remove(websocket)
+        session.close()
+        connected_clients.pop(websocket, None)
         print(f"✗ Client disconnected: {client_addr} (total: {len(connected_clients)})")
 
 
-async def broadcast(data):
-    """Broadcast data to all connected clients"""
-    if not connected_clients:
-        return
+async def broadcast(data, stream=None):
+    """Publish a snapshot to every subscription group and wake the senders of
+    their clients (and feed the worker processes); never waits on a client.
+    A worker passes the collector's (epoch, seq) as ``stream``."""
+    subscriptions.publish(data, list(connected_clients.values()), stream)
+    if snapshot_feed is not None and snapshot_feed.seq != publisher.seq:
+        snapshot_feed.publish(publisher.epoch, publisher.seq, publisher.legacy_message().encode())
+
+
+# ── Poll Scheduler ──────────────────────────────────────────────────
+
+class PollSchedule:
+    """When one collector runs next, and how long it may take.
+
+    The interval adapts to the data: after a run that changed something it
+    halves (down to ``min_interval``), after a run that changed nothing it
+    grows by half (up to ``max_interval``).  Sources that change often are
+    refreshed at their fastest rate, quiet or expensive ones drift towards
+    their slowest.
+    """
+
+    __slots__ = ('name', 'interval', 'min_interval', 'max_interval', 'timeout', 'next_run')
+
+    def __init__(self, name, interval, min_interval, max_interval, timeout):
+        self.name = name
+        self.min_interval = min_interval
+        self.max_interval = max(max_interval, min_interval)
+        self.interval = min(max(interval, self.min_interval), self.max_interval)
+        self.timeout = timeout
+        self.next_run = 0.0
 
-    message = json.dumps(data)
-    dead_clients = set()
+    def due(self, now: float) -> bool:
+        return now >= self.next_run
 
-    for client in connected_clients:
+    def record(self, now: float, changed: bool) -> None:
+        if changed:
+            self.interval = max(self.min_interval, self.interval / 2)
+        else:
+            self.interval = min(self.max_interval, self.interval * 1.5)
+        self.next_run = now + self.interval
+
+    def failed(self, now: float) -> None:
+        """Run timed out or errored — retry after the current interval, unadapted"""
+        self.next_run = now + self.interval
+
+
+class PollScheduler:
+    """Per-collector poll schedules for ami_monitor_loop.
+
+    Defaults below can be overridden per collector in config.json under
+    ``realtime.collectors``, e.g. ``{"presence": {"interval": 60, "max": 300}}``.
+    Channels, endpoints and queues are normally kept by the event listener;
+    their schedule only applies while it is down (otherwise the table's own
+    reconcile interval does).
+    """
+
+    # name: (interval, min, max, timeout) in seconds
+    DEFAULTS = {
+        'channels':  (2,                  1,  10,  5),
+        'endpoints': (5,                  2,  30,  5),
+        'queues':    (2,                  1,  10,  5),
+        'presence':  (30,                 10, 120, 5),   # FOP2 pushes changes as UserEvents
+        'db':        (DB_RELOAD_INTERVAL, 10, 120, 10),
+    }
+
+    def __init__(self, overrides=None):
+        overrides = overrides or {}
+        self.schedules: Dict[str, PollSchedule] = {}
+        for name, (interval, low, high, timeout) in self.DEFAULTS.items():
+            conf = overrides.get(name, {})
+            self.schedules[name] = PollSchedule(
+                name,
+                float(conf.get('interval', interval)),
+                float(conf.get('min', low)),
+                float(conf.get('max', high)),
+                float(conf.get('timeout', timeout)),
+            )
+
+    def __getitem__(self, name) -> PollSchedule:
+        return self.schedules[name]
+
+    def next_run(self, names) -> float:
+        return min(self.schedules[name].next_run for name in names)
+
+    async def run(self, name, coro):
+        """Await a collector coroutine under its timeout (None on timeout)"""
+        schedule = self.schedules[name]
         try:
-            await client.send(message)
-        except:
-            dead_clients.add(client)
+            return await asyncio.wait_for(coro, timeout=schedule.timeout)
+        except asyncio.TimeoutError:
+            print(f"⚠ Collector '{name}' timed out after {schedule.timeout:g}s")
+            return None
+
+    def describe(self) -> str:
+        return ', '.join(f"{s.name}={s.interval:g}s" for s in self.schedules.values())
+
 
-    # Remove dead clients
-    for client in dead_clients:
-        connected_clients.discard(client)
+# What counts as a change for each AMI collector's result (durations and
+# wait times tick every second and are ignored)
+COLLECTOR_FINGERPRINTS = {
+    'channels':  lambda dump: {(ch['uniqueid'], ch['channel'], ch['state'], ch['bridgeid']) for ch in dump},
+    'endpoints': lambda states: states,
+    'queues':    lambda _: {name: (q['calls_waiting'], q['total_members'], q['available_members'],
+                                   q['paused_members'], q['busy_members'], q['completed'], q['abandoned'])
+                            for name, q in queue_collector.queues.items()},
+    'presence':  lambda presence: presence,
+}
 
 
 async def ami_monitor_loop():
     """Main AMI monitoring loop"""
-    global last_db_reload, presence_states
+    global presence_states, presence_polled_at
 
     ami = None
     last_channel_count = 0
     ami_just_connected = False
+    scheduler = PollScheduler(COLLECTOR_CONFIG)
+    fingerprints = {}
+    print(f"✓ Poll schedule: {scheduler.describe()}")
 
     while True:
         try:
@@ -1125,68 +2303,84 @@ async def ami_monitor_loop():
                 ami_just_connected = False
                 print(f"✓ Seeded presence for {len(initial)} extensions from AstDB")
 
-            # Get channels and extension states
-            channels = await ami.get_channels()
-            extension_states = await ami.get_extension_states()
-            queue_status = await ami.get_queue_status()
-            paused_extensions = await ami.get_queue_paused_members()
-
-            # Poll AstDB for presence every cycle — reliable fallback for missed events.
-            # detect_presence_changes() compares against presence_prev to detect transitions
-            # and update break_history without double-counting.
-            polled_presence = await ami.get_presence_states()
+            # Every collector runs on its own schedule; whatever is due this
+            # round is pipelined on the one connection (written at once and
+            # answered by ActionID), so a round costs about one round trip.
+            # Channels, queues and extension status come from the event
+            # listener; while it is up their dumps only reconcile the tables
+            # on the tables' own intervals, while it is down they are polled
+            # on their schedules.
+            # The AstDB presence poll is a reliable fallback for missed
+            # FOP2ASTDB events: detect_presence_changes() compares against
+            # presence_prev to detect transitions and update break_history
+            # without double-counting.
+            poll_started = time.time()
+            due = {}
+            for name, table, collect in (
+                ('channels',  channel_table,   ami.get_channels),
+                ('endpoints', extension_state, ami.get_extension_states),
+                ('queues',    queue_state,     lambda: queue_collector.collect(ami)),
+            ):
+                if table.needs_reconcile(poll_started) and (table.live or scheduler[name].due(poll_started)):
+                    due[name] = collect()
+            if scheduler['presence'].due(poll_started):
+                due['presence'] = ami.get_presence_states()
+
+            names = list(due)
+            results = dict(zip(names, await asyncio.gather(
+                *(scheduler.run(name, due[name]) for name in names))))
+            if not ami.connected:
+                raise ConnectionError('AMI connection lost during poll')
+
+            if results.get('channels') is not None:
+                channel_table.reconcile(results['channels'], poll_started)
+            if results.get('endpoints') is not None:
+                extension_state.reconcile(results['endpoints'], poll_started)
+            if results.get('queues'):
+                queue_state.load(queue_collector.queues, poll_started)
+
+            polled_presence = results.get('presence')
             if polled_presence:
+                presence_polled_at = time.time()
                 detect_presence_changes(polled_presence)
                 presence_states.update(polled_presence)
 
-            current_count = len(channels)
-
-            # Reload DB stats on hangup or periodically
-            current_time = time.time()
-            if (last_channel_count > 0 and current_count < last_channel_count) or (current_time - last_db_reload >= DB_RELOAD_INTERVAL):
-                load_db_stats()
-                last_db_reload = current_time
+            # Adapt each schedule to whether its source changed since its last run
+            finished = time.time()
+            round_changed = False
+            for name in names:
+                if results[name] is None or results[name] is False:
+                    scheduler[name].failed(finished)
+                    continue
+                fingerprint = COLLECTOR_FINGERPRINTS[name](results[name])
+                changed = fingerprint != fingerprints.get(name)
+                scheduler[name].record(finished, changed)
+                fingerprints[name] = fingerprint
+                round_changed = round_changed or changed
 
-            last_channel_count = current_count
+            current_count = len(channel_table.channels)
 
-            data = process_channels(channels, extension_states, paused_extensions, presence_states)
-
-            # Enrich KPI entries with break history data
-            today_str = datetime.now().strftime('%Y-%m-%d')
-            now_dt    = datetime.now()
-            for kpi in data.get('extension_kpis', []):
-                ext       = kpi.get('extension', '')
-                hist      = [e for e in break_history.get(ext, []) if e.get('date') == today_str]
-                completed = [e for e in hist if e['end'] is not None]
-                open_brk  = next((e for e in reversed(hist) if e['end'] is None), None)
-                break_secs = sum(e['duration'] or 0 for e in completed)
-                if open_brk:
-                    try:
-                        start_dt = datetime.strptime(f"{today_str} {open_brk['start']}", '%Y-%m-%d %H:%M:%S')
-                        break_secs += max(0, int((now_dt - start_dt).total_seconds()))
-                    except Exception:
-                        pass
-                kpi['breaks_today']        = len(hist)
-                kpi['break_seconds_today'] = break_secs
-                kpi['break_history']       = [
-                    {
-                        'start':    e['start'],
-                        'end':      e['end'] or '(ongoing)',
-                        'duration': e['duration'],
-                        'subtype':  e.get('subtype', ''),
-                        'note':     e.get('note', ''),
-                    }
-                    for e in hist
-                ]
-
-            # Add queue data
-            data['queues'] = process_queue_data(queue_status)
+            # Reload DB stats on hangup or on schedule
+            # (in the background: the loader pushes when the stats changed)
+            db_loader.start(scheduler['db'])
+            if last_channel_count > 0 and current_count < last_channel_count:
+                db_loader.request(after_hangup=True)
 
-            await broadcast(data)
+            last_channel_count = current_count
 
-            print(f"[{datetime.now().strftime('%H:%M:%S')}] Active: {data['active_calls']}, Channels: {data['total_channels']}, Extensions: {len(data['extension_kpis'])}, Clients: {len(connected_clients)}")
+            # Push what this round changed (event-driven changes are pushed
+            # by the event listener)
+            if round_changed or not push_trigger.ready:
+                push_trigger.ready = True
+                push_trigger.mark()
 
-            await asyncio.sleep(2)
+            # Sleep until the next collector is due, checking for hangups at
+            # least every BROADCAST_INTERVAL
+            polled = ['presence'] + [name for name, table in (
+                ('channels', channel_table), ('endpoints', extension_state), ('queues', queue_state))
+                if not table.live]
+            wake = min(scheduler.next_run(polled), time.time() + BROADCAST_INTERVAL)
+            await asyncio.sleep(max(0.05, wake - time.time()))
 
         except Exception as e:
             print(f"✗ Monitor loop error: {e}")
@@ -1196,6 +2390,119 @@ async def ami_monitor_loop():
             await asyncio.sleep(5)
 
 
+# ── Snapshot Push ───────────────────────────────────────────────────
+
+class PushTrigger:
+    """Wakes snapshot_pusher when anything a snapshot is built from changed"""
+
+    def __init__(self):
+        self.ready = False           # first AMI round done: there is something to show
+        self._event = asyncio.Event()
+
+    def mark(self) -> None:
+        self._event.set()
+
+    def clear(self) -> None:
+        self._event.clear()
+
+    async def wait(self, timeout: float) -> bool:
+        """True when marked, False when ``timeout`` passed without a change"""
+        try:
+            await asyncio.wait_for(self._event.wait(), timeout=timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+
+push_trigger = PushTrigger()
+
+
+def assemble_snapshot() -> Dict[str, Any]:
+    """Build the snapshot clients receive from the current live state"""
+    data = process_channels(channel_table.snapshot(), extension_state.states,
+                            queue_state.paused_extensions, presence_states)
+
+    # Enrich KPI entries with break history data
+    today_str = datetime.now().strftime('%Y-%m-%d')
+    now_dt    = datetime.now()
+    for kpi in data.get('extension_kpis', []):
+        ext       = kpi.get('extension', '')
+        hist      = [e for e in break_history.get(ext, []) if e.get('date') == today_str]
+        completed = [e for e in hist if e['end'] is not None]
+        open_brk  = next((e for e in reversed(hist) if e['end'] is None), None)
+        break_secs = sum(e['duration'] or 0 for e in completed)
+        if open_brk:
+            try:
+                start_dt = datetime.strptime(f"{today_str} {open_brk['start']}", '%Y-%m-%d %H:%M:%S')
+                break_secs += max(0, int((now_dt - start_dt).total_seconds()))
+            except Exception:
+                pass
+        kpi['breaks_today']        = len(hist)
+        kpi['break_seconds_today'] = break_secs
+        kpi['break_history']       = [
+            {
+                'start':    e['start'],
+                'end':      e['end'] or '(ongoing)',
+                'duration': e['duration'],
+                'subtype':  e.get('subtype', ''),
+                'note':     e.get('note', ''),
+            }
+            for e in hist
+        ]
+
+    # Add queue data
+    data['queues'] = process_queue_data(queue_state.queues)
+    data['freshness'] = snapshot_freshness(data['timestamp'])
+    data['db_refresh'] = db_loader.coordinator.metrics()
+    return data
+
+
+def snapshot_freshness(now: float) -> Dict[str, int]:
+    """When each source of the snapshot was last known to be current (unix
+    time).  Event-fed tables are current while the event listener is up,
+    otherwise as of their last successful poll; while AMI is down clients
+    keep getting the last data, and these show how old it is."""
+    def seen(table, polled_at):
+        return int(now if table.live else max(polled_at, listener_lost_at))
+
+    return {
+        'channels':   seen(channel_table, channel_table.last_reconcile),
+        'extensions': seen(extension_state, extension_state.last_reconcile),
+        'queues':     seen(queue_state, queue_state.last_reconcile),
+        'presence':   seen(channel_table, presence_polled_at),
+        'db_stats':   int(db_stats_loaded_at),
+    }
+
+
+async def snapshot_pusher():
+    """Push a snapshot shortly after state changes, and at least every
+    BROADCAST_INTERVAL so durations and wait times keep ticking (a
+    heartbeat that only moves the clock is not pushed, see
+    SnapshotPublisher._clock_only).
+
+    The first change of a burst opens a PUSH_COALESCE_MS window; everything
+    that changes within it goes out in the same push, so latency stays under
+    the window however busy the PBX is and clients are never flooded.
+    """
+    last_log = 0.0
+    while True:
+        if await push_trigger.wait(BROADCAST_INTERVAL):
+            await asyncio.sleep(PUSH_COALESCE_MS / 1000.0)
+        push_trigger.clear()
+        if not push_trigger.ready:
+            continue
+        try:
+            data = assemble_snapshot()
+            await broadcast(data)
+        except Exception as e:
+            print(f"✗ Snapshot push error: {e}")
+            continue
+
+        if time.time() - last_log >= BROADCAST_INTERVAL:
+            last_log = time.time()
+            print(f"[{datetime.now().strftime('%H:%M:%S')}] Active: {data['active_calls']}, Channels: {data['total_channels']}, Extensions: {len(data['extension_kpis'])}, Clients: {len(connected_clients)}")
+
+
 # ── Queue Log Watcher ───────────────────────────────────────────────
 
 async def parse_queue_log_history():
@@ -1491,8 +2798,22 @@ async def parse_full_log_history():
         print(f"⚠ FullLog parse error: {e}")
 
 
+# Events the listener acts on.  After login they are sent as an AMI Filter,
+# so Asterisk drops the rest of the subscribed classes (Newexten, VarSet, ...)
+# before they reach the socket and the frame parser.  The filter is a regex
+# on the event text, so a name also lets through events it prefixes
+# (Hangup -> HangupRequest); those are ignored as before.  Asterisk before 10
+# has no Filter action, and it needs the system write permission: either
+# way the response is an error and the listener keeps receiving everything.
+LISTENER_EVENTS = sorted(CHANNEL_EVENTS | QUEUE_EVENTS | EXTENSION_EVENTS | {'UserEvent'})
+LISTENER_FILTER_ID = 'rt-listener-filter'
+
+
 async def ami_event_listener():
-    """Dedicated AMI connection — watches FOP2ASTDB, PeerStatus, ContactStatus."""
+    """Dedicated AMI connection — watches FOP2ASTDB, PeerStatus, ContactStatus
+    and the channel/queue/device events that keep channel_table, queue_state
+    and extension_state current."""
+    global listener_lost_at
     while True:
         writer = None
         try:
@@ -1501,50 +2822,76 @@ async def ami_event_listener():
 
             login = (
                 f"Action: Login\r\nUsername: {AMI_USER}\r\nSecret: {AMI_SECRET}\r\n"
-                f"Events: system,user\r\n\r\n"
+                f"Events: system,call,agent,user\r\n\r\n"
             )
             writer.write(login.encode())
             await writer.drain()
 
             # Read login response
-            resp = b""
-            while b"\r\n\r\n" not in resp:
-                resp += await asyncio.wait_for(reader.read(4096), timeout=5)
-            if b"Success" not in resp:
+            parser = AMIFrameParser()
+            frames = []
+            while not frames:
+                chunk = await asyncio.wait_for(reader.read(4096), timeout=5)
+                if not chunk:
+                    raise ConnectionError('connection closed during login')
+                frames = parser.feed(chunk)
+            if frames[0].get('Response') != 'Success':
                 print("✗ AMI event listener login failed")
                 await asyncio.sleep(10)
                 continue
 
-            print("✓ AMI event listener connected — watching FOP2ASTDB + PeerStatus + ContactStatus")
-            buf = b""
+            print("✓ AMI event listener connected — watching FOP2ASTDB + PeerStatus + ContactStatus + channels + queues + device states")
+            writer.write((
+                f"Action: Filter\r\nActionID: {LISTENER_FILTER_ID}\r\nOperation: Add\r\n"
+                f"Filter: Event: ({'|'.join(LISTENER_EVENTS)})\r\n\r\n"
+            ).encode())
+            await writer.drain()
+            channel_table.attach()
+            queue_state.attach()
+            extension_state.attach()
 
             while True:
                 try:
-                    chunk = await asyncio.wait_for(reader.read(4096), timeout=60)
+                    chunk = await asyncio.wait_for(reader.read(65536), timeout=60)
                 except asyncio.TimeoutError:
                     continue   # keepalive timeout — connection still alive
                 if not chunk:
                     break
-                buf += chunk
 
-                # Process every complete event (double CRLF separator)
-                while b"\r\n\r\n" in buf:
-                    raw, buf = buf.split(b"\r\n\r\n", 1)
-                    fields = {}
-                    for line in raw.decode('utf-8', errors='replace').split('\r\n'):
-                        if ':' in line:
-                            k, _, v = line.partition(':')
-                            fields[k.strip()] = v.strip()
+                # Process every complete event in this read
+                versions = (channel_table.version, queue_state.version, extension_state.version)
+                presence_changed = False
+                for fields in parser.feed(chunk):
+                    if fields.get('ActionID') == LISTENER_FILTER_ID:
+                        if fields.get('Response') == 'Success':
+                            print(f"✓ AMI event filter active ({len(LISTENER_EVENTS)} event types)")
+                        else:
+                            print(f"⚠ AMI event filter unavailable ({fields.get('Message', 'error')}), "
+                                  f"receiving the full event classes")
+                        continue
+                    evt = fields.event
 
-                    evt = fields.get('Event', '')
+                    # ── Extension / device state (PeerStatus and ContactStatus
+                    #    are also logged as LOGIN/LOGOUT below) ──
+                    if evt in EXTENSION_EVENTS:
+                        extension_state.apply_event(evt, fields)
+
+                    # ── Live channel table ──
+                    if evt in CHANNEL_EVENTS:
+                        channel_table.apply_event(evt, fields)
+
+                    # ── Queue state ──
+                    elif evt in QUEUE_EVENTS:
+                        queue_state.apply_event(evt, fields)
 
                     # ── FOP2 Presence ──
-                    if evt == 'UserEvent' and fields.get('UserEvent') == 'FOP2ASTDB':
+                    elif evt == 'UserEvent' and fields.get('UserEvent') == 'FOP2ASTDB':
                         key   = fields.get('Key',   '')   # e.g. "PJSIP/102"
                         value = fields.get('Value', '')   # e.g. "Break"
                         ext   = re.sub(r'^(PJSIP|SIP)/', '', key, flags=re.IGNORECASE)
                         if ext.isdigit():
                             apply_fop2_event(ext, value)
+                            presence_changed = True
                             # Persist to agent_event
                             new_state, subtype = fop2_value_to_state(value)
                             if new_state in ('away', 'xa', 'dnd'):
@@ -1593,10 +2940,19 @@ async def ami_event_listener():
                                                           extra=f"ContactStatus:{aor}:{status}")
                                 print(f"[AMI] LOGOUT ext={ext} ({status})")
 
+                if presence_changed or versions != (channel_table.version, queue_state.version,
+                                                    extension_state.version):
+                    push_trigger.mark()
+
         except Exception as e:
             print(f"⚠ AMI event listener error: {e}")
             await asyncio.sleep(5)
         finally:
+            if channel_table.live:
+                listener_lost_at = time.time()
+            channel_table.detach()
+            queue_state.detach()
+            extension_state.detach()
             if writer:
                 try:
                     writer.close()
@@ -1604,19 +2960,143 @@ async def ami_event_listener():
                     pass
 
 
+# ── HTTP Snapshot ───────────────────────────────────────────────────
+# GET /snapshot on the WebSocket port, for wallboards and pages that poll.
+# Query parameters filter like a subscription (comma-separated topics,
+# queues, extensions); responses come from the same publishers as the
+# WebSocket clients, so polling never touches AMI or the database.
+
+def _comma_list(query, name):
+    values = query.get(name)
+    if values is None:
+        return None
+    return [item for value in values for item in value.split(',') if item]
+
+
+def _content_coding(accept_encoding: str) -> str:
+    """Preferred coding we have for an Accept-Encoding header"""
+    accepted = set()
+    for part in accept_encoding.split(','):
+        coding, _, params = part.strip().partition(';')
+        if params.replace(' ', '') not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            accepted.add(coding.strip().lower())
+    if BROTLI_AVAILABLE and 'br' in accepted:
+        return 'br'
+    if 'gzip' in accepted:
+        return 'gzip'
+    return 'identity'
+
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in tags or etag in tags or 'W/' + etag in tags
+
+
+async def serve_http_snapshot(path: str, request_headers):
+    """websockets process_request hook: answers GET /snapshot and lets every
+    other request continue to the WebSocket handshake"""
+    url = urlsplit(path)
+    if url.path.rstrip('/') != '/snapshot':
+        return None
+    headers = [('Cache-Control', 'no-cache'), ('Access-Control-Allow-Origin', '*')]
+    query = parse_qs(url.query)
+    try:
+        subscription = Subscription.parse({name: _comma_list(query, name)
+                                           for name in ('topics', 'queues', 'extensions')})
+    except (TypeError, ValueError) as e:
+        return HTTPStatus.BAD_REQUEST, headers, f"{e}\n".encode()
+
+    group = subscriptions.publisher_for(subscription, keep=False)
+    if group.data is None:
+        return HTTPStatus.SERVICE_UNAVAILABLE, headers + [('Retry-After', '1')], b'no snapshot yet\n'
+
+    headers += [('ETag', group.etag), ('Vary', 'Accept-Encoding')]
+    if _etag_matches(request_headers.get('If-None-Match', ''), group.etag):
+        return HTTPStatus.NOT_MODIFIED, headers, b''
+    coding = _content_coding(request_headers.get('Accept-Encoding', ''))
+    if coding != 'identity':
+        headers.append(('Content-Encoding', coding))
+    headers.append(('Content-Type', 'application/json'))
+    return HTTPStatus.OK, headers, group.http_body(coding)
+
+
+# ── Worker Processes ────────────────────────────────────────────────
+# With realtime.workers > 0 this process is the collector: it runs the AMI,
+# queue_log and DB tasks and feeds its snapshots to that many worker
+# processes (this script with --worker), which share the WebSocket port.
+
+async def supervise_workers(count: int):
+    """Start ``count`` WebSocket workers and restart any that exit"""
+    script = os.path.abspath(__file__)
+    workers = []
+    try:
+        while True:
+            for worker in [w for w in workers if w.poll() is not None]:
+                print(f"⚠ WebSocket worker {worker.pid} exited with code {worker.returncode}, restarting")
+                workers.remove(worker)
+            while len(workers) < count:
+                workers.append(subprocess.Popen([sys.executable, script, '--worker']))
+            await asyncio.sleep(5)
+    finally:
+        for worker in workers:
+            worker.terminate()
+
+
+async def follow_collector():
+    """Worker: broadcast every snapshot from the collector's feed to this
+    process's clients, reconnecting whenever the collector restarts"""
+    while True:
+        try:
+            reader, writer = await asyncio.open_unix_connection(COLLECTOR_SOCKET)
+        except OSError:
+            await asyncio.sleep(1)
+            continue
+        try:
+            epoch, seq, data = await read_frame(reader)
+            print(f"✓ Worker {os.getpid()} following collector at {COLLECTOR_SOCKET} (epoch {epoch}, seq {seq})")
+            while True:
+                await broadcast(data, (epoch, seq))
+                epoch, seq, data = await read_frame(reader)
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError) as e:
+            print(f"⚠ Worker {os.getpid()} lost the collector feed: {e!r}")
+        finally:
+            writer.close()
+        await asyncio.sleep(1)
+
+
+def ws_compression():
+    compression = 'deflate' if WS_COMPRESSION == 'deflate' else None
+    print(f"   permessage-deflate: {'on' if compression else 'off'}, "
+          f"encodings: {', '.join(CODECS)}")
+    return compression
+
+
+async def worker_main():
+    """Entry point of a WebSocket worker (--worker): serves clients from the
+    collector's feed and never touches AMI or the database"""
+    print(f"🌐 WebSocket worker {os.getpid()} on ws://{WS_HOST}:{WS_PORT}")
+    async with websockets.serve(handle_client, WS_HOST, WS_PORT, compression=ws_compression(),
+                                process_request=serve_http_snapshot, reuse_port=True):
+        await follow_collector()
+
+
 async def main():
     """Main entry point"""
+    global snapshot_feed
     print("\n" + "="*60)
     print("Asterisk Realtime WebSocket Service")
     print("="*60)
 
-    # Load initial DB stats (sync pymysql)
-    load_db_stats()
-
-    # Initialize async DB pool for agent_event table
+    # Initialize async DB pool for agent_event table and CDR stats
     await init_db_pool()
     await ensure_agent_event_table()
 
+    # Load initial DB stats
+    try:
+        await db_loader.load()
+    except Exception as e:
+        print(f"⚠ Database stats load failed: {e}")
+
     # One-shot: backfill historical logs (full log + queue_log) using shared processor
     script_dir = os.path.dirname(os.path.abspath(__file__))
     processor = os.path.join(script_dir, 'process-agent-logs.py')
@@ -1635,23 +3115,34 @@ async def main():
     except Exception as e:
         print(f"⚠ Log processor error: {e}")
 
+    # Run monitor loop, event listener, snapshot pusher and queue log watcher concurrently
+    collectors = [ami_monitor_loop(), ami_event_listener(), snapshot_pusher(), queue_log_watcher()]
+
+    if WS_WORKERS > 0:
+        snapshot_feed = FeedServer(COLLECTOR_SOCKET)
+        await snapshot_feed.start()
+        print(f"\n🌐 Collector feeding {WS_WORKERS} WebSocket workers via {COLLECTOR_SOCKET}")
+        try:
+            await asyncio.gather(*collectors, supervise_workers(WS_WORKERS))
+        finally:
+            db_loader.cancel()
+        return
+
     # Start WebSocket server
     print(f"\n🌐 Starting WebSocket server on ws://{WS_HOST}:{WS_PORT}")
-
-    async with websockets.serve(handle_client, WS_HOST, WS_PORT):
-        # Run monitor loop, event listener, and queue log watcher concurrently
-        await asyncio.gather(
-            ami_monitor_loop(),
-            ami_event_listener(),
-            queue_log_watcher(),
-        )
+    async with websockets.serve(handle_client, WS_HOST, WS_PORT, compression=ws_compression(),
+                                process_request=serve_http_snapshot):
+        try:
+            await asyncio.gather(*collectors)
+        finally:
+            db_loader.cancel()
 
 
 if __name__ == '__main__':
     # Python 3.6 compatibility - asyncio.run() was added in 3.7
     try:
         loop = asyncio.get_event_loop()
-        loop.run_until_complete(main())
+        loop.run_until_complete(worker_main() if '--worker' in sys.argv[1:] else main())
     except KeyboardInterrupt:
         print("\n\n✓ Shutdown complete")
     finally:
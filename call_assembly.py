@@ -0,0 +1,72 @@
+"""
+Call assembly: group channel legs into calls
+Shared by asterisk-realtime-websocket.py and asterisk-realtime-report.py
+
+Legs that share a Linkedid belong to the same call.  Legs that sit in the
+same bridge (BridgeId / BridgeUniqueid) or name each other as bridged peer
+(BridgedChannel, pre-12 Asterisk) are merged as well, which keeps attended
+transfers together.  Grouping is a single pass over the legs with a
+union-find over hash keys, so it costs O(channels) however many calls are up.
+"""
+
+from typing import Any, Dict, List, Tuple
+
+
+def _find(parent: Dict[str, str], key: str) -> str:
+    root = key
+    while parent[root] != root:
+        root = parent[root]
+    while parent[key] != root:          # path compression
+        parent[key], key = root, parent[key]
+    return root
+
+
+def _union(parent: Dict[str, str], a: str, b: str) -> None:
+    parent.setdefault(a, a)
+    parent.setdefault(b, b)
+    ra, rb = _find(parent, a), _find(parent, b)
+    if ra != rb:
+        parent[rb] = ra
+
+
+def leg_key(ch: Dict[str, Any]) -> str:
+    """Stable identity of one leg (Uniqueid, else channel name)"""
+    return ch.get('uniqueid') or ch['channel']
+
+
+def group_call_legs(channels: List[Dict[str, Any]]) -> List[Tuple[str, List[Dict[str, Any]]]]:
+    """Group channel legs into calls.
+
+    Returns ``[(call_id, legs), ...]`` in order of first appearance.  The call
+    id is the smallest Linkedid (else Uniqueid / channel name) among the legs,
+    so it stays the same from one cycle to the next while the call is up.
+    """
+    parent: Dict[str, str] = {}
+    for ch in channels:
+        node = 'C:' + ch['channel']
+        parent.setdefault(node, node)
+        if ch.get('linkedid'):
+            _union(parent, node, 'L:' + ch['linkedid'])
+        if ch.get('bridgeid'):
+            _union(parent, node, 'B:' + ch['bridgeid'])
+        if ch.get('bridged'):
+            _union(parent, node, 'C:' + ch['bridged'])
+
+    groups: Dict[str, List[Dict[str, Any]]] = {}
+    for ch in channels:
+        groups.setdefault(_find(parent, 'C:' + ch['channel']), []).append(ch)
+
+    calls = []
+    for legs in groups.values():
+        call_id = min(ch.get('linkedid') or leg_key(ch) for ch in legs)
+        calls.append((call_id, legs))
+    return calls
+
+
+def originating_leg(legs: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """The leg that started the call (its Uniqueid equals the Linkedid),
+    else the longest-running leg"""
+    for ch in legs:
+        if ch.get('linkedid') and ch.get('uniqueid') == ch['linkedid']:
+            return ch
+    return max(legs, key=lambda ch: ch.get('duration', 0))
@@ -0,0 +1,328 @@
+#!/usr/bin/env python3.6
+"""
+Add and maintain derived classification columns on the cdr table.
+
+Adds src_ext, dst_ext, is_gateway_src, is_gateway_dst and direction to cdr,
+with indexes on (calldate, src_ext) and (calldate, dst_ext), so queries can
+filter and group on them instead of running SUBSTRING_INDEX/LIKE/REGEXP on
+channel and dstchannel for every row.
+
+Run manually:
+    python3.6 cdr-columns.py                  # Show what is installed and whether it is current
+
+Or with options:
+    python3.6 cdr-columns.py --migrate        # Add columns, indexes and trigger; fill existing rows
+    python3.6 cdr-columns.py --reclassify     # After changing asterisk.gateways: update trigger, recompute all rows
+    python3.6 cdr-columns.py --drop           # Remove trigger, indexes and columns
+
+New rows are filled by a BEFORE INSERT trigger; existing rows are filled one
+day of calldate at a time, so the tool can be stopped and re-run (--migrate
+only touches rows it has not filled yet).  The trigger has the configured
+gateways written into it, which is why changing them needs --reclassify.
+
+Adding the columns rebuilds cdr on servers without instant ADD COLUMN; run
+--migrate outside business hours on large tables.
+
+    src_ext / dst_ext   extension of channel / dstchannel (numeric PJSIP/SIP
+                        endpoint), otherwise NULL
+    is_gateway_src/dst  1 when channel / dstchannel matches a configured gateway
+    direction           'inbound' when the caller side is a gateway, 'outbound'
+                        when only the callee side is, otherwise 'internal'
+"""
+
+import asyncio
+import json
+import re
+import sys
+from datetime import timedelta
+
+try:
+    import aiomysql
+except ImportError:
+    print("ERROR: aiomysql not installed. Install with: pip3 install aiomysql")
+    sys.exit(1)
+
+# ── Configuration ─────────────────────────────────────────────────
+
+CONFIG_FILE = '/var/www/html/supervisor2/config.json'
+try:
+    with open(CONFIG_FILE, 'r') as f:
+        CONFIG = json.load(f)
+        print("Loaded configuration from {}".format(CONFIG_FILE))
+except Exception as e:
+    print("Could not load config.json: {}".format(e))
+    CONFIG = {}
+
+DB_CONFIG_FILE = CONFIG.get('realtime', {}).get('dbConfigFile', '/etc/amportal.conf')
+TRIGGER_NAME   = 'cdr_derived_columns'
+
+# Same normalisation as the realtime service: match on the trunk name
+GATEWAYS = []
+for gw in CONFIG.get('asterisk', {}).get('gateways', ['PJSIP/we']):
+    if 'PJSIP/' in gw:
+        GATEWAYS.append(gw.replace('PJSIP/', ''))
+    elif 'SIP/' in gw:
+        GATEWAYS.append(gw.replace('SIP/', ''))
+    elif gw:
+        GATEWAYS.append(gw)
+
+COLUMNS = [
+    ('src_ext',        "VARCHAR(20) DEFAULT NULL"),
+    ('dst_ext',        "VARCHAR(20) DEFAULT NULL"),
+    ('is_gateway_src', "TINYINT(1) DEFAULT NULL"),
+    ('is_gateway_dst', "TINYINT(1) DEFAULT NULL"),
+    ('direction',      "ENUM('inbound','outbound','internal') DEFAULT NULL"),
+]
+
+INDEXES = [
+    ('idx_calldate_src_ext', '`calldate`, `src_ext`'),
+    ('idx_calldate_dst_ext', '`calldate`, `dst_ext`'),
+]
+
+db_pool = None
+
+
+# ── DB helpers ────────────────────────────────────────────────────
+
+def get_db_config():
+    """Parse DB credentials from FreePBX/amportal config file."""
+    db_config = {'host': 'localhost', 'user': 'root', 'password': '', 'db': 'asteriskcdrdb', 'port': 3306}
+    try:
+        with open(DB_CONFIG_FILE, 'r') as f:
+            for line in f:
+                line = line.strip()
+                if '=' in line and not line.startswith('#'):
+                    key, value = line.split('=', 1)
+                    key, value = key.strip(), value.strip().strip('"').strip("'")
+                    if key == 'AMPDBHOST':   db_config['host'] = value
+                    elif key == 'AMPDBUSER': db_config['user'] = value
+                    elif key == 'AMPDBPASS': db_config['password'] = value
+                    elif key == 'AMPDBPORT': db_config['port'] = int(value) if value.isdigit() else 3306
+    except Exception:
+        pass
+    return db_config
+
+
+async def init_db_pool():
+    """Create aiomysql connection pool."""
+    global db_pool
+    cfg = get_db_config()
+    try:
+        db_pool = await aiomysql.create_pool(
+            host=cfg['host'], port=cfg['port'],
+            user=cfg['user'], password=cfg['password'],
+            db=cfg['db'], minsize=1, maxsize=1,
+            autocommit=True
+        )
+        print("DB pool created ({}:{}/{})".format(cfg['host'], cfg['port'], cfg['db']))
+    except Exception as e:
+        print("Failed to create DB pool: {}".format(e))
+        sys.exit(1)
+
+
+async def query(sql, args=None):
+    async with db_pool.acquire() as conn:
+        async with conn.cursor(aiomysql.DictCursor) as cur:
+            await cur.execute(sql, args)
+            return await cur.fetchall()
+
+
+async def execute(sql, args=None):
+    async with db_pool.acquire() as conn:
+        async with conn.cursor() as cur:
+            return await cur.execute(sql, args)
+
+
+# ── Classification SQL ────────────────────────────────────────────
+# The same expressions fill new rows (in the trigger, on NEW.<column>) and
+# existing ones (in UPDATE, on the bare column).
+
+def check_gateways():
+    """Gateway names are written into SQL literals and the trigger comment."""
+    bad = [gw for gw in GATEWAYS if not re.match(r'^[A-Za-z0-9_.-]+$', gw)]
+    if bad:
+        print("ERROR: unsupported characters in gateway name(s): {}".format(bad))
+        sys.exit(2)
+
+
+def ext_sql(col):
+    """SUBSTRING_INDEX(SUBSTRING_INDEX(col, '/', -1), '-', 1) of a numeric PJSIP/SIP endpoint."""
+    ext = "SUBSTRING_INDEX(SUBSTRING_INDEX({}, '/', -1), '-', 1)".format(col)
+    return "CASE WHEN {c} REGEXP '^(PJSIP|SIP)/[0-9]' AND {e} REGEXP '^[0-9]+$' THEN {e} END".format(c=col, e=ext)
+
+
+def gateway_sql(col):
+    if not GATEWAYS:
+        return "0"
+    return "(" + " OR ".join("IFNULL({}, '') LIKE '%{}%'".format(col, gw) for gw in GATEWAYS) + ")"
+
+
+def assignments(prefix=''):
+    """(column, expression) pairs; ``prefix`` is 'NEW.' inside the trigger."""
+    channel, dstchannel = prefix + 'channel', prefix + 'dstchannel'
+    gw_src, gw_dst = gateway_sql(channel), gateway_sql(dstchannel)
+    return [
+        ('src_ext', ext_sql(channel)),
+        ('dst_ext', ext_sql(dstchannel)),
+        ('is_gateway_src', gw_src),
+        ('is_gateway_dst', gw_dst),
+        ('direction', "CASE WHEN {} THEN 'inbound' WHEN {} THEN 'outbound' ELSE 'internal' END".format(gw_src, gw_dst)),
+    ]
+
+
+def gateway_marker():
+    return "gateways: {}".format(','.join(GATEWAYS))
+
+
+def trigger_sql():
+    body = "\n".join("    SET NEW.{} = {};".format(col, expr) for col, expr in assignments('NEW.'))
+    return ("CREATE TRIGGER `{}` BEFORE INSERT ON `cdr` FOR EACH ROW\n"
+            "BEGIN\n    /* {} */\n{}\nEND".format(TRIGGER_NAME, gateway_marker(), body))
+
+
+# ── Schema inspection ─────────────────────────────────────────────
+
+async def installed():
+    """Which of our columns and indexes exist, and the trigger's gateway marker."""
+    columns = {row['COLUMN_NAME'] for row in await query(
+        "SELECT COLUMN_NAME FROM information_schema.COLUMNS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'cdr'")}
+    indexes = {row['INDEX_NAME'] for row in await query(
+        "SELECT DISTINCT INDEX_NAME FROM information_schema.STATISTICS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'cdr'")}
+    rows = await query(
+        "SELECT ACTION_STATEMENT FROM information_schema.TRIGGERS "
+        "WHERE TRIGGER_SCHEMA = DATABASE() AND TRIGGER_NAME = %s", (TRIGGER_NAME,))
+    marker = None
+    if rows:
+        match = re.search(r'/\*\s*(gateways:[^*]*?)\s*\*/', rows[0]['ACTION_STATEMENT'] or '')
+        marker = match.group(1) if match else ''
+    return ({name for name, _ in COLUMNS if name in columns},
+            {name for name, _ in INDEXES if name in indexes},
+            marker)
+
+
+async def status():
+    columns, indexes, marker = await installed()
+    print("Gateways (config): {}".format(GATEWAYS))
+    print("Columns:  {}/{} ({})".format(len(columns), len(COLUMNS), ', '.join(sorted(columns)) or 'none'))
+    print("Indexes:  {}/{} ({})".format(len(indexes), len(INDEXES), ', '.join(sorted(indexes)) or 'none'))
+    if marker is None:
+        print("Trigger:  missing")
+    elif marker != gateway_marker():
+        print("Trigger:  OUTDATED ({}), run --reclassify".format(marker or 'no gateway marker'))
+    else:
+        print("Trigger:  current")
+    if 'direction' in columns:
+        rows = await query("SELECT 1 FROM cdr WHERE direction IS NULL LIMIT 1")
+        print("Rows:     {}".format('some not filled yet, run --migrate' if rows else 'all filled'))
+
+
+# ── Migration ─────────────────────────────────────────────────────
+
+async def add_schema():
+    """Add the missing columns and indexes in one ALTER TABLE."""
+    columns, indexes, _ = await installed()
+    parts = ["ADD COLUMN `{}` {}".format(name, ddl) for name, ddl in COLUMNS if name not in columns]
+    parts += ["ADD INDEX `{}` ({})".format(name, cols) for name, cols in INDEXES if name not in indexes]
+    if not parts:
+        print("Columns and indexes already present")
+        return
+    print("Altering cdr ({} change(s)), this can take a while on a large table...".format(len(parts)))
+    await execute("ALTER TABLE `cdr` " + ", ".join(parts))
+    print("Columns and indexes added")
+
+
+async def install_trigger():
+    await execute("DROP TRIGGER IF EXISTS `{}`".format(TRIGGER_NAME))
+    await execute(trigger_sql())
+    print("Trigger {} installed ({})".format(TRIGGER_NAME, gateway_marker()))
+
+
+async def fill_rows(only_missing):
+    """Compute the columns for existing rows, one calldate day per statement."""
+    bounds = await query("SELECT DATE(MIN(calldate)) AS first, DATE(MAX(calldate)) AS last FROM cdr")
+    first, last = bounds[0]['first'], bounds[0]['last']
+    if first is None:
+        print("cdr is empty, nothing to fill")
+        return
+    # Parameters follow, so the LIKE patterns' % must be doubled for pymysql
+    sets = ", ".join("`{}` = {}".format(col, expr.replace('%', '%%')) for col, expr in assignments())
+    sql = "UPDATE cdr SET {} WHERE calldate >= %s AND calldate < %s".format(sets)
+    if only_missing:
+        sql += " AND direction IS NULL"
+    total = 0
+    day = first
+    while day <= last:
+        rows = await execute(sql, (day, day + timedelta(days=1)))
+        total += rows
+        if rows:
+            print("[Fill] {}: {} rows".format(day, rows))
+        day += timedelta(days=1)
+    print("Filled {} rows ({} .. {})".format(total, first, last))
+
+
+async def drop_schema():
+    await execute("DROP TRIGGER IF EXISTS `{}`".format(TRIGGER_NAME))
+    columns, indexes, _ = await installed()
+    parts = ["DROP INDEX `{}`".format(name) for name, _ in INDEXES if name in indexes]
+    parts += ["DROP COLUMN `{}`".format(name) for name, _ in COLUMNS if name in columns]
+    if parts:
+        await execute("ALTER TABLE `cdr` " + ", ".join(parts))
+    print("Trigger, indexes and columns removed")
+
+
+# ── Main ──────────────────────────────────────────────────────────
+
+async def run(mode):
+    await init_db_pool()
+    try:
+        if mode == 'migrate':
+            await add_schema()
+            await install_trigger()      # before filling, so rows inserted meanwhile are covered
+            await fill_rows(only_missing=True)
+        elif mode == 'reclassify':
+            columns, _, _ = await installed()
+            if len(columns) < len(COLUMNS):
+                print("ERROR: columns missing, run --migrate first")
+                sys.exit(1)
+            await install_trigger()
+            await fill_rows(only_missing=False)
+        elif mode == 'drop':
+            await drop_schema()
+        else:
+            await status()
+    finally:
+        db_pool.close()
+        await db_pool.wait_closed()
+
+
+def main():
+    if '--help' in sys.argv or '-h' in sys.argv:
+        print(__doc__)
+        sys.exit(0)
+
+    modes = [mode for mode in ('migrate', 'reclassify', 'drop') if '--' + mode in sys.argv]
+    if len(modes) > 1:
+        print("ERROR: choose one of --migrate, --reclassify, --drop")
+        sys.exit(2)
+    mode = modes[0] if modes else 'status'
+    check_gateways()
+
+    print("=" * 60)
+    print("CDR Derived Columns")
+    print("=" * 60)
+    print("Mode: {}".format(mode.upper()))
+    print("")
+
+    loop = asyncio.get_event_loop()
+    try:
+        loop.run_until_complete(run(mode))
+    except KeyboardInterrupt:
+        print("\nAborted.")
+    finally:
+        loop.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,358 @@
+#!/usr/bin/env python3.6
+"""
+Roll CDR rows up into the extension_daily_stats table.
+
+One row per day, hour, extension, direction (inbound/outbound/internal) and
+disposition, holding the call count and talk time, so KPI pages and services
+can read a few hundred small rows instead of scanning the cdr table with
+string functions on channel/dstchannel.
+
+Run as a worker (keeps the recent hours up to date):
+    python3.6 cdr-rollup.py
+
+Or with options:
+    python3.6 cdr-rollup.py --once                              # One pass and exit (e.g. from cron)
+    python3.6 cdr-rollup.py --backfill 2026-01-15               # Rebuild one past day
+    python3.6 cdr-rollup.py --backfill 2026-01-01 2026-01-31    # Rebuild a range of days
+
+Each hour's buckets are rebuilt as a whole from that hour's CDR rows, and
+extension_daily_stats_hours records how many cdr rows they were built from.
+A pass counts the cdr rows per hour (an index range scan on calldate) and
+only rebuilds hours whose count changed, so new rows are picked up without
+re-reading anything else.  A CDR row is written when its call ends but is
+dated when it started, so a pass looks back `rollup.windowHours` hours, and
+every `rollup.recheckInterval` seconds back to the start of yesterday, which
+catches calls longer than the window.  Older days only change via --backfill.
+"""
+
+import asyncio
+import json
+import sys
+import time
+from datetime import date, datetime, timedelta
+
+try:
+    import aiomysql
+except ImportError:
+    print("ERROR: aiomysql not installed. Install with: pip3 install aiomysql")
+    sys.exit(1)
+
+from cdr_stats import classify
+
+# ── Configuration ─────────────────────────────────────────────────
+
+CONFIG_FILE = '/var/www/html/supervisor2/config.json'
+try:
+    with open(CONFIG_FILE, 'r') as f:
+        CONFIG = json.load(f)
+        print("Loaded configuration from {}".format(CONFIG_FILE))
+except Exception as e:
+    print("Could not load config.json: {}".format(e))
+    CONFIG = {}
+
+DB_CONFIG_FILE   = CONFIG.get('realtime', {}).get('dbConfigFile', '/etc/amportal.conf')
+ROLLUP_INTERVAL  = CONFIG.get('rollup', {}).get('interval', 60)           # seconds between passes
+WINDOW_HOURS     = CONFIG.get('rollup', {}).get('windowHours', 3)         # hours each pass looks back
+RECHECK_INTERVAL = CONFIG.get('rollup', {}).get('recheckInterval', 3600)  # seconds between yesterday rechecks
+LOCK_NAME        = 'extension_daily_stats'
+LOCK_TIMEOUT     = 60
+
+# Same normalisation as the realtime service: match on the trunk name
+GATEWAYS = []
+for gw in CONFIG.get('asterisk', {}).get('gateways', ['PJSIP/we']):
+    if 'PJSIP/' in gw:
+        GATEWAYS.append(gw.replace('PJSIP/', '').lower())
+    elif 'SIP/' in gw:
+        GATEWAYS.append(gw.replace('SIP/', '').lower())
+    elif gw:
+        GATEWAYS.append(gw.lower())
+
+db_pool = None
+
+
+# ── DB helpers ────────────────────────────────────────────────────
+
+def get_db_config():
+    """Parse DB credentials from FreePBX/amportal config file."""
+    db_config = {'host': 'localhost', 'user': 'root', 'password': '', 'db': 'asteriskcdrdb', 'port': 3306}
+    try:
+        with open(DB_CONFIG_FILE, 'r') as f:
+            for line in f:
+                line = line.strip()
+                if '=' in line and not line.startswith('#'):
+                    key, value = line.split('=', 1)
+                    key, value = key.strip(), value.strip().strip('"').strip("'")
+                    if key == 'AMPDBHOST':   db_config['host'] = value
+                    elif key == 'AMPDBUSER': db_config['user'] = value
+                    elif key == 'AMPDBPASS': db_config['password'] = value
+                    elif key == 'AMPDBPORT': db_config['port'] = int(value) if value.isdigit() else 3306
+    except Exception:
+        pass
+    return db_config
+
+
+async def init_db_pool():
+    """Create aiomysql connection pool."""
+    global db_pool
+    cfg = get_db_config()
+    try:
+        db_pool = await aiomysql.create_pool(
+            host=cfg['host'], port=cfg['port'],
+            user=cfg['user'], password=cfg['password'],
+            db=cfg['db'], minsize=1, maxsize=2,
+            autocommit=True
+        )
+        print("DB pool created ({}:{}/{})".format(cfg['host'], cfg['port'], cfg['db']))
+    except Exception as e:
+        print("Failed to create DB pool: {}".format(e))
+        sys.exit(1)
+
+
+async def ensure_rollup_tables():
+    """Create extension_daily_stats and its bookkeeping table if they don't exist."""
+    stats_sql = """
+    CREATE TABLE IF NOT EXISTS `extension_daily_stats` (
+        `stat_date`   DATE             NOT NULL,
+        `hour`        TINYINT UNSIGNED NOT NULL,
+        `extension`   VARCHAR(20)      NOT NULL,
+        `direction`   ENUM('inbound','outbound','internal') NOT NULL,
+        `disposition` VARCHAR(32)      NOT NULL,
+        `calls`       INT UNSIGNED     NOT NULL DEFAULT 0,
+        `billsec`     BIGINT UNSIGNED  NOT NULL DEFAULT 0,
+        `duration`    BIGINT UNSIGNED  NOT NULL DEFAULT 0,
+        `first_call`  DATETIME         DEFAULT NULL,
+        `last_call_end` DATETIME       DEFAULT NULL,
+        PRIMARY KEY (`stat_date`, `hour`, `extension`, `direction`, `disposition`),
+        INDEX `idx_ext_date` (`extension`, `stat_date`)
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+    """
+    hours_sql = """
+    CREATE TABLE IF NOT EXISTS `extension_daily_stats_hours` (
+        `stat_date` DATE             NOT NULL,
+        `hour`      TINYINT UNSIGNED NOT NULL,
+        `cdr_rows`  INT UNSIGNED     NOT NULL,
+        `rolled_at` DATETIME         NOT NULL,
+        PRIMARY KEY (`stat_date`, `hour`)
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+    """
+    try:
+        async with db_pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(stats_sql)
+                await cur.execute(hours_sql)
+        print("extension_daily_stats tables ready")
+    except Exception as e:
+        print("ensure_rollup_tables error: {}".format(e))
+        sys.exit(1)
+
+
+# ── Rollup ────────────────────────────────────────────────────────
+
+def bucket_rows(rows):
+    """Per (extension, direction, disposition) totals of one hour's cdr rows."""
+    buckets = {}
+    for row in rows:
+        disposition = row['disposition'] or ''
+        if disposition == 'NOANSWER':
+            disposition = 'NO ANSWER'
+        billsec = int(row['billsec'] or 0)
+        start = row['calldate']
+        end = start + timedelta(seconds=billsec)
+        for ext, direction in classify(row['channel'], row['dstchannel'], GATEWAYS):
+            b = buckets.get((ext, direction, disposition))
+            if b is None:
+                b = buckets[(ext, direction, disposition)] = {
+                    'calls': 0, 'billsec': 0, 'duration': 0, 'first_call': start, 'last_call_end': end}
+            b['calls'] += 1
+            b['billsec'] += billsec
+            b['duration'] += int(row['duration'] or 0)
+            b['first_call'] = min(b['first_call'], start)
+            b['last_call_end'] = max(b['last_call_end'], end)
+    return buckets
+
+
+async def changed_hours(cur, since, until):
+    """(day, hour, cdr_rows) of the hours in [since, until) whose cdr row count
+    differs from what their buckets were built from."""
+    await cur.execute(
+        "SELECT DATE(calldate) AS d, HOUR(calldate) AS h, COUNT(*) AS n FROM cdr "
+        "WHERE calldate >= %s AND calldate < %s GROUP BY d, h", (since, until))
+    counts = {(row['d'], row['h']): row['n'] for row in await cur.fetchall()}
+    await cur.execute(
+        "SELECT stat_date, hour, cdr_rows FROM extension_daily_stats_hours "
+        "WHERE stat_date BETWEEN %s AND %s", (since.date(), until.date()))
+    rolled = {}
+    for row in await cur.fetchall():
+        start = datetime.combine(row['stat_date'], datetime.min.time()) + timedelta(hours=row['hour'])
+        if since <= start < until:
+            rolled[(row['stat_date'], row['hour'])] = row['cdr_rows']
+    return sorted((day, hour, counts.get((day, hour), 0))
+                  for day, hour in set(counts) | set(rolled)
+                  if counts.get((day, hour), 0) != rolled.get((day, hour)))
+
+
+async def rebuild_hour(conn, day, hour):
+    """Replace the buckets of one hour with ones built from its cdr rows, in
+    one transaction.  Returns the number of cdr rows read."""
+    start = datetime.combine(day, datetime.min.time()) + timedelta(hours=hour)
+    async with conn.cursor(aiomysql.DictCursor) as cur:
+        await conn.begin()
+        try:
+            await cur.execute(
+                "SELECT calldate, channel, dstchannel, disposition, billsec, duration FROM cdr "
+                "WHERE calldate >= %s AND calldate < %s", (start, start + timedelta(hours=1)))
+            rows = await cur.fetchall()
+            buckets = bucket_rows(rows)
+            await cur.execute("DELETE FROM extension_daily_stats WHERE stat_date = %s AND hour = %s", (day, hour))
+            if buckets:
+                await cur.executemany(
+                    "INSERT INTO extension_daily_stats (stat_date, hour, extension, direction, disposition, "
+                    "calls, billsec, duration, first_call, last_call_end) "
+                    "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)",
+                    [(day, hour, ext, direction, disposition, b['calls'], b['billsec'], b['duration'],
+                      b['first_call'], b['last_call_end'])
+                     for (ext, direction, disposition), b in buckets.items()])
+            await cur.execute(
+                "REPLACE INTO extension_daily_stats_hours (stat_date, hour, cdr_rows, rolled_at) "
+                "VALUES (%s, %s, %s, NOW())", (day, hour, len(rows)))
+            await conn.commit()
+        except BaseException:
+            await conn.rollback()
+            raise
+    return len(rows)
+
+
+async def with_lock(work):
+    """Run work(conn) holding the rollup lock, so a backfill and the worker
+    never rebuild the same hour at once."""
+    async with db_pool.acquire() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute("SELECT GET_LOCK(%s, %s)", (LOCK_NAME, LOCK_TIMEOUT))
+            if (await cur.fetchone())[0] != 1:
+                raise RuntimeError("could not get the {} lock within {}s".format(LOCK_NAME, LOCK_TIMEOUT))
+        try:
+            return await work(conn)
+        finally:
+            async with conn.cursor() as cur:
+                await cur.execute("SELECT RELEASE_LOCK(%s)", (LOCK_NAME,))
+
+
+async def rollup_pass(since):
+    """Rebuild every hour since ``since`` that has new cdr rows."""
+    async def work(conn):
+        until = datetime.now().replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+        async with conn.cursor(aiomysql.DictCursor) as cur:
+            hours = await changed_hours(cur, since, until)
+        for day, hour, _ in hours:
+            await rebuild_hour(conn, day, hour)
+        return hours
+
+    hours = await with_lock(work)
+    if hours:
+        print("[{}] Rolled up {} hour(s): {}".format(
+            datetime.now().strftime('%H:%M:%S'), len(hours),
+            ', '.join('{} {:02d}h ({} rows)'.format(day, hour, n) for day, hour, n in hours)))
+    return hours
+
+
+async def backfill(first, last):
+    """Rebuild every hour of the days from ``first`` to ``last``."""
+    day = first
+    while day <= last:
+        async def work(conn, day=day):
+            return sum([await rebuild_hour(conn, day, hour) for hour in range(24)])
+        rows = await with_lock(work)
+        print("[Backfill] {}: {} cdr rows".format(day, rows))
+        day += timedelta(days=1)
+
+
+async def worker(once=False):
+    """Roll up the recent hours every ROLLUP_INTERVAL seconds, and from the
+    start of yesterday at start-up and every RECHECK_INTERVAL seconds."""
+    last_recheck = None
+    while True:
+        now = time.time()
+        if last_recheck is None or now - last_recheck >= RECHECK_INTERVAL:
+            since = datetime.combine(date.today() - timedelta(days=1), datetime.min.time())
+            last_recheck = now
+        else:
+            since = datetime.now().replace(minute=0, second=0, microsecond=0) - timedelta(hours=WINDOW_HOURS)
+        try:
+            await rollup_pass(since)
+        except Exception as e:
+            if once:
+                raise
+            print("Rollup pass error: {}".format(e))
+        if once:
+            return
+        await asyncio.sleep(ROLLUP_INTERVAL)
+
+
+# ── Main ──────────────────────────────────────────────────────────
+
+async def run(once=False, backfill_range=None):
+    await init_db_pool()
+    await ensure_rollup_tables()
+    try:
+        if backfill_range:
+            await backfill(*backfill_range)
+        else:
+            await worker(once=once)
+    finally:
+        db_pool.close()
+        await db_pool.wait_closed()
+
+
+def parse_backfill_range():
+    """Dates following --backfill: FROM [TO]."""
+    args = sys.argv[sys.argv.index('--backfill') + 1:]
+    dates = []
+    for arg in args[:2]:
+        if arg.startswith('--'):
+            break
+        dates.append(datetime.strptime(arg, '%Y-%m-%d').date())
+    if not dates:
+        raise ValueError("--backfill needs a date (YYYY-MM-DD)")
+    first, last = dates[0], dates[-1]
+    if last < first:
+        raise ValueError("--backfill range ends before it starts")
+    return first, last
+
+
+def main():
+    if '--help' in sys.argv or '-h' in sys.argv:
+        print(__doc__)
+        sys.exit(0)
+
+    once = '--once' in sys.argv
+    backfill_range = None
+    if '--backfill' in sys.argv:
+        try:
+            backfill_range = parse_backfill_range()
+        except ValueError as e:
+            print("ERROR: {}".format(e))
+            sys.exit(2)
+
+    print("=" * 60)
+    print("CDR Extension Rollup")
+    print("=" * 60)
+    if backfill_range:
+        print("Mode: BACKFILL {} .. {}".format(*backfill_range))
+    elif once:
+        print("Mode: single pass")
+    else:
+        print("Mode: worker (every {}s, {}h window)".format(ROLLUP_INTERVAL, WINDOW_HOURS))
+    print("Gateways: {}".format(GATEWAYS))
+    print("")
+
+    loop = asyncio.get_event_loop()
+    try:
+        loop.run_until_complete(run(once=once, backfill_range=backfill_range))
+    except KeyboardInterrupt:
+        print("\nAborted.")
+    finally:
+        loop.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,390 @@
+"""
+Incremental CDR aggregation for today's per-extension stats
+Shared by asterisk-realtime-websocket.py and asterisk-realtime-report.py
+(the report service only uses RefreshCoordinator, CDRWatermark and
+landed_query) and by cdr-rollup.py (classify)
+
+Re-aggregating every CDR row of the day on each refresh costs more the later
+it gets.  CDRAccumulator keeps today's totals in memory instead, and each
+refresh only reads rows that can be new since the last one.
+
+A CDR row is written when its call ends, but its calldate is when the call
+started, so rows do not arrive in calldate order.  A row that has not been
+written yet belongs to a call that is still up or ended moments ago, so its
+calldate is no older than the oldest such call: that is the low-water mark
+kept by CDRWatermark, and each refresh re-reads the rows at or after it.
+Rows already folded in are remembered by (uniqueid, sequence) until the mark
+passes them, so re-reading one never counts it twice.
+
+A full load aggregates everything before the mark in SQL, as the service
+always did, and reads the rest as rows.  Hours that cdr-rollup.py has rolled
+up from as many cdr rows as the hour has now are read from
+extension_daily_stats instead (rollup_hours_query, rollup_query), so only
+the hours since then are aggregated from cdr.  It runs at start-up, when the day
+changes (so counters start from zero after midnight), when the mark moves
+back past what the aggregate covered, and periodically as a safety net.
+
+Classification follows the original query: a row counts for the extension
+of its channel (outbound when the other side is a configured gateway) and
+for the extension of its dstchannel (inbound when the caller is a gateway);
+anything else is internal.
+"""
+
+import re
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+_SIP = re.compile(r'(?:PJSIP|SIP)/', re.IGNORECASE)             # REGEXP '^(PJSIP|SIP)/.*'
+_SIP_NUMERIC = re.compile(r'(?:PJSIP|SIP)/[0-9]', re.IGNORECASE)  # REGEXP '^(PJSIP|SIP)/[0-9]+'
+
+COUNTERS = ('total_calls', 'answered_calls', 'missed_calls', 'total_duration',
+            'inbound_calls', 'outbound_calls', 'internal_calls')
+
+
+def _gateway_like(gateways: Iterable[str]) -> str:
+    # Quadruple %: f-string resolves %% to %, then pymysql resolves %% to %
+    return " OR ".join([f"channel LIKE '%%%%{gw}%%%%' OR dstchannel LIKE '%%%%{gw}%%%%'" for gw in gateways])
+
+
+def aggregate_query(gateways: Iterable[str], day: date, until: datetime,
+                    start: Optional[datetime] = None) -> Tuple[str, tuple]:
+    """Per-extension totals of ``day``'s CDR rows before ``until`` (and at or
+    after ``start``, by default midnight), as ``(sql, params)``"""
+    gateway_like = _gateway_like(gateways)
+    query = f"""
+    SELECT
+        extension,
+        SUM(total_calls) as total_calls,
+        SUM(answered_calls) as answered_calls,
+        SUM(total_duration) as total_duration,
+        SUM(missed_calls) as missed_calls,
+        SUM(inbound_calls) as inbound_calls,
+        SUM(outbound_calls) as outbound_calls,
+        SUM(internal_calls) as internal_calls,
+        MIN(first_call_start) as first_call_start,
+        MAX(last_call_end) as last_call_end
+    FROM (
+        SELECT
+            SUBSTRING_INDEX(SUBSTRING_INDEX(channel, '/', -1), '-', 1) AS extension,
+            COUNT(*) as total_calls,
+            SUM(CASE WHEN disposition = 'ANSWERED' THEN 1 ELSE 0 END) as answered_calls,
+            SUM(billsec) as total_duration,
+            SUM(CASE WHEN disposition IN ('NO ANSWER', 'NOANSWER') THEN 1 ELSE 0 END) as missed_calls,
+            SUM(CASE WHEN ({gateway_like}) AND dstchannel REGEXP '^(PJSIP|SIP)/.*' THEN 1 ELSE 0 END) as outbound_calls,
+            0 as inbound_calls,
+            SUM(CASE WHEN NOT ({gateway_like}) OR dstchannel NOT REGEXP '^(PJSIP|SIP)/.*' THEN 1 ELSE 0 END) as internal_calls,
+            MIN(calldate) as first_call_start,
+            MAX(DATE_ADD(calldate, INTERVAL billsec SECOND)) as last_call_end
+        FROM cdr
+        WHERE calldate >= %s AND calldate < %s
+        AND (channel LIKE 'PJSIP/%%%%' OR channel LIKE 'SIP/%%%%')
+        AND channel REGEXP '^(PJSIP|SIP)/[0-9]+'
+        GROUP BY extension
+
+        UNION ALL
+
+        SELECT
+            SUBSTRING_INDEX(SUBSTRING_INDEX(dstchannel, '/', -1), '-', 1) AS extension,
+            COUNT(*) as total_calls,
+            SUM(CASE WHEN disposition = 'ANSWERED' AND dstchannel REGEXP '^(PJSIP|SIP)/[0-9]+' THEN 1 ELSE 0 END) as answered_calls,
+            SUM(billsec) as total_duration,
+            SUM(CASE WHEN disposition IN ('NO ANSWER', 'NOANSWER') THEN 1 ELSE 0 END) as missed_calls,
+            0 as outbound_calls,
+            SUM(CASE WHEN ({gateway_like}) AND channel REGEXP '^(PJSIP|SIP)/.*' THEN 1 ELSE 0 END) as inbound_calls,
+            SUM(CASE WHEN NOT ({gateway_like}) OR channel NOT REGEXP '^(PJSIP|SIP)/.*' THEN 1 ELSE 0 END) as internal_calls,
+            MIN(calldate) as first_call_start,
+            MAX(DATE_ADD(calldate, INTERVAL billsec SECOND)) as last_call_end
+        FROM cdr
+        WHERE calldate >= %s AND calldate < %s
+        AND (dstchannel LIKE 'PJSIP/%%%%' OR dstchannel LIKE 'SIP/%%%%')
+        AND dstchannel REGEXP '^(PJSIP|SIP)/[0-9]+'
+        GROUP BY extension
+    ) combined
+    WHERE extension REGEXP '^[0-9]+$'
+    GROUP BY extension
+    """
+    if start is None:
+        start = datetime.combine(day, datetime.min.time())
+    return query, (start, until, start, until)
+
+
+def rollup_hours_query(day: date, until: datetime) -> Tuple[str, tuple]:
+    """Per hour of ``day`` before ``until``: how many cdr rows it has now
+    (``n``, an index range count on calldate) and how many extension_daily_stats
+    was built from (``rolled``, NULL if not rolled up)"""
+    query = """
+    SELECT c.h AS hour, c.n AS n, r.cdr_rows AS rolled
+    FROM (
+        SELECT HOUR(calldate) AS h, COUNT(*) AS n
+        FROM cdr
+        WHERE calldate >= %s AND calldate < %s
+        GROUP BY h
+    ) c
+    LEFT JOIN extension_daily_stats_hours r ON r.stat_date = %s AND r.hour = c.h
+    """
+    start = datetime.combine(day, datetime.min.time())
+    return query, (start, until, day)
+
+
+def rolled_up_until(day: date, until: datetime, hours: List[Dict[str, Any]]) -> datetime:
+    """End of the run of whole hours from midnight, before ``until``, whose
+    extension_daily_stats buckets are current (rollup_hours_query() rows;
+    an hour with no cdr rows needs no buckets)"""
+    counts = {row['hour']: (row['n'], row['rolled']) for row in hours}
+    start = datetime.combine(day, datetime.min.time())
+    hour = 0
+    while hour < 24 and start + timedelta(hours=hour + 1) <= until:
+        n, rolled = counts.get(hour, (0, 0))
+        if n and n != rolled:
+            break
+        hour += 1
+    return start + timedelta(hours=hour)
+
+
+def rollup_query(day: date, hours: int) -> Tuple[str, tuple]:
+    """extension_daily_stats totals of ``day``'s first ``hours`` hours, per
+    extension, direction and disposition"""
+    query = """
+    SELECT extension, direction, disposition,
+           SUM(calls) AS calls, SUM(billsec) AS billsec,
+           MIN(first_call) AS first_call_start, MAX(last_call_end) AS last_call_end
+    FROM extension_daily_stats
+    WHERE stat_date = %s AND hour < %s
+    GROUP BY extension, direction, disposition
+    """
+    return query, (day, hours)
+
+
+def rows_query(day: date, since: datetime) -> Tuple[str, tuple]:
+    """``day``'s CDR rows at or after ``since`` that involve an extension"""
+    query = """
+    SELECT calldate, channel, dstchannel, disposition, billsec, uniqueid, sequence
+    FROM cdr
+    WHERE calldate >= %s AND calldate < %s
+    AND (channel REGEXP '^(PJSIP|SIP)/[0-9]+' OR dstchannel REGEXP '^(PJSIP|SIP)/[0-9]+')
+    """
+    end = datetime.combine(day, datetime.min.time()) + timedelta(days=1)
+    return query, (since, end)
+
+
+def landed_query(since: datetime) -> Tuple[str, tuple]:
+    """Cheap probe for newly written CDR rows: how many rows have a calldate
+    at or after ``since`` (an index range count on calldate)"""
+    return "SELECT COUNT(*) AS n FROM cdr WHERE calldate >= %s", (since,)
+
+
+def _extension(channel: str) -> Optional[str]:
+    """SUBSTRING_INDEX(SUBSTRING_INDEX(channel, '/', -1), '-', 1), if numeric"""
+    ext = channel.rsplit('/', 1)[-1].split('-', 1)[0]
+    return ext if ext.isdigit() else None
+
+
+def classify(channel: Optional[str], dstchannel: Optional[str],
+             gateways: List[str]) -> List[Tuple[str, str]]:
+    """``(extension, direction)`` pairs a CDR row counts for, direction being
+    'inbound', 'outbound' or 'internal'; ``gateways`` lowercased"""
+    channel, dstchannel = channel or '', dstchannel or ''
+    gateway = any(gw in c.lower() for gw in gateways for c in (channel, dstchannel))
+    pairs = []
+    if _SIP_NUMERIC.match(channel):
+        ext = _extension(channel)
+        if ext:
+            pairs.append((ext, 'outbound' if gateway and _SIP.match(dstchannel) else 'internal'))
+    if _SIP_NUMERIC.match(dstchannel):
+        ext = _extension(dstchannel)
+        if ext:
+            pairs.append((ext, 'inbound' if gateway and _SIP.match(channel) else 'internal'))
+    return pairs
+
+
+class CDRAccumulator:
+    """One day's per-extension totals, built from an aggregate and then
+    updated row by row"""
+
+    def __init__(self, day: date, gateways: Iterable[str]):
+        self.day = day
+        self.gateways = [gw.lower() for gw in gateways if gw]
+        self.floor: Optional[datetime] = None    # rows before this are in the aggregate
+        self.totals: Dict[str, Dict[str, Any]] = {}
+        self.seen: Dict[Tuple[str, Any], datetime] = {}
+
+    def _entry(self, ext: str) -> Dict[str, Any]:
+        entry = self.totals.get(ext)
+        if entry is None:
+            entry = self.totals[ext] = dict.fromkeys(COUNTERS, 0)
+            entry['first_call_start'] = entry['last_call_end'] = None
+        return entry
+
+    def _span(self, entry: Dict[str, Any], first: Optional[datetime], last: Optional[datetime]) -> None:
+        if first is not None and (entry['first_call_start'] is None or first < entry['first_call_start']):
+            entry['first_call_start'] = first
+        if last is not None and (entry['last_call_end'] is None or last > entry['last_call_end']):
+            entry['last_call_end'] = last
+
+    def add_totals(self, rows: List[Dict[str, Any]], floor: datetime) -> None:
+        """Fold in aggregate_query() rows covering everything before ``floor``"""
+        self.floor = floor
+        for row in rows:
+            ext = row['extension'].replace('PJSIP/', '').replace('SIP/', '')
+            if not ext.isdigit():
+                continue
+            entry = self._entry(ext)
+            for counter in COUNTERS:
+                entry[counter] += int(row[counter] or 0)
+            self._span(entry, row.get('first_call_start'), row.get('last_call_end'))
+
+    def add_rollup(self, rows: List[Dict[str, Any]]) -> None:
+        """Fold in rollup_query() rows (the same classification as fold())"""
+        for row in rows:
+            entry = self._entry(row['extension'])
+            calls = int(row['calls'] or 0)
+            entry['total_calls'] += calls
+            entry['total_duration'] += int(row['billsec'] or 0)
+            if row['disposition'] == 'ANSWERED':
+                entry['answered_calls'] += calls
+            elif row['disposition'] in ('NO ANSWER', 'NOANSWER'):
+                entry['missed_calls'] += calls
+            entry[row['direction'] + '_calls'] += calls
+            self._span(entry, row['first_call_start'], row['last_call_end'])
+
+    def _count(self, ext, row, billsec, direction) -> None:
+        entry = self._entry(ext)
+        entry['total_calls'] += 1
+        entry['total_duration'] += billsec
+        if row['disposition'] == 'ANSWERED':
+            entry['answered_calls'] += 1
+        elif row['disposition'] in ('NO ANSWER', 'NOANSWER'):
+            entry['missed_calls'] += 1
+        entry[direction] += 1
+        self._span(entry, row['calldate'], row['calldate'] + timedelta(seconds=billsec))
+
+    def fold(self, rows: List[Dict[str, Any]]) -> int:
+        """Fold in rows_query() rows not seen yet; returns how many were new"""
+        added = 0
+        for row in rows:
+            key = (row['uniqueid'], row['sequence'])
+            if key in self.seen:
+                continue
+            self.seen[key] = row['calldate']
+            added += 1
+            billsec = int(row['billsec'] or 0)
+            for ext, direction in classify(row['channel'], row['dstchannel'], self.gateways):
+                self._count(ext, row, billsec, direction + '_calls')
+        return added
+
+    def forget_before(self, since: datetime) -> None:
+        """Drop remembered rows that will not be read again"""
+        self.seen = {key: calldate for key, calldate in self.seen.items() if calldate >= since}
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """Totals in the extension_stats_db format"""
+        return {
+            ext: {
+                'total_calls_today': entry['total_calls'],
+                'answered_today': entry['answered_calls'],
+                'missed_today': entry['missed_calls'],
+                'total_duration_today': entry['total_duration'],
+                'inbound_today': entry['inbound_calls'],
+                'outbound_today': entry['outbound_calls'],
+                'internal_today': entry['internal_calls'],
+                'first_call_start': entry['first_call_start'].strftime('%H:%M:%S') if entry['first_call_start'] else '',
+                'last_call_end': entry['last_call_end'].strftime('%H:%M:%S') if entry['last_call_end'] else '',
+            }
+            for ext, entry in self.totals.items()
+        }
+
+
+class CDRWatermark:
+    """Oldest calldate a CDR row still to be written can have.
+
+    Fed with the start times of the live channels on every refresh.  Rows
+    written after the previous refresh belong to calls that ended at most
+    ``settle`` seconds before it (CDR rows are written as calls end).  So a
+    channel stays in the reckoning until it was seen gone ``settle`` seconds
+    before the previous refresh, and since a call that came and went between
+    two refreshes started after the refresh before its end, that refresh is
+    kept for as long too.
+    """
+
+    def __init__(self, settle: float, slack: float = 5):
+        self.settle = settle
+        self.slack = slack           # whole-second calldates, start times estimated from durations
+        self._channels: Dict[str, List[Optional[float]]] = {}   # uid -> [started, gone_at]
+        self._refreshes: List[float] = []
+
+    def update(self, start_times: Dict[str, float], now: float) -> datetime:
+        horizon = (self._refreshes[-1] if self._refreshes else now) - self.settle
+        for uid, started in start_times.items():
+            self._channels[uid] = [started, None]
+        for uid, entry in list(self._channels.items()):
+            if uid not in start_times:
+                if entry[1] is None:
+                    entry[1] = now
+                elif entry[1] <= horizon:
+                    del self._channels[uid]
+        while len(self._refreshes) > 1 and self._refreshes[1] <= horizon:
+            self._refreshes.pop(0)
+        self._refreshes.append(now)
+        oldest = min([self._refreshes[0]] + [started for started, _ in self._channels.values()])
+        return datetime.fromtimestamp(oldest - self.slack).replace(microsecond=0)
+
+
+class RefreshCoordinator:
+    """Merges stats refresh triggers into one refresh at a time.
+
+    trigger() asks for a refresh; triggers arriving while one is pending are
+    merged into it and counted as skipped, and a trigger while a refresh runs
+    leaves one trailing refresh pending.  ready() says when the pending one
+    may run: no sooner than ``min_interval`` after the previous one started
+    and, when a hangup asked for it, once the call's CDR row has landed
+    (the caller probes with landed_query()) or ``landing_timeout`` passed.
+    """
+
+    def __init__(self, min_interval: float, landing_timeout: float):
+        self.min_interval = min_interval
+        self.landing_timeout = landing_timeout
+        self.pending_since: Optional[float] = None   # first trigger not served yet
+        self.awaiting_cdr = False
+        self.last_started = 0.0
+        self.triggers = 0
+        self.skipped = 0
+        self.refreshes = 0
+        self.landing_timeouts = 0
+
+    @property
+    def pending(self) -> bool:
+        return self.pending_since is not None
+
+    def trigger(self, now: float, after_hangup: bool = False) -> None:
+        self.triggers += 1
+        if self.pending:
+            self.skipped += 1
+        else:
+            self.pending_since = now
+        self.awaiting_cdr = self.awaiting_cdr or after_hangup
+
+    def holdoff(self, now: float) -> float:
+        """Seconds until the minimum spacing allows the next refresh"""
+        return max(0.0, self.last_started + self.min_interval - now)
+
+    def ready(self, now: float, landed: bool = False) -> bool:
+        if not self.pending or self.holdoff(now) > 0:
+            return False
+        if self.awaiting_cdr and not landed:
+            if now - self.pending_since < self.landing_timeout:
+                return False
+            self.landing_timeouts += 1
+        return True
+
+    def started(self, now: float) -> None:
+        self.pending_since = None
+        self.awaiting_cdr = False
+        self.last_started = now
+        self.refreshes += 1
+
+    def metrics(self) -> Dict[str, int]:
+        return {'triggers': self.triggers, 'skipped': self.skipped,
+                'refreshes': self.refreshes, 'landing_timeouts': self.landing_timeouts}
+
+    def describe(self) -> str:
+        return ', '.join(f"{name} {value}" for name, value in self.metrics().items())
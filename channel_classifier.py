@@ -0,0 +1,59 @@
+"""
+Channel name classifier
+Shared by asterisk-realtime-websocket.py and asterisk-realtime-report.py
+
+Classifies a channel name such as "PJSIP/1001-0000002a" or "PJSIP/we-00000031"
+in one pass: technology, extension number and configured gateway.  The
+gateway patterns from config.json are compiled once into a single regex and
+results are cached per channel name, so the realtime loop does not repeat
+the string scans for every leg on every cycle.
+"""
+
+import re
+from collections import namedtuple
+from typing import Collection, Iterable
+
+ChannelClass = namedtuple('ChannelClass', 'kind technology extension gateway')
+"""kind: 'gateway' | 'extension' | 'other'; technology: 'PJSIP', 'SIP', 'Local', ...;
+extension: digits of a SIP/PJSIP peer name or None; gateway: matched gateway or None"""
+
+SIP_TECHNOLOGIES = ('SIP', 'PJSIP')
+
+_EXTENSION_RE = re.compile(r'(?:PJSIP|SIP)/(\d+)')
+
+
+class ChannelClassifier:
+    """Precompiled gateway/extension classifier with a per-channel-name cache"""
+
+    def __init__(self, gateways: Iterable[str]):
+        patterns = sorted({gw.lower() for gw in gateways if gw}, key=len, reverse=True)
+        self.gateway_re = re.compile('|'.join(re.escape(gw) for gw in patterns)) if patterns else None
+        self._cache = {}
+
+    def classify(self, channel: str) -> ChannelClass:
+        result = self._cache.get(channel)
+        if result is None:
+            technology = channel.partition('/')[0] if '/' in channel else ''
+            match = self.gateway_re.search(channel.lower()) if self.gateway_re else None
+            gateway = match.group(0) if match else None
+            ext_match = _EXTENSION_RE.search(channel)
+            extension = ext_match.group(1) if ext_match else None
+            if gateway:
+                kind = 'gateway'
+            elif extension:
+                kind = 'extension'
+            else:
+                kind = 'other'
+            result = self._cache[channel] = ChannelClass(kind, technology, extension, gateway)
+        return result
+
+    def is_sip(self, channel: str) -> bool:
+        return self.classify(channel).technology in SIP_TECHNOLOGIES
+
+    def prune(self, live_channels: Collection[str]) -> None:
+        """Drop cached names of channels that are gone.  Cheap to call every
+        cycle: the cache is only rebuilt once it has grown well past the
+        number of live channels."""
+        if len(self._cache) > 2 * len(live_channels) + 256:
+            live = set(live_channels)
+            self._cache = {name: cls for name, cls in self._cache.items() if name in live}
@@ -0,0 +1,247 @@
+"""
+Snapshot deltas for the realtime WebSocket protocol
+Used by asterisk-realtime-websocket.py
+
+A realtime snapshot is a dict of scalars (active_calls, timestamp, ...) plus
+three keyed sections: calls (by call_id), extension_kpis (by extension) and
+queues (by name).  Instead of resending the whole snapshot every tick, the
+service sends a delta with only what changed:
+
+    {"set":    {scalar: value, ...},
+     "unset":  [scalar, ...],
+     "<section>": {"upsert": [entry, ...],     # added or changed entries, whole
+                   "remove": [key, ...],       # keys that are gone
+                   "order":  [key, ...]}}      # only when the key order changed
+
+Every scalar and entry is kept as a Fragment: the object plus its encodings.
+The next snapshot re-encodes an entry only when it no longer compares equal
+to that object, and messages are assembled by joining the cached fragments,
+so encoding cost follows the number of changed entries rather than the
+number of extensions.  This relies on published entries never being mutated
+afterwards; producers build fresh dicts (and copy nested lists) for every
+snapshot.
+
+Messages come in variants of codec and layout (see Variant):
+  codec   "json" (text frames) or "msgpack" (binary frames, needs msgpack)
+  layout  "objects" (a list of dicts per section) or "columns", where a
+          section (and a delta's upserts) is {"fields": [...], "rows": [[...]]}
+          so the keys are sent once instead of once per entry
+"""
+
+import json
+import struct
+from collections import namedtuple
+from typing import Any, Dict, List, Optional
+
+try:
+    import msgpack
+    MSGPACK_AVAILABLE = True
+except ImportError:
+    MSGPACK_AVAILABLE = False
+
+SECTIONS = {
+    'calls': 'call_id',
+    'extension_kpis': 'extension',
+    'queues': 'name',
+}
+
+
+# ── Codecs ───────────────────────────────────────────────────────────
+# value() encodes a Python value; array() and mapping() wrap fragments that
+# are already encoded, which is what lets messages be joined from caches.
+
+class JSONCodec:
+    name = 'json'
+    binary = False
+
+    @staticmethod
+    def value(value: Any) -> str:
+        return json.dumps(value, separators=(',', ':'))
+
+    @staticmethod
+    def array(items) -> str:
+        return '[' + ','.join(items) + ']'
+
+    @classmethod
+    def mapping(cls, pairs) -> str:
+        return '{' + ','.join(f"{cls.value(key)}:{item}" for key, item in pairs) + '}'
+
+
+def _msgpack_header(count: int, fix: int, code16: int, code32: int) -> bytes:
+    if count < 16:
+        return bytes((fix | count,))
+    if count < 0x10000:
+        return bytes((code16,)) + struct.pack('>H', count)
+    return bytes((code32,)) + struct.pack('>I', count)
+
+
+class MsgpackCodec:
+    name = 'msgpack'
+    binary = True
+
+    @staticmethod
+    def value(value: Any) -> bytes:
+        return msgpack.packb(value, use_bin_type=True)
+
+    @staticmethod
+    def array(items) -> bytes:
+        items = list(items)
+        return _msgpack_header(len(items), 0x90, 0xdc, 0xdd) + b''.join(items)
+
+    @classmethod
+    def mapping(cls, pairs) -> bytes:
+        pairs = list(pairs)
+        return _msgpack_header(len(pairs), 0x80, 0xde, 0xdf) + b''.join(
+            cls.value(key) + item for key, item in pairs)
+
+
+CODECS = {'json': JSONCodec}
+if MSGPACK_AVAILABLE:
+    CODECS['msgpack'] = MsgpackCodec
+
+Variant = namedtuple('Variant', 'codec columns')
+"""codec: a name from CODECS; columns: True for the columnar layout"""
+
+DEFAULT_VARIANT = Variant('json', False)
+
+
+def negotiate_variant(encoding: Optional[str], layout: Optional[str]) -> Variant:
+    """Variant for a client's requested encoding/layout; unknown or
+    unavailable choices fall back to JSON objects"""
+    return Variant(encoding if encoding in CODECS else 'json', layout == 'columns')
+
+
+class Fragment:
+    """One scalar or entry together with its encodings, computed on demand"""
+
+    __slots__ = ('value', 'encoded')
+
+    def __init__(self, value: Any):
+        self.value = value
+        self.encoded = {'json': JSONCodec.value(value)}
+
+    @property
+    def json(self) -> str:
+        return self.encoded['json']
+
+    def encode(self, codec) -> Any:
+        encoded = self.encoded.get(codec.name)
+        if encoded is None:
+            encoded = self.encoded[codec.name] = codec.value(self.value)
+        return encoded
+
+    def row(self, codec, fields: tuple) -> Any:
+        """The entry as an array of its values in ``fields`` order"""
+        key = (codec.name, fields)
+        encoded = self.encoded.get(key)
+        if encoded is None:
+            get = self.value.get
+            encoded = self.encoded[key] = codec.array(codec.value(get(field)) for field in fields)
+        return encoded
+
+
+def _reuse(cache: Optional[Dict[Any, Fragment]], key, value) -> Fragment:
+    cached = cache.get(key) if cache else None
+    if cached is not None and cached.value == value:
+        return cached
+    return Fragment(value)
+
+
+def encode_entries(fragments: List[Fragment], variant: Variant) -> Any:
+    """A list of entries in the variant's codec and layout"""
+    codec = CODECS[variant.codec]
+    if not variant.columns:
+        return codec.array(f.encode(codec) for f in fragments)
+    fields = {}
+    for f in fragments:
+        for field in f.value:
+            fields.setdefault(field, None)
+    fields = tuple(fields)
+    return codec.mapping((('fields', codec.value(list(fields))),
+                          ('rows', codec.array(f.row(codec, fields) for f in fragments))))
+
+
+class SnapshotIndex:
+    """Fragments of one snapshot, reusing those of ``prev`` for scalars and
+    entries that did not change"""
+
+    __slots__ = ('keys', 'scalars', 'sections', '_encoded')
+
+    def __init__(self, data: Dict[str, Any], prev: Optional['SnapshotIndex'] = None):
+        self.keys = list(data)
+        self.scalars = {key: _reuse(prev and prev.scalars, key, value)
+                        for key, value in data.items() if key not in SECTIONS}
+        self.sections = {}
+        for section, id_key in SECTIONS.items():
+            if section not in data:
+                continue
+            previous = prev.sections.get(section) if prev else None
+            self.sections[section] = {entry[id_key]: _reuse(previous, entry[id_key], entry)
+                                      for entry in data[section]}
+        self._encoded = {}
+
+    def encode(self, variant: Variant = DEFAULT_VARIANT) -> Any:
+        """The whole snapshot as one encoded object"""
+        encoded = self._encoded.get(variant)
+        if encoded is None:
+            codec = CODECS[variant.codec]
+            encoded = self._encoded[variant] = codec.mapping(
+                (key, self.scalars[key].encode(codec) if key in self.scalars
+                 else encode_entries(list(self.sections[key].values()), variant))
+                for key in self.keys)
+        return encoded
+
+
+def diff_snapshots(prev: Optional[SnapshotIndex], data: Dict[str, Any]):
+    """Delta from ``prev`` to ``data``.
+
+    Returns ``(delta, index)``: the delta (empty when nothing changed, None
+    when there is no baseline) with set values and upserted entries as
+    Fragments, for encode_delta(), and the index of ``data`` to diff the
+    next snapshot against.
+    """
+    index = SnapshotIndex(data, prev)
+    if prev is None:
+        return None, index
+
+    delta: Dict[str, Any] = {}
+    changed = {key: fragment for key, fragment in index.scalars.items()
+               if key not in prev.scalars or prev.scalars[key].json != fragment.json}
+    if changed:
+        delta['set'] = changed
+    gone = [key for key in prev.scalars if key not in index.scalars]
+    if gone:
+        delta['unset'] = gone
+
+    for section in SECTIONS:
+        old = prev.sections.get(section, {})
+        new = index.sections.get(section, {})
+        changes: Dict[str, List[Any]] = {}
+        upsert = [fragment for key, fragment in new.items()
+                  if key not in old or old[key].json != fragment.json]
+        if upsert:
+            changes['upsert'] = upsert
+        removed = [key for key in old if key not in new]
+        if removed:
+            changes['remove'] = removed
+        if list(new) != [key for key in old if key in new] + [key for key in new if key not in old]:
+            changes['order'] = list(new)
+        if changes:
+            delta[section] = changes
+    return delta, index
+
+
+def encode_delta(delta: Dict[str, Any], variant: Variant = DEFAULT_VARIANT, **header) -> Any:
+    """Message for a delta from diff_snapshots(), with ``header`` fields first"""
+    codec = CODECS[variant.codec]
+    parts = [(key, codec.value(value)) for key, value in header.items()]
+    for key, value in delta.items():
+        if key == 'set':
+            parts.append((key, codec.mapping((k, f.encode(codec)) for k, f in value.items())))
+        elif key in SECTIONS:
+            parts.append((key, codec.mapping(
+                (part, encode_entries(items, variant) if part == 'upsert' else codec.value(items))
+                for part, items in value.items())))
+        else:
+            parts.append((key, codec.value(value)))
+    return codec.mapping(parts)
@@ -0,0 +1,92 @@
+"""
+Snapshot feed from the collector process to WebSocket worker processes
+Used by asterisk-realtime-websocket.py when ``realtime.workers`` is set
+
+In that mode one collector process does all the AMI, queue_log and database
+work and publishes every new snapshot over a local Unix socket; the worker
+processes share the WebSocket port (SO_REUSEPORT) and serve the clients from
+the feed, so AMI and database load do not grow with the number of workers.
+
+A frame is a 9-byte header (payload length and snapshot seq, big-endian
+uint32 each, and the length of the epoch), the collector's epoch in ASCII,
+then the snapshot as JSON: the bytes the collector has already encoded for
+legacy clients, so feeding N workers costs N socket writes and no extra
+encoding.  Workers number their snapshots with the collector's (epoch, seq),
+so a client resuming after a reconnect can land on any worker.  Each worker connection holds at most one
+unsent frame; a worker that falls behind skips to the latest snapshot, just
+like a slow WebSocket client.
+"""
+
+import asyncio
+import json
+import os
+import struct
+from typing import Any, Dict, Optional, Tuple
+
+HEADER = struct.Struct('>IIB')
+
+
+class _WorkerLink:
+    """One connected worker and the latest frame it has not been sent yet"""
+
+    def __init__(self, writer: asyncio.StreamWriter):
+        self.writer = writer
+        self.pending: Optional[bytes] = None
+        self._wakeup = asyncio.Event()
+
+    def offer(self, frame: bytes) -> None:
+        self.pending = frame
+        self._wakeup.set()
+
+    async def run(self) -> None:
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            frame, self.pending = self.pending, None
+            self.writer.write(frame)
+            await self.writer.drain()
+
+
+class FeedServer:
+    """Collector side: hands every published snapshot to all workers, and the
+    latest one to a worker as soon as it connects"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.seq = None
+        self.links = set()
+        self._latest: Optional[bytes] = None
+        self._server = None
+
+    async def start(self) -> None:
+        if os.path.exists(self.path):
+            os.unlink(self.path)     # left over from a previous run
+        self._server = await asyncio.start_unix_server(self._accept, path=self.path)
+
+    def publish(self, epoch: str, seq: int, payload: bytes) -> None:
+        self.seq = seq
+        tag = epoch.encode('ascii')
+        self._latest = HEADER.pack(len(payload), seq, len(tag)) + tag + payload
+        for link in self.links:
+            link.offer(self._latest)
+
+    async def _accept(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        link = _WorkerLink(writer)
+        self.links.add(link)
+        if self._latest is not None:
+            link.offer(self._latest)
+        try:
+            await link.run()
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.links.discard(link)
+            writer.close()
+
+
+async def read_frame(reader: asyncio.StreamReader) -> Tuple[str, int, Dict[str, Any]]:
+    """Worker side: the next ``(epoch, seq, snapshot)`` from the feed.  Raises
+    asyncio.IncompleteReadError when the collector goes away."""
+    size, seq, tag_size = HEADER.unpack(await reader.readexactly(HEADER.size))
+    epoch = (await reader.readexactly(tag_size)).decode('ascii')
+    return epoch, seq, json.loads((await reader.readexactly(size)).decode())
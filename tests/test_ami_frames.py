@@ -0,0 +1,67 @@
+from ami_frames import AMIFrameParser, parse_frame
+
+BANNER = b'Asterisk Call Manager/5.0.1\r\n'
+LOGIN = b'Response: Success\r\nActionID: 1\r\nMessage: Authentication accepted\r\n\r\n'
+EVENT = b'Event: Hangup\r\nChannel: PJSIP/101-00000001\r\nUniqueid: 1700000000.1\r\nCause: 16\r\n\r\n'
+
+
+def feed_all(parser, chunks):
+    frames = []
+    for chunk in chunks:
+        frames.extend(parser.feed(chunk))
+    return frames
+
+
+def test_banner_is_not_a_frame():
+    parser = AMIFrameParser(expect_banner=True)
+    frames = parser.feed(BANNER + LOGIN)
+    assert parser.banner == 'Asterisk Call Manager/5.0.1'
+    assert frames == [{'Response': 'Success', 'ActionID': '1', 'Message': 'Authentication accepted'}]
+    assert parser.pending() == 0
+
+
+def test_banner_split_across_reads():
+    parser = AMIFrameParser(expect_banner=True)
+    assert parser.feed(b'Asterisk Call Man') == []
+    assert parser.banner is None
+    assert parser.feed(b'ager/5.0.1\r') == []
+    frames = parser.feed(b'\n' + LOGIN)
+    assert parser.banner == 'Asterisk Call Manager/5.0.1'
+    assert frames[0]['Response'] == 'Success'
+
+
+def test_terminator_split_at_every_offset():
+    data = LOGIN + EVENT
+    for cut in range(1, 4):
+        # \r | \n\r\n, \r\n | \r\n, \r\n\r | \n
+        split = len(LOGIN) - 4 + cut
+        parser = AMIFrameParser()
+        frames = feed_all(parser, [data[:split], data[split:]])
+        assert [f.get('Response') or f.event for f in frames] == ['Success', 'Hangup'], cut
+        assert parser.pending() == 0
+
+
+def test_one_byte_at_a_time():
+    data = BANNER + LOGIN + EVENT + EVENT
+    parser = AMIFrameParser(expect_banner=True)
+    frames = feed_all(parser, [data[i:i + 1] for i in range(len(data))])
+    assert parser.banner == 'Asterisk Call Manager/5.0.1'
+    assert [f.get('Response') or f.event for f in frames] == ['Success', 'Hangup', 'Hangup']
+    assert frames[1]['Channel'] == 'PJSIP/101-00000001'
+
+
+def test_incomplete_frame_stays_buffered():
+    parser = AMIFrameParser()
+    assert parser.feed(EVENT[:-2]) == []
+    assert parser.pending() == len(EVENT) - 2
+    assert parser.feed(b'\r\n')[0].event == 'Hangup'
+    assert parser.pending() == 0
+
+
+def test_command_output_is_collected():
+    frame = parse_frame(b'Response: Follows\r\nPrivilege: Command\r\n'
+                        b'Output: Name/username   Host\r\nOutput: 101/101   (Unspecified)\r\n'
+                        b'2 sip peers [Monitored: 0 online]')
+    assert frame['Response'] == 'Follows'
+    assert frame['Output'].split('\n') == ['Name/username   Host', '101/101   (Unspecified)',
+                                           '2 sip peers [Monitored: 0 online]']
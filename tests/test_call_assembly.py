@@ -0,0 +1,79 @@
+from call_assembly import group_call_legs, originating_leg
+
+
+def leg(channel, uniqueid, linkedid='', bridgeid='', bridged='', duration=0):
+    return {'channel': channel, 'uniqueid': uniqueid, 'linkedid': linkedid,
+            'bridgeid': bridgeid, 'bridged': bridged, 'duration': duration}
+
+
+def channels_of(calls):
+    return [(call_id, sorted(ch['channel'] for ch in legs)) for call_id, legs in calls]
+
+
+def test_separate_calls_stay_separate():
+    calls = group_call_legs([
+        leg('PJSIP/101-01', '100.1', '100.1', 'b1'),
+        leg('PJSIP/102-02', '100.2', '100.1', 'b1'),
+        leg('PJSIP/103-03', '200.1', '200.1', 'b2'),
+        leg('PJSIP/104-04', '200.2', '200.1', 'b2'),
+    ])
+    assert channels_of(calls) == [('100.1', ['PJSIP/101-01', 'PJSIP/102-02']),
+                                  ('200.1', ['PJSIP/103-03', 'PJSIP/104-04'])]
+
+
+def test_attended_transfer_joins_both_calls():
+    # 101 called 102, put it on hold and called 103; after the transfer
+    # 102 and 103 share a bridge while their Linkedids still differ
+    calls = group_call_legs([
+        leg('PJSIP/102-02', '100.2', '100.1', 'b3', duration=90),
+        leg('PJSIP/103-04', '200.2', '200.1', 'b3', duration=30),
+    ])
+    assert channels_of(calls) == [('100.1', ['PJSIP/102-02', 'PJSIP/103-04'])]
+
+
+def test_transfer_with_originator_still_up():
+    calls = group_call_legs([
+        leg('PJSIP/101-01', '100.1', '100.1', 'b1'),
+        leg('PJSIP/102-02', '100.2', '100.1', 'b1'),
+        leg('PJSIP/101-03', '200.1', '200.1', 'b2'),
+        leg('PJSIP/103-04', '200.2', '200.1', 'b2'),
+        leg('PJSIP/104-05', '300.1', '300.1'),
+    ])
+    assert channels_of(calls) == [('100.1', ['PJSIP/101-01', 'PJSIP/102-02']),
+                                  ('200.1', ['PJSIP/101-03', 'PJSIP/103-04']),
+                                  ('300.1', ['PJSIP/104-05'])]
+
+
+def test_queue_call_through_local_channels():
+    trunk = leg('PJSIP/we-00000010', '500.1', '500.1', 'b9', duration=40)
+    legs = [
+        trunk,
+        leg('Local/101@from-queue-00000001;1', '500.2', '500.1', 'b9', duration=12),
+        leg('Local/101@from-queue-00000001;2', '500.3', '500.1', 'b10', duration=12),
+        leg('PJSIP/101-00000011', '500.4', '500.1', 'b10', duration=12),
+        leg('Local/102@from-queue-00000002;1', '500.5', '500.1', duration=15),
+    ]
+    calls = group_call_legs(legs)
+    assert len(calls) == 1
+    call_id, grouped = calls[0]
+    assert call_id == '500.1'
+    assert len(grouped) == 5
+    assert originating_leg(grouped) is trunk
+
+
+def test_bridged_peer_without_linkedid():
+    # Asterisk 11: no Linkedid/BridgeId, only BridgedChannel
+    calls = group_call_legs([
+        leg('SIP/101-01', '1.1', bridged='SIP/we-02', duration=10),
+        leg('SIP/we-02', '1.2', bridged='SIP/101-01', duration=12),
+        leg('SIP/103-03', '1.3', duration=5),
+    ])
+    assert channels_of(calls) == [('1.1', ['SIP/101-01', 'SIP/we-02']), ('1.3', ['SIP/103-03'])]
+    assert originating_leg(calls[0][1])['channel'] == 'SIP/we-02'    # longest running
+
+
+def test_call_id_is_stable_when_legs_come_and_go():
+    first = group_call_legs([leg('PJSIP/we-1', '700.1', '700.1', 'b1'),
+                             leg('PJSIP/101-2', '700.2', '700.1', 'b1')])
+    later = group_call_legs([leg('PJSIP/101-2', '700.2', '700.1', 'b1')])
+    assert first[0][0] == later[0][0] == '700.1'
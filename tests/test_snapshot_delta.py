@@ -0,0 +1,141 @@
+import copy
+import json
+
+import pytest
+
+from snapshot_delta import (MSGPACK_AVAILABLE, SECTIONS, SnapshotIndex, Variant,
+                            diff_snapshots, encode_delta)
+
+if MSGPACK_AVAILABLE:
+    import msgpack
+
+VARIANTS = [
+    Variant('json', False),
+    Variant('json', True),
+    pytest.param(Variant('msgpack', False), marks=pytest.mark.skipif(not MSGPACK_AVAILABLE, reason='msgpack not installed')),
+    pytest.param(Variant('msgpack', True), marks=pytest.mark.skipif(not MSGPACK_AVAILABLE, reason='msgpack not installed')),
+]
+
+
+# ── Client side, as in assets/realtime-protocol.js ──────────────────
+
+def decode(message, variant):
+    if variant.codec == 'msgpack':
+        return msgpack.unpackb(message, raw=False)
+    return json.loads(message)
+
+
+def from_columns(block):
+    if isinstance(block, list):
+        return block
+    return [dict(zip(block['fields'], row)) for row in block['rows']]
+
+
+def load_snapshot(data):
+    for section in SECTIONS:
+        if section in data:
+            data[section] = from_columns(data[section])
+    return data
+
+
+def apply_delta(state, delta):
+    state.update(delta.get('set', {}))
+    for key in delta.get('unset', []):
+        del state[key]
+    for section, id_key in SECTIONS.items():
+        change = delta.get(section)
+        if not change:
+            continue
+        by_key = {entry[id_key]: entry for entry in state.get(section, [])}
+        for key in change.get('remove', []):
+            del by_key[key]
+        for entry in from_columns(change.get('upsert', [])):
+            by_key[entry[id_key]] = entry
+        state[section] = [by_key[key] for key in change['order']] if 'order' in change else list(by_key.values())
+
+
+def normalized(data):
+    """Columnar rows carry every field of the section; absent ones decode as None"""
+    data = copy.deepcopy(data)
+    for section in SECTIONS:
+        for entry in data.get(section, []):
+            for key in [key for key, value in entry.items() if value is None]:
+                del entry[key]
+    return data
+
+
+# ── Fixtures ────────────────────────────────────────────────────────
+
+def call(call_id, ext, status='Up', duration=0):
+    return {'call_id': call_id, 'extension': ext, 'status': status, 'duration': duration}
+
+
+def kpi(ext, calls, status='idle'):
+    return {'extension': ext, 'total_calls_today': calls, 'status': status}
+
+
+SNAPSHOTS = [
+    {'timestamp': 100, 'active_calls': 1,
+     'calls': [call('c1', '101')],
+     'extension_kpis': [kpi('101', 3), kpi('102', 0), kpi('103', 7)],
+     'queues': [{'name': 'sales', 'calls_waiting': 0}]},
+    # scalar change, entry change, new call
+    {'timestamp': 102, 'active_calls': 2,
+     'calls': [call('c1', '101', duration=2), call('c2', '102', 'Ringing')],
+     'extension_kpis': [kpi('101', 3, 'busy'), kpi('102', 0, 'ringing'), kpi('103', 7)],
+     'queues': [{'name': 'sales', 'calls_waiting': 0}]},
+    # removal, reorder, a scalar gone and one added
+    {'timestamp': 104, 'active_calls': 1, 'note': 'x',
+     'calls': [call('c2', '102', duration=2)],
+     'extension_kpis': [kpi('103', 7), kpi('101', 4), kpi('102', 0, 'busy')],
+     'queues': [{'name': 'support', 'calls_waiting': 1}, {'name': 'sales', 'calls_waiting': 2}]},
+    # unset scalar, empty section, new entry with a field the others lack
+    {'timestamp': 106, 'active_calls': 0,
+     'calls': [],
+     'extension_kpis': [kpi('103', 7), kpi('101', 4), kpi('102', 1), dict(kpi('104', 0), break_history=[])],
+     'queues': [{'name': 'sales', 'calls_waiting': 2}, {'name': 'support', 'calls_waiting': 0}]},
+]
+
+
+@pytest.mark.parametrize('variant', VARIANTS)
+def test_deltas_rebuild_every_snapshot(variant):
+    index = SnapshotIndex(SNAPSHOTS[0])
+    state = load_snapshot(decode(index.encode(variant), variant))
+    assert normalized(state) == SNAPSHOTS[0]
+    for data in SNAPSHOTS[1:]:
+        delta, index = diff_snapshots(index, data)
+        message = decode(encode_delta(delta, variant, type='delta', seq=1, base=0), variant)
+        assert (message['type'], message['seq'], message['base']) == ('delta', 1, 0)
+        apply_delta(state, message)
+        assert normalized(state) == data
+
+
+def test_delta_contents():
+    index = SnapshotIndex(SNAPSHOTS[1])
+    delta, _ = diff_snapshots(index, SNAPSHOTS[2])
+    message = json.loads(encode_delta(delta))
+    assert message['set'] == {'timestamp': 104, 'active_calls': 1, 'note': 'x'}
+    assert message['calls'] == {'upsert': [call('c2', '102', duration=2)], 'remove': ['c1']}
+    assert message['extension_kpis']['upsert'] == [kpi('101', 4), kpi('102', 0, 'busy')]
+    assert message['extension_kpis']['order'] == ['103', '101', '102']
+    assert 'remove' not in message['extension_kpis']
+    assert message['queues']['order'] == ['support', 'sales']
+
+
+def test_unchanged_snapshot_gives_empty_delta():
+    index = SnapshotIndex(SNAPSHOTS[0])
+    delta, _ = diff_snapshots(index, copy.deepcopy(SNAPSHOTS[0]))
+    assert delta == {}
+
+
+def test_no_baseline_gives_no_delta():
+    delta, index = diff_snapshots(None, SNAPSHOTS[0])
+    assert delta is None
+    assert json.loads(index.encode()) == SNAPSHOTS[0]
+
+
+def test_unchanged_entries_reuse_their_encoding():
+    first = SnapshotIndex(SNAPSHOTS[0])
+    second = SnapshotIndex(copy.deepcopy(SNAPSHOTS[1]), first)
+    assert second.sections['extension_kpis']['103'] is first.sections['extension_kpis']['103']
+    assert second.sections['extension_kpis']['101'] is not first.sections['extension_kpis']['101']
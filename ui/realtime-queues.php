@@ -133,9 +133,10 @@ use function buildUrl;
 
 </div>
 
+<script src="<?= h($CONFIG['assetsUrl']) ?>/realtime-protocol.js"></script>
 <script>
-let ws = null;
-let reconnectInterval = null;
+// Only what this page renders
+const SUBSCRIPTION = { topics: ['queues'] };
 
 function formatDuration(seconds) {
   const m = Math.floor(seconds / 60);
@@ -302,71 +303,7 @@ function updateDisplay(data) {
     }).join('');
   }
 
-  document.getElementById('updateStatus').textContent = 'Last Update: ' + new Date().toLocaleTimeString();
-}
-
-function connectWebSocket() {
-  if (ws && ws.readyState === WebSocket.OPEN) {
-    return;
-  }
-
-  // Construct WebSocket URL - use current hostname with port 8765
-  const wsProtocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
-  const wsUrl = `${wsProtocol}//${window.location.hostname}:8765`;
-
-  console.log('Connecting to WebSocket:', wsUrl);
-  document.getElementById('updateStatus').textContent = 'Connecting to WebSocket...';
-
-  try {
-    ws = new WebSocket(wsUrl);
-
-    ws.onopen = function() {
-      console.log('✓ WebSocket connected');
-      document.getElementById('connectionStatus').className = 'connection-status connected';
-      document.getElementById('updateStatus').textContent = 'Connected - Waiting for updates';
-
-      // Clear reconnect interval if exists
-      if (reconnectInterval) {
-        clearInterval(reconnectInterval);
-        reconnectInterval = null;
-      }
-    };
-
-    ws.onmessage = function(event) {
-      try {
-        const data = JSON.parse(event.data);
-        document.getElementById('connectionStatus').className = 'connection-status connected';
-        updateDisplay(data);
-      } catch (e) {
-        console.error('Error parsing WebSocket message:', e);
-      }
-    };
-
-    ws.onerror = function(error) {
-      console.error('WebSocket error:', error);
-      document.getElementById('connectionStatus').className = 'connection-status disconnected';
-      document.getElementById('updateStatus').textContent = 'Connection Error';
-    };
-
-    ws.onclose = function() {
-      console.log('✗ WebSocket disconnected');
-      document.getElementById('connectionStatus').className = 'connection-status disconnected';
-      document.getElementById('updateStatus').textContent = 'Disconnected - Reconnecting...';
-
-      // Attempt to reconnect every 5 seconds
-      if (!reconnectInterval) {
-        reconnectInterval = setInterval(function() {
-          console.log('Attempting to reconnect...');
-          connectWebSocket();
-        }, 5000);
-      }
-    };
-
-  } catch (e) {
-    console.error('Failed to create WebSocket:', e);
-    document.getElementById('connectionStatus').className = 'connection-status disconnected';
-    document.getElementById('updateStatus').textContent = 'Failed to connect';
-  }
+  document.getElementById('updateStatus').textContent = updateStatusText(data);
 }
 
 // Initialize WebSocket connection
@@ -233,6 +233,7 @@ use function buildUrl;
 
 </div>
 
+<script src="<?= h($CONFIG['assetsUrl']) ?>/realtime-protocol.js"></script>
 <script>
 const IS_ADMIN = <?= $isAdmin ? 'true' : 'false' ?>;
 const ALLOWED_EXTS = <?= json_encode(array_fill_keys((array)($me['extensions'] ?? []), true)) ?>;
@@ -247,8 +248,11 @@ function filterByPermissions(data) {
   return d;
 }
 
-let ws = null;
-let reconnectInterval = null;
+// Only what this page renders: calls and extension KPIs with break details,
+// and for non-admins only their own extensions
+const SUBSCRIPTION = { topics: ['calls', 'extension_kpis', 'breaks'] };
+if (!IS_ADMIN) SUBSCRIPTION.extensions = Object.keys(ALLOWED_EXTS).filter(e => /^\d+$/.test(e));
+
 let sessionStats = {};
 
 function fetchSessionStats() {
@@ -491,71 +495,7 @@ function updateDisplay(data) {
     `).join('');
   }
 
-  document.getElementById('updateStatus').textContent = 'Last Update: ' + new Date().toLocaleTimeString();
-}
-
-function connectWebSocket() {
-  if (ws && ws.readyState === WebSocket.OPEN) {
-    return;
-  }
-
-  // Construct WebSocket URL - use current hostname with port 8765
-  const wsProtocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
-  const wsUrl = `${wsProtocol}//${window.location.hostname}:8765`;
-
-  console.log('Connecting to WebSocket:', wsUrl);
-  document.getElementById('updateStatus').textContent = 'Connecting to WebSocket...';
-
-  try {
-    ws = new WebSocket(wsUrl);
-
-    ws.onopen = function() {
-      console.log('✓ WebSocket connected');
-      document.getElementById('connectionStatus').className = 'connection-status connected';
-      document.getElementById('updateStatus').textContent = 'Connected - Waiting for updates';
-
-      // Clear reconnect interval if exists
-      if (reconnectInterval) {
-        clearInterval(reconnectInterval);
-        reconnectInterval = null;
-      }
-    };
-
-    ws.onmessage = function(event) {
-      try {
-        const data = JSON.parse(event.data);
-        document.getElementById('connectionStatus').className = 'connection-status connected';
-        updateDisplay(data);
-      } catch (e) {
-        console.error('Error parsing WebSocket message:', e);
-      }
-    };
-
-    ws.onerror = function(error) {
-      console.error('WebSocket error:', error);
-      document.getElementById('connectionStatus').className = 'connection-status disconnected';
-      document.getElementById('updateStatus').textContent = 'Connection Error';
-    };
-
-    ws.onclose = function() {
-      console.log('✗ WebSocket disconnected');
-      document.getElementById('connectionStatus').className = 'connection-status disconnected';
-      document.getElementById('updateStatus').textContent = 'Disconnected - Reconnecting...';
-
-      // Attempt to reconnect every 5 seconds
-      if (!reconnectInterval) {
-        reconnectInterval = setInterval(function() {
-          console.log('Attempting to reconnect...');
-          connectWebSocket();
-        }, 5000);
-      }
-    };
-
-  } catch (e) {
-    console.error('Failed to create WebSocket:', e);
-    document.getElementById('connectionStatus').className = 'connection-status disconnected';
-    document.getElementById('updateStatus').textContent = 'Failed to connect';
-  }
+  document.getElementById('updateStatus').textContent = updateStatusText(data);
 }
 
 // Initialize WebSocket connection